@@ -1,11 +1,19 @@
 import sys
 import argparse
-from async_myvariant import AsyncMyVariantInfo
+from async_myvariant import AsyncMyVariantInfo, MYVARIANT_URL
+from annotation_cache import AnnotationCache
+from annotation_schema import FIELDS, OUTPUT_SCHEMA
+from annotation_writer import AnnotationWriter, OUTPUT_FORMATS, scan_annotations
+from checkpoint import Checkpoint, make_manifest as make_checkpoint_manifest
+from local_annotations import LocalAnnotations
+from incremental import InputOrder, find_previous, make_manifest, save_snapshot
+from run_metrics import RunMetrics
+from vcf_reader import VARIANT_SCHEMA, iter_variant_rows
 import polars as pl
 import asyncio
 import logging
+from itertools import islice
 from pathlib import Path
-import time
 
 
 def handle_exception(exc_type, exc_value, exc_traceback):
@@ -13,10 +21,9 @@ def handle_exception(exc_type, exc_value, exc_traceback):
         sys.__excepthook__(exc_type, exc_value, exc_traceback)
         return
 
-    logger.error("Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback))
-
-
-sys.excepthook = handle_exception
+    logging.getLogger("annotate").error(
+        "Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback)
+    )
 
 
 def annotate_variant(data: dict):
@@ -67,62 +74,16 @@ def annotate_variant(data: dict):
     )
 
 
-async def main(input_path, output_path, logger):
-    client = AsyncMyVariantInfo()
-    logger.info(f"Reading {input_path}...")
-    hgvs_notations = client.get_hgvs_from_vcf(input_path)
-    logger.info(f"Success! There are {len(hgvs_notations)} SNPs")
-
-    # queries myvariant
-    # ----------------
-    fields = [
-        # frequency
-        "cadd.1000g.af",
-        "dbnsfp.1000gp3.af",
-        "gnomad_exome.af.af_male",
-        "gnomad_exome.af.af",
-        "gnomad_exome.af.af_female",
-        "dbnsfp.exac.af",
-        "dbsnp.alleles.freq.exac",
-        "exac.af",
-        # geneid
-        "dbnsfp.ensembl.geneid",
-        "docm.ensembl_gene_id",
-        "cadd.gene.gene_id",
-        # rsid
-        "dbsnp.rsid",
-        "dbnsfp.rsid",
-        "gnomad_genome.rsid",
-        # dp
-        "gnomad_exome.dp",
-        "gnomad_genome.dp",
-        "exac.dp",
-        # vcf
-        "vcf",
-    ]
-
-    logger.info(f"Querying {len(hgvs_notations)} SNPs...")
-
-    start_time = time.perf_counter()  # Record the start time
-    response = await client.getvariants(
-        ids=hgvs_notations, fields=fields, chunk_size=1000
-    )
-    end_time = time.perf_counter()  # Record the end time
-    elapsed_time = end_time - start_time
-
-    logger.info(f"Success! Query took {elapsed_time:.2f} seconds.")
-
-    annotations = [annotate_variant(data) for data in response]
-
-    output_dict = {
-        "hgvs": [],
-        "rsid": [],
-        "genes": [],
-        "freq": [],
-        "male_freq": [],
-        "female_freq": [],
-        "dp": [],
-    }
+# columns read from the annotations, the others are read from the VCF
+ANNOTATION_COLUMNS = ["hgvs", "rsid", "genes", "freq", "male_freq", "female_freq", "dp"]
+ANNOTATION_SCHEMA = {column: OUTPUT_SCHEMA[column] for column in ANNOTATION_COLUMNS}
+
+
+def annotations_to_frame(annotations) -> pl.DataFrame:
+    """
+    Builds the DataFrame of the `ANNOTATION_COLUMNS` from `annotate_variant` results.
+    """
+    output_dict = {column: [] for column in ANNOTATION_COLUMNS}
     for (
         hgvs,
         rsid,
@@ -134,24 +95,322 @@ async def main(input_path, output_path, logger):
     ) in annotations:
         output_dict["hgvs"].append(hgvs)
         output_dict["rsid"].append(rsid)
-        genes = ",".join(gene_ids) if gene_ids else None
-        output_dict["genes"].append(genes)
+        output_dict["genes"].append(gene_ids or None)
         output_dict["freq"].append(global_freq)
         output_dict["male_freq"].append(male_freq)
         output_dict["female_freq"].append(female_freq)
         output_dict["dp"].append(global_dp)
-    df = pl.from_dict(output_dict)
-    df.write_csv(output_path, separator="\t")
+    return pl.from_dict(output_dict, schema=ANNOTATION_SCHEMA, strict=False)
+
+
+# columns gathered by `annotate_variants` from the hits
+RESPONSE_SCHEMA = {
+    "hgvs": pl.String,
+    "rsid": pl.String,
+    "genes": pl.String,
+    "gnomad_af": pl.Float64,
+    "male_freq": pl.Float64,
+    "female_freq": pl.Float64,
+    "genome_1k_af": pl.Float64,
+    "exac_af": pl.Float64,
+    "gnomad_exome_dp": pl.Float64,
+    "gnomad_genome_dp": pl.Float64,
+    "exac_dp": pl.Float64,
+}
+# a gene without an id in a list of gene ids joined by commas
+EMPTY_GENE_ID = r"(?:^|,)(?:,|$)"
+
+
+def _truthy(expr: pl.Expr) -> pl.Expr:
+    # mirrors python's `or`, which skips zeros as well as missing values
+    return pl.when(expr != 0).then(expr)
+
+
+def annotate_variants(response: list[dict]) -> pl.DataFrame:
+    """
+    Columnar equivalent of `annotate_variant` followed by `annotations_to_frame`.
+
+    The values are gathered from the hits in a single pass into flat columns, which
+    polars builds without inspecting nested objects, and the preferred values are
+    picked with expressions instead of per-variant python code. Gene ids are joined
+    by commas and split by polars, which is much faster than building a list column
+    from python lists.
+    """
+    if not response:
+        return pl.DataFrame(schema=ANNOTATION_SCHEMA)
+
+    hgvs, rsid, genes = [], [], []
+    gnomad_af, male_freq, female_freq, gnomad_exome_dp = [], [], [], []
+    genome_1k_af, gnomad_genome_dp, exac_af, exac_dp = [], [], [], []
+    empty = {}
+    for data in response:
+        hgvs.append(data["query"])
+        rsid.append(data.get("dbsnp", empty).get("rsid"))
+        cadd = data.get("cadd", empty)
+        gene = cadd.get("gene")
+        if not gene:
+            genes.append(None)
+        elif isinstance(gene, list):
+            genes.append(",".join(item.get("gene_id") or "" for item in gene))
+        else:
+            # a single gene is returned as a dict instead of a list of dicts
+            genes.append(gene.get("gene_id") or "")
+        genome_1k_af.append(cadd.get("1000g", empty).get("af"))
+        exome = data.get("gnomad_exome", empty)
+        freqs = exome.get("af", empty)
+        gnomad_af.append(freqs.get("af"))
+        male_freq.append(freqs.get("af_male"))
+        female_freq.append(freqs.get("af_female"))
+        gnomad_exome_dp.append(exome.get("dp"))
+        gnomad_genome_dp.append(data.get("gnomad_genome", empty).get("dp"))
+        exac = data.get("exac", empty)
+        exac_af.append(exac.get("af"))
+        exac_dp.append(exac.get("dp"))
+    raw = pl.DataFrame(
+        {
+            "hgvs": hgvs,
+            "rsid": rsid,
+            "genes": genes,
+            "gnomad_af": gnomad_af,
+            "male_freq": male_freq,
+            "female_freq": female_freq,
+            "genome_1k_af": genome_1k_af,
+            "exac_af": exac_af,
+            "gnomad_exome_dp": gnomad_exome_dp,
+            "gnomad_genome_dp": gnomad_genome_dp,
+            "exac_dp": exac_dp,
+        },
+        schema=RESPONSE_SCHEMA,
+        strict=False,
+    )
+
+    gene_ids = pl.col("genes").str.split(",")
+    # genes without an id are rare, and nulling them is comparatively slow
+    if raw["genes"].str.contains(EMPTY_GENE_ID).any():
+        gene_ids = gene_ids.list.eval(pl.when(pl.element() != "").then(pl.element()))
+    return raw.select(
+        "hgvs",
+        "rsid",
+        gene_ids.alias("genes"),
+        pl.coalesce(
+            _truthy(pl.col("gnomad_af")),
+            _truthy(pl.col("genome_1k_af")),
+            pl.col("exac_af"),
+        ).alias("freq"),
+        "male_freq",
+        "female_freq",
+        pl.coalesce(
+            _truthy(pl.col("gnomad_exome_dp")),
+            _truthy(pl.col("gnomad_genome_dp")),
+            pl.col("exac_dp"),
+        )
+        .cast(pl.Int64)
+        .alias("dp"),
+    )
+
+
+async def main(
+    input_path,
+    output_path,
+    logger,
+    client=None,
+    chunk_size=1000,
+    output_format=None,
+    workers=1,
+    region_size=None,
+    incremental=False,
+    checkpoint=True,
+):
+    """
+    Annotates the VCF at `input_path` as a stream: SNPs are read, queried, annotated and
+    appended to the output one chunk at a time, so memory is bounded by the chunk size
+    and the number of requests in flight, not by the size of the VCF.
+
+    In incremental mode, the annotations of the previous run are reused for the SNPs
+    still in the VCF and only the new SNPs are queried. The VCF is still streamed and
+    reused and new annotations are merged in VCF order, see `incremental.InputOrder`.
+
+    With `checkpoint`, each annotated chunk is also persisted as it completes, and a
+    run that crashed or was killed resumes after the last persisted chunk, see
+    `checkpoint.Checkpoint`.
+    """
+    if client is None:
+        client = AsyncMyVariantInfo()
+    logger.info(f"Reading {input_path}...")
+    if Path(input_path).suffix == ".parquet":
+        # variants gathered beforehand, e.g. the variants of a cohort
+        variants = pl.read_parquet(input_path, columns=list(VARIANT_SCHEMA)).iter_rows()
+    else:
+        variants = iter_variant_rows(
+            input_path, workers=workers, region_size=region_size
+        )
+
+    manifest = None
+    previous = None
+    if incremental:
+        manifest = make_manifest(FIELDS, client.url, await client.source_version())
+        previous = find_previous(Path(output_path), manifest)
+
+    num_snps = 0
+    client.metrics = RunMetrics()
+    with AnnotationWriter(output_path, OUTPUT_SCHEMA, format=output_format) as output:
+        input_order = InputOrder(
+            scan_annotations(previous, OUTPUT_SCHEMA).collect()
+            if previous is not None
+            else None,
+            chunk_size,
+            OUTPUT_SCHEMA,
+        )
+
+        chunks = None
+        if checkpoint:
+            chunks = Checkpoint(
+                output_path,
+                make_checkpoint_manifest(
+                    input_path, FIELDS, client.url, chunk_size, previous
+                ),
+            )
+            if chunks.load():
+                logger.info(
+                    f"Resuming after {chunks.num_chunks} chunks ({chunks.num_rows} "
+                    f"SNPs) annotated by an interrupted run."
+                )
+                for df in chunks.iter_chunks():
+                    output.write(df)
+                    num_snps += len(df)
+                variants = islice(variants, chunks.num_inputs, None)
+
+        logger.info(f"Querying SNPs in chunks of {chunk_size}...")
+        try:
+            async for response in client.iter_chunks(
+                input_order.new_ids(variants),
+                fields=FIELDS,
+                chunk_size=chunk_size,
+            ):
+                df, num_inputs = input_order.merge(annotate_variants(response))
+                if chunks is not None:
+                    chunks.save(df, num_inputs)
+                output.write(df)
+                num_snps += len(df)
+                logger.debug(f"Wrote {num_snps} SNPs to {output_path}")
+            df, num_inputs = input_order.flush()
+            if df is not None:
+                if chunks is not None:
+                    chunks.save(df, num_inputs)
+                output.write(df)
+                num_snps += len(df)
+        except BaseException:
+            if chunks is not None and chunks.num_chunks:
+                logger.error(
+                    f"Interrupted after {chunks.num_chunks} chunks, run again to "
+                    f"resume from {chunks.dir}."
+                )
+            raise
+        client.metrics.variants = output.num_rows
+    if previous is not None:
+        logger.info(
+            f"Reused {input_order.num_reused} annotated SNPs from the previous run, "
+            f"{input_order.num_new} SNPs were new."
+        )
+    if chunks is not None:
+        chunks.remove()
+    if manifest is not None:
+        save_snapshot(Path(output_path), manifest)
+
+    metrics = client.metrics.to_dict()
+    logger.info(
+        f"Success! Annotated {num_snps} SNPs in {metrics['seconds']:.2f} seconds."
+    )
+    logger.info(
+        f"{metrics['variants_per_second']:.0f} SNPs per second, {metrics['chunks']} "
+        f"chunks queried in {metrics['requests']} requests, {metrics['retries']} "
+        f"retries, {metrics['errors']} errors."
+    )
+    client.metrics.save(Path(output_path), Path(output_path).stem)
+    if client.cache is not None:
+        client.cache.log_stats()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input_file")
     parser.add_argument("output_file")
+    parser.add_argument(
+        "--cache", help="Path to a SQLite file used to cache MyVariant.info responses"
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        help="Seconds after which cached responses are queried again",
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=None,
+        help="Maximum number of cached responses, least recently used are evicted first",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only use cached responses, uncached SNPs are reported as not found",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=8,
+        help="Maximum number of concurrent requests to MyVariant.info",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="Number of SNPs per query and per batch written to the output",
+    )
+    parser.add_argument(
+        "--format",
+        choices=sorted(set(OUTPUT_FORMATS.values())),
+        default=None,
+        help="Output format, inferred from the output file extension by default",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes parsing the VCF by region, requires a tabix or CSI index",
+    )
+    parser.add_argument(
+        "--region-size",
+        type=int,
+        default=None,
+        help="Size in bases of the regions parsed in parallel, whole contigs by default",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Reuse the annotations of the previous run and only query new SNPs",
+    )
+    parser.add_argument(
+        "--no-checkpoint",
+        dest="checkpoint",
+        action="store_false",
+        help="Don't persist annotated chunks, an interrupted run starts over",
+    )
+    parser.add_argument(
+        "--local",
+        help="Annotate from a local store built by local_annotations.py instead of MyVariant.info",
+    )
+    parser.add_argument(
+        "--url",
+        default=MYVARIANT_URL,
+        help="Base URL of the MyVariant.info API",
+    )
 
     args = parser.parse_args()
     input_path = Path(args.input_file)
     output_path = Path(args.output_file)
+    if args.offline and not args.cache:
+        parser.error("--offline requires --cache")
 
     # Setup logging
     # setup third party logs
@@ -182,5 +441,33 @@ if __name__ == "__main__":
     file_log.setLevel(logging.NOTSET)  # Log absolutely everything to file
     file_log.setFormatter(formatter)
     logger.addHandler(file_log)
+    sys.excepthook = handle_exception
+
+    cache = None
+    if args.cache:
+        cache = AnnotationCache(
+            args.cache, ttl=args.cache_ttl, max_entries=args.cache_max_entries
+        )
 
-    asyncio.run(main(input_path=input_path, output_path=output_path, logger=logger))
+    client = AsyncMyVariantInfo(
+        cache=cache,
+        offline=args.offline,
+        url=args.url,
+        max_in_flight=args.max_in_flight,
+        backend=LocalAnnotations(args.local) if args.local else None,
+    )
+
+    asyncio.run(
+        main(
+            input_path=input_path,
+            output_path=output_path,
+            logger=logger,
+            client=client,
+            chunk_size=args.chunk_size,
+            output_format=args.format,
+            workers=args.workers,
+            region_size=args.region_size,
+            incremental=args.incremental,
+            checkpoint=args.checkpoint,
+        )
+    )
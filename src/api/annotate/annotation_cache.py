@@ -0,0 +1,147 @@
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+
+# SQLite's default limit on host parameters is 999 on older builds
+SQLITE_BATCH_SIZE = 900
+
+
+def fields_key(fields) -> str:
+    """
+    Normalizes a `fields` argument into the string used as part of the cache key.
+    """
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    return ",".join(sorted(field.strip() for field in fields))
+
+
+class AnnotationCache:
+    """
+    Persistent on-disk cache of MyVariant.info hits, keyed by HGVS ID and the requested fields.
+
+    Entries older than `ttl` seconds are treated as misses, and the cache is trimmed to the
+    `max_entries` most recently used entries on `evict`.
+    """
+
+    def __init__(
+        self,
+        path: Path | str,
+        ttl: float | None = None,
+        max_entries: int | None = None,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger("annotate")
+
+        # several snakemake jobs may share the same cache file
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS annotations (
+                hgvs TEXT NOT NULL,
+                fields TEXT NOT NULL,
+                hits TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (hgvs, fields)
+            ) WITHOUT ROWID
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS annotations_accessed ON annotations (accessed)"
+        )
+        self.connection.commit()
+
+    def get_many(self, ids, fields="all") -> dict[str, list[dict]]:
+        """
+        Returns the cached hits for the given ids, as a dict of id -> list of hits.
+        Ids that are not cached, or that have expired, are left out.
+        """
+        key = fields_key(fields)
+        now = time.time()
+        oldest = now - self.ttl if self.ttl is not None else float("-inf")
+        unique_ids = list(dict.fromkeys(ids))
+
+        found = {}
+        for i in range(0, len(unique_ids), SQLITE_BATCH_SIZE):
+            batch = unique_ids[i : i + SQLITE_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.connection.execute(
+                f"SELECT hgvs, hits FROM annotations WHERE fields = ? AND created >= ? "
+                f"AND hgvs IN ({placeholders})",
+                (key, oldest, *batch),
+            )
+            for hgvs, hits in rows:
+                found[hgvs] = json.loads(hits)
+
+        if found:
+            self.connection.executemany(
+                "UPDATE annotations SET accessed = ? WHERE hgvs = ? AND fields = ?",
+                ((now, hgvs, key) for hgvs in found),
+            )
+            self.connection.commit()
+
+        self.hits += len(found)
+        self.misses += len(unique_ids) - len(found)
+        return found
+
+    def put_many(self, hits_by_id: dict[str, list[dict]], fields="all"):
+        """
+        Stores the hits returned for each id, replacing any previous entry.
+        """
+        key = fields_key(fields)
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO annotations (hgvs, fields, hits, created, accessed) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                (hgvs, key, json.dumps(hits), now, now)
+                for hgvs, hits in hits_by_id.items()
+            ),
+        )
+        self.connection.commit()
+
+    def evict(self) -> int:
+        """
+        Removes expired entries, then the least recently used ones above `max_entries`.
+        Returns the number of removed entries.
+        """
+        removed = 0
+        if self.ttl is not None:
+            cursor = self.connection.execute(
+                "DELETE FROM annotations WHERE created < ?", (time.time() - self.ttl,)
+            )
+            removed += cursor.rowcount
+        if self.max_entries is not None:
+            cursor = self.connection.execute(
+                "DELETE FROM annotations WHERE (hgvs, fields) IN ("
+                "SELECT hgvs, fields FROM annotations ORDER BY accessed DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            removed += cursor.rowcount
+        self.connection.commit()
+        if removed:
+            self.logger.debug(f"Evicted {removed} entries from {self.path}")
+        return removed
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        self.logger.info(
+            f"Annotation cache: {self.hits} hits, {self.misses} misses "
+            f"({hit_rate:.1%} hit rate), {len(self)} entries in {self.path}"
+        )
+
+    def close(self):
+        self.connection.close()
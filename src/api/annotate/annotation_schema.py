@@ -0,0 +1,47 @@
+import polars as pl
+
+# fields queried from MyVariant.info and columns of the annotations, apart from
+# annotate.py so that other scripts can use them without importing it
+
+# queries myvariant
+# ----------------
+FIELDS = [
+    # frequency
+    "cadd.1000g.af",
+    "dbnsfp.1000gp3.af",
+    "gnomad_exome.af.af_male",
+    "gnomad_exome.af.af",
+    "gnomad_exome.af.af_female",
+    "dbnsfp.exac.af",
+    "dbsnp.alleles.freq.exac",
+    "exac.af",
+    # geneid
+    "dbnsfp.ensembl.geneid",
+    "docm.ensembl_gene_id",
+    "cadd.gene.gene_id",
+    # rsid
+    "dbsnp.rsid",
+    "dbnsfp.rsid",
+    "gnomad_genome.rsid",
+    # dp
+    "gnomad_exome.dp",
+    "gnomad_genome.dp",
+    "exac.dp",
+    # vcf
+    "vcf",
+]
+
+# fixed so that every batch written to the output has the same columns and types
+OUTPUT_SCHEMA = {
+    "hgvs": pl.String,
+    "chrom": pl.String,
+    "pos": pl.Int64,
+    "ref": pl.String,
+    "alt": pl.String,
+    "rsid": pl.String,
+    "genes": pl.List(pl.String),
+    "freq": pl.Float64,
+    "male_freq": pl.Float64,
+    "female_freq": pl.Float64,
+    "dp": pl.Int64,
+}
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import polars as pl
+
+OUTPUT_FORMATS = {
+    ".tsv": "tsv",
+    ".parquet": "parquet",
+    ".arrow": "ipc",
+    ".ipc": "ipc",
+    ".feather": "ipc",
+}
+
+
+def output_format(path: Path | str) -> str:
+    """
+    Infers the output format from the file extension.
+    """
+    suffix = Path(path).suffix
+    if suffix not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unknown output format {suffix}. Must be one of: {list(OUTPUT_FORMATS)}"
+        )
+    return OUTPUT_FORMATS[suffix]
+
+
+def scan_annotations(
+    path: Path | str, schema: dict, format: str | None = None
+) -> pl.LazyFrame:
+    """
+    Scans a file written by `AnnotationWriter`, with the gene list split back into a
+    list column for TSV files.
+    """
+    format = format or output_format(path)
+    if format == "parquet":
+        return pl.scan_parquet(path)
+    elif format == "ipc":
+        return pl.scan_ipc(path)
+    return pl.scan_csv(
+        path,
+        separator="\t",
+        schema_overrides={**schema, "genes": pl.String},
+    ).with_columns(pl.col("genes").str.split(","))
+
+
+class AnnotationWriter:
+    """
+    Appends batches of annotations to a TSV, Parquet or Arrow IPC file.
+
+    TSV batches are appended to the output as they arrive, with the gene list joined by
+    commas. Columnar formats can't be appended to, so batches are spilled to Parquet
+    parts next to the output and streamed into a single file when the writer is closed.
+
+    The output is written to a hidden file and moved into place once complete, so
+    readers never see a partial file and a previous output is only replaced on success.
+    """
+
+    def __init__(self, path: Path | str, schema: dict, format: str | None = None):
+        self.path = Path(path)
+        self.schema = schema
+        self.format = format or output_format(self.path)
+        self.num_rows = 0
+        self.tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        self.file = None
+        self.parts_dir = None
+
+    def __enter__(self):
+        if self.format == "tsv":
+            self.file = open(self.tmp_path, "wb")
+            self._to_tsv(pl.DataFrame(schema=self.schema)).write_csv(
+                self.file, separator="\t"
+            )
+        else:
+            self.parts_dir = Path(
+                tempfile.mkdtemp(prefix=f".{self.path.name}.", dir=self.path.parent)
+            )
+        return self
+
+    def write(self, df: pl.DataFrame):
+        if self.format == "tsv":
+            self._to_tsv(df).write_csv(self.file, separator="\t", include_header=False)
+        else:
+            df.write_parquet(
+                self.parts_dir / f"{self.num_rows:012d}.parquet",
+                compression="uncompressed",
+            )
+        self.num_rows += len(df)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.format == "tsv":
+                self.file.close()
+            elif exc_type is None:
+                self._assemble()
+            if exc_type is None:
+                os.replace(self.tmp_path, self.path)
+        finally:
+            self.tmp_path.unlink(missing_ok=True)
+            if self.parts_dir is not None:
+                shutil.rmtree(self.parts_dir, ignore_errors=True)
+
+    def _assemble(self):
+        # the streaming engine can sink Parquet scans, but not IPC scans
+        parts = sorted(self.parts_dir.glob("*.parquet"))
+        if parts:
+            lf = pl.scan_parquet(parts)
+        else:
+            lf = pl.LazyFrame(schema=self.schema)
+        if self.format == "parquet":
+            lf.sink_parquet(self.tmp_path, statistics=True)
+        else:
+            # uncompressed, so that the API can memory-map it
+            lf.sink_ipc(self.tmp_path, compression=None)
+
+    @staticmethod
+    def _to_tsv(df: pl.DataFrame) -> pl.DataFrame:
+        return df.with_columns(pl.col("genes").list.join(","))
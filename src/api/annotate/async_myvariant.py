@@ -1,43 +1,215 @@
 import asyncio
-from myvariant import MyVariantInfo
+from collections import deque
+from itertools import batched
+import random
+import time
+import httpx
 from pathlib import Path
-from cyvcf2 import VCF
 import logging
+from annotation_cache import AnnotationCache
+from local_annotations import LocalAnnotations
+from run_metrics import RunMetrics
+from vcf_reader import iter_hgvs
+
+MYVARIANT_URL = "https://myvariant.info/v1"
+# responses worth retrying, anything else is raised right away
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
 
 class AsyncMyVariantInfo:
-    def __init__(self):
-        self.client = MyVariantInfo()
-
-    def get_hgvs_from_vcf(self, path: Path | str) -> list[str]:
-        file = VCF(str(path))
-        return list(
-            self.client.format_hgvs(
-                variant.CHROM, variant.POS, variant.REF, variant.ALT[0]
+    """
+    Queries MyVariant.info, or a local store built from dumps when given a `backend`,
+    see `local_annotations.LocalAnnotations`.
+    """
+
+    def __init__(
+        self,
+        cache: AnnotationCache | None = None,
+        offline: bool = False,
+        url: str = MYVARIANT_URL,
+        max_in_flight: int = 8,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        timeout: float = 120.0,
+        transport: httpx.AsyncBaseTransport | None = None,
+        backend: LocalAnnotations | None = None,
+    ):
+        if offline and cache is None:
+            raise ValueError("Offline mode requires an annotation cache")
+        self.cache = cache
+        self.offline = offline
+        self.url = url.rstrip("/") if backend is None else backend.url
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.transport = transport
+        self.backend = backend
+        self.metrics = RunMetrics()
+
+    def get_hgvs_from_vcf(
+        self, path: Path | str, workers: int = 1, region_size: int | None = None
+    ) -> list[str]:
+        return list(self.iter_hgvs_from_vcf(path, workers, region_size))
+
+    def iter_hgvs_from_vcf(
+        self, path: Path | str, workers: int = 1, region_size: int | None = None
+    ):
+        """
+        Lazily yields the HGVS ids of every ALT allele of the variants in the VCF, in
+        file order. Indexed VCFs can be parsed in parallel, see `vcf_reader.iter_hgvs`.
+        """
+        return iter_hgvs(path, workers=workers, region_size=region_size)
+
+    async def source_version(self) -> str | None:
+        """
+        Returns the build version of the MyVariant.info data, None when offline or when
+        the metadata can't be fetched.
+        """
+        if self.backend is not None:
+            return self.backend.version()
+        if self.offline:
+            return None
+        try:
+            async with httpx.AsyncClient(
+                timeout=self.timeout, transport=self.transport
+            ) as http:
+                response = await http.get(f"{self.url}/metadata")
+                response.raise_for_status()
+                return response.json().get("build_version")
+        except (httpx.HTTPError, ValueError) as e:
+            logging.getLogger("annotate").warning(
+                f"Could not fetch the MyVariant.info metadata: {e!r}"
             )
-            for variant in file
-        )
+            return None
 
     async def getvariants(self, ids: list, chunk_size=500, fields="all"):
         """
         Fetch variant information for a list of IDs asynchronously, divided into chunks.
+        IDs found in the cache are not sent over the network.
+        """
+        results = []
+        async for hits in self.iter_chunks(ids, chunk_size=chunk_size, fields=fields):
+            results.extend(hits)
+        return results
+
+    async def iter_chunks(self, ids, chunk_size=500, fields="all"):
+        """
+        Yields the hits for each chunk of IDs, in the order of `ids`, as chunks complete.
+
+        `ids` may be any iterable, it is consumed lazily: at most `max_in_flight` requests
+        are sent at once, and no more than twice as many chunks are held in memory.
         """
-        loop = asyncio.get_event_loop()
         logger = logging.getLogger("annotate")
-        # Divide the ids into chunks
-        chunks = [ids[i : i + chunk_size] for i in range(0, len(ids), chunk_size)]
-        logger.debug(
-            f"Divided {len(ids)} SNPs into {len(chunks)} chunks of size {chunk_size}."
+        limits = httpx.Limits(
+            max_connections=self.max_in_flight,
+            max_keepalive_connections=self.max_in_flight,
         )
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        pending = deque()
+        num_chunks = 0
+        async with httpx.AsyncClient(
+            limits=limits, timeout=self.timeout, transport=self.transport
+        ) as http:
+            try:
+                for chunk in batched(ids, chunk_size):
+                    pending.append(
+                        asyncio.create_task(
+                            self._query_chunk(http, semaphore, list(chunk), fields)
+                        )
+                    )
+                    num_chunks += 1
+                    if len(pending) >= 2 * self.max_in_flight:
+                        yield await pending.popleft()
+                while pending:
+                    yield await pending.popleft()
+            finally:
+                for task in pending:
+                    task.cancel()
+                # once per run, evicting scans the whole cache
+                if self.cache is not None:
+                    evicted = self.cache.evict()
+                    logger.debug(f"Evicted {evicted} cached responses.")
+        logger.debug(f"Queried {num_chunks} chunks of size {chunk_size}.")
 
-        # Asynchronously fetch data for each chunk
-        tasks = [
-            loop.run_in_executor(
-                None, lambda chunk=chunk: self.client.getvariants(chunk, fields=fields)
-            )
-            for chunk in chunks
-        ]
-        results = await asyncio.gather(*tasks)
+    async def _query_chunk(self, http, semaphore, ids: list, fields):
+        logger = logging.getLogger("annotate")
+        if self.cache is None:
+            async with semaphore:
+                return await self._fetch(http, ids, fields)
+
+        cached = self.cache.get_many(ids, fields=fields)
+        missing = [id for id in dict.fromkeys(ids) if id not in cached]
+        self.metrics.cache_hits += len(cached)
+        self.metrics.cache_misses += len(missing)
+        logger.debug(f"Cache returned {len(cached)} SNPs, {len(missing)} missing.")
+
+        fetched = {}
+        if self.offline:
+            if missing:
+                logger.warning(
+                    f"Offline mode: {len(missing)} SNPs are not cached and will be reported as not found."
+                )
+            fetched = {id: [{"query": id, "notfound": True}] for id in missing}
+        elif missing:
+            async with semaphore:
+                hits = await self._fetch(http, missing, fields)
+            for hit in hits:
+                fetched.setdefault(hit["query"], []).append(hit)
+            self.cache.put_many(fetched, fields=fields)
+
+        # keeps the order of the requested ids
+        results = []
+        for id in ids:
+            results.extend(cached.get(id) or fetched.get(id, []))
+        return results
+
+    async def _fetch(self, http: httpx.AsyncClient, ids: list, fields) -> list[dict]:
+        start = time.perf_counter()
+        try:
+            if self.backend is not None:
+                # lookups run in a worker thread, polars releases the GIL
+                return await asyncio.to_thread(self.backend.query, ids, fields)
+            return await self._post(http, ids, fields)
+        finally:
+            self.metrics.observe_chunk(time.perf_counter() - start)
 
-        # Merge all results into a single list
-        return sum(results, [])
+    async def _post(self, http: httpx.AsyncClient, ids: list, fields) -> list[dict]:
+        """
+        POSTs a chunk of IDs to the annotation endpoint, retrying with jittered
+        exponential backoff on rate limiting, server errors and connection errors.
+        """
+        logger = logging.getLogger("annotate")
+        data = {"ids": ",".join(f'"{id}"' for id in ids)}
+        if fields != "all":
+            data["fields"] = fields if isinstance(fields, str) else ",".join(fields)
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            self.metrics.requests += 1
+            try:
+                response = await http.post(f"{self.url}/variant", data=data)
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    self.metrics.errors += 1
+                    raise
+                reason = repr(e)
+            else:
+                if (
+                    response.status_code not in RETRY_STATUS_CODES
+                    or attempt == self.max_retries
+                ):
+                    self.metrics.errors += response.is_error
+                    response.raise_for_status()
+                    return response.json()
+                reason = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("Retry-After")
+
+            delay = random.uniform(0, self.backoff * 2**attempt)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            logger.debug(
+                f"Chunk of {len(ids)} SNPs failed with {reason}, retrying in {delay:.2f} seconds."
+            )
+            self.metrics.retries += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import polars as pl
+
+# bump when the layout of the manifest or of the chunks changes
+CHECKPOINT_VERSION = 2
+
+
+def checkpoint_dir(output_path: Path) -> Path:
+    """
+    Chunks annotated by an unfinished run. They live in a hidden directory, so that
+    they survive Snakemake removing the output of a failed job and are not picked up
+    as a sample by the API.
+    """
+    return output_path.parent / ".checkpoints" / output_path.name
+
+
+def file_identity(path: Path | str | None) -> dict | None:
+    """
+    Size and modification time of a file, None if it doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return {"path": str(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def make_manifest(
+    input_path: Path | str,
+    fields: list[str],
+    url: str,
+    chunk_size: int,
+    previous: Path | None = None,
+) -> dict:
+    """
+    Identifies a run: chunks can only be reused by a run reading the same input, in
+    chunks of the same size, annotated with the same fields from the same API, and,
+    in incremental mode, from the same previous output.
+    """
+    return {
+        "version": CHECKPOINT_VERSION,
+        "input": file_identity(input_path),
+        "fields": sorted(fields),
+        "url": url,
+        "chunk_size": chunk_size,
+        "previous": file_identity(previous),
+    }
+
+
+class Checkpoint:
+    """
+    Persists the chunks of a run as they complete, so that a run that crashed or was
+    killed resumes where it stopped instead of querying everything again.
+
+    Chunks are written to Parquet files, then counted in the manifest. Both are
+    replaced atomically, so the manifest only ever counts complete chunks. Chunks are
+    yielded in input order, so the completed chunks always cover the first input ids,
+    counted in the manifest as well.
+    """
+
+    def __init__(self, output_path: Path | str, manifest: dict):
+        self.dir = checkpoint_dir(Path(output_path))
+        self.manifest = manifest
+        self.num_chunks = 0
+        self.num_rows = 0
+        self.num_inputs = 0
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.dir / "manifest.json"
+
+    def chunk_path(self, index: int) -> Path:
+        return self.dir / f"{index:08d}.parquet"
+
+    def load(self) -> int:
+        """
+        Returns the number of chunks completed by a previous run of the same manifest.
+        Checkpoints of other runs are removed.
+        """
+        logger = logging.getLogger("annotate")
+        try:
+            previous = json.loads(self.manifest_path.read_text())
+        except (OSError, ValueError):
+            previous = None
+        if (
+            previous is not None
+            and {key: previous.get(key) for key in self.manifest} == self.manifest
+        ):
+            self.num_chunks = previous["chunks"]
+            self.num_rows = previous["rows"]
+            self.num_inputs = previous["inputs"]
+            return self.num_chunks
+
+        if previous is not None:
+            logger.info(
+                f"The input or the options changed since the interrupted run, "
+                f"discarding its checkpoint in {self.dir}."
+            )
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.num_chunks = self.num_rows = self.num_inputs = 0
+        return 0
+
+    def iter_chunks(self):
+        """
+        Yields the completed chunks, in order.
+        """
+        for index in range(self.num_chunks):
+            yield pl.read_parquet(self.chunk_path(index))
+
+    def save(self, df: pl.DataFrame, num_inputs: int):
+        """
+        Persists the next chunk, annotating the next `num_inputs` input ids.
+        """
+        self.dir.mkdir(parents=True, exist_ok=True)
+        path = self.chunk_path(self.num_chunks)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        df.write_parquet(tmp_path, compression="lz4")
+        os.replace(tmp_path, path)
+
+        self.num_chunks += 1
+        self.num_rows += len(df)
+        self.num_inputs += num_inputs
+        manifest = {
+            **self.manifest,
+            "chunks": self.num_chunks,
+            "rows": self.num_rows,
+            "inputs": self.num_inputs,
+        }
+        tmp_path = self.manifest_path.with_name(f".{self.manifest_path.name}.tmp")
+        tmp_path.write_text(json.dumps(manifest))
+        os.replace(tmp_path, self.manifest_path)
+
+    def remove(self):
+        """
+        Removes the checkpoint once the output is complete.
+        """
+        shutil.rmtree(self.dir, ignore_errors=True)
+        try:
+            self.dir.parent.rmdir()
+        except OSError:
+            pass
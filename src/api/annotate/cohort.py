@@ -0,0 +1,98 @@
+import argparse
+from itertools import batched
+from pathlib import Path
+import polars as pl
+from annotation_schema import OUTPUT_SCHEMA
+from annotation_writer import AnnotationWriter, scan_annotations
+from vcf_reader import VARIANT_SCHEMA, iter_variant_rows
+
+# variants of a sample held in memory at once
+BATCH_SIZE = 100_000
+
+
+def write_variants(
+    vcf_path: Path | str,
+    output_path: Path | str,
+    workers: int = 1,
+    region_size: int | None = None,
+):
+    """
+    Writes the variants of a VCF, in VCF order, to a Parquet file in batches of
+    `BATCH_SIZE`, see `vcf_reader.iter_variant_rows`.
+    """
+    rows = iter_variant_rows(vcf_path, workers=workers, region_size=region_size)
+    with AnnotationWriter(output_path, VARIANT_SCHEMA, format="parquet") as output:
+        for batch in batched(rows, BATCH_SIZE):
+            output.write(pl.DataFrame(batch, schema=VARIANT_SCHEMA, orient="row"))
+
+
+def union_variants(variant_paths: list[Path | str], output_path: Path | str):
+    """
+    Writes the unique variants of all samples, in order of first appearance.
+    """
+    lf = pl.LazyFrame(schema=VARIANT_SCHEMA)
+    if variant_paths:
+        lf = pl.concat([pl.scan_parquet(path) for path in variant_paths])
+    lf.unique("hgvs", maintain_order=True).collect().write_parquet(output_path)
+
+
+def join_sample(
+    variants_path: Path | str,
+    annotations_path: Path | str,
+    output_path: Path | str,
+    output_format: str | None = None,
+):
+    """
+    Writes the annotations of a sample, picked from the cohort annotations, in the
+    order of its VCF.
+    """
+    annotations = scan_annotations(annotations_path, OUTPUT_SCHEMA)
+    df = (
+        pl.scan_parquet(variants_path)
+        .select("hgvs")
+        .join(annotations, on="hgvs", how="inner", maintain_order="left")
+        .collect()
+    )
+    with AnnotationWriter(output_path, OUTPUT_SCHEMA, format=output_format) as output:
+        output.write(df)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Annotates a cohort once, then picks the annotations of each sample"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    variants = commands.add_parser("variants", help="Lists the variants of a VCF")
+    variants.add_argument("input_file")
+    variants.add_argument("output_file")
+    variants.add_argument("--workers", type=int, default=1)
+    variants.add_argument("--region-size", type=int, default=None)
+
+    union = commands.add_parser("union", help="Merges the variants of all samples")
+    union.add_argument("output_file")
+    union.add_argument("input_files", nargs="*")
+
+    join = commands.add_parser("join", help="Writes the annotations of a sample")
+    join.add_argument("variants_file")
+    join.add_argument("annotations_file")
+    join.add_argument("output_file")
+    join.add_argument("--format", default=None)
+
+    args = parser.parse_args()
+    if args.command == "variants":
+        write_variants(
+            args.input_file,
+            args.output_file,
+            workers=args.workers,
+            region_size=args.region_size,
+        )
+    elif args.command == "union":
+        union_variants(args.input_files, args.output_file)
+    else:
+        join_sample(
+            args.variants_file,
+            args.annotations_file,
+            args.output_file,
+            output_format=args.format,
+        )
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import shutil
+from array import array
+from collections import deque
+from itertools import batched
+from pathlib import Path
+
+import polars as pl
+from vcf_reader import VARIANT_SCHEMA
+
+# bump when the layout of the manifest or of the annotations changes
+MANIFEST_VERSION = 3
+# columns of the variants added to their annotations
+POSITION_SCHEMA = {
+    column: dtype for column, dtype in VARIANT_SCHEMA.items() if column != "hgvs"
+}
+
+
+def snapshot_path(output_path: Path) -> Path:
+    """
+    Copy of the last output kept for incremental runs. It lives in a hidden directory,
+    so that it survives Snakemake removing the output before rerunning a job and is not
+    picked up as a sample by the API.
+    """
+    return output_path.parent / ".snapshots" / output_path.name
+
+
+def manifest_path(snapshot: Path) -> Path:
+    return snapshot.with_name(f"{snapshot.name}.manifest.json")
+
+
+def make_manifest(fields: list[str], url: str, source_version: str | None) -> dict:
+    return {
+        "version": MANIFEST_VERSION,
+        "fields": sorted(fields),
+        "url": url,
+        "source_version": source_version,
+    }
+
+
+def find_previous(output_path: Path, manifest: dict) -> Path | None:
+    """
+    Returns the snapshot of the previous output if it was annotated with the same
+    fields, from the same API and, when known, the same data release.
+    """
+    logger = logging.getLogger("annotate")
+    snapshot = snapshot_path(output_path)
+    try:
+        previous = json.loads(manifest_path(snapshot).read_text())
+    except (OSError, ValueError):
+        return None
+    if not snapshot.exists():
+        return None
+
+    for key in ["version", "fields", "url"]:
+        if previous.get(key) != manifest[key]:
+            logger.info(f"The {key} changed since the last run, annotating everything.")
+            return None
+    if manifest["source_version"] not in (None, previous.get("source_version")):
+        logger.info(
+            f"MyVariant.info was updated from {previous.get('source_version')} to "
+            f"{manifest['source_version']} since the last run, annotating everything."
+        )
+        return None
+    return snapshot
+
+
+def save_snapshot(output_path: Path, manifest: dict):
+    """
+    Keeps the output and its manifest for the next incremental run. The output is
+    hard-linked when possible: outputs are replaced, never modified in place.
+    """
+    snapshot = snapshot_path(output_path)
+    snapshot.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = snapshot.with_name(f".{snapshot.name}.tmp")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        os.link(output_path, tmp_path)
+    except OSError:
+        shutil.copyfile(output_path, tmp_path)
+    os.replace(tmp_path, snapshot)
+
+    manifest = {**manifest, "size": snapshot.stat().st_size}
+    tmp_path.write_text(json.dumps(manifest))
+    os.replace(tmp_path, manifest_path(snapshot))
+
+
+class InputOrder:
+    """
+    Merges the annotations reused from the previous run with the new ones, in input
+    order.
+
+    The input is a stream of `(hgvs, chrom, pos, ref, alt)` rows, see
+    `vcf_reader.iter_variant_rows`. `new_ids` filters it lazily, yielding only the ids
+    missing from the previous output, and remembers which reused rows precede each of
+    them. `merge` then adds the positions of the variants to each chunk of new ids once
+    it is annotated, and interleaves it with the reused rows. Chunks are annotated in
+    order, so only the ids in flight are remembered.
+    """
+
+    def __init__(self, previous: pl.DataFrame | None, chunk_size: int, schema: dict):
+        # sorted by id, so that ids are looked up by binary search
+        self.previous = (
+            previous.sort("hgvs", maintain_order=True)
+            if previous is not None and len(previous)
+            else None
+        )
+        self.chunk_size = chunk_size
+        self.columns = list(schema)
+        # (reused rows preceding the variant, number of input ids they cover, variant)
+        self.pending = deque()
+        self.reused = array("q")
+        self.reused_inputs = 0
+        self.num_reused = 0
+        self.num_new = 0
+
+    def _find(self, variants: tuple[tuple, ...]):
+        """
+        Yields the range of rows of each variant in the previous output, empty if
+        missing.
+        """
+        if self.previous is None:
+            return ((0, 0) for _ in variants)
+        ids = pl.Series([variant[0] for variant in variants], dtype=pl.String)
+        hgvs = self.previous["hgvs"]
+        return zip(
+            hgvs.search_sorted(ids, side="left").to_list(),
+            hgvs.search_sorted(ids, side="right").to_list(),
+        )
+
+    def new_ids(self, variants):
+        """
+        Yields the ids that must be queried.
+        """
+        for batch in batched(variants, self.chunk_size):
+            for variant, (start, end) in zip(batch, self._find(batch)):
+                self.reused_inputs += 1
+                if start < end:
+                    self.reused.extend(range(start, end))
+                    self.num_reused += 1
+                    continue
+                self.pending.append((self.reused, self.reused_inputs, variant))
+                self.reused, self.reused_inputs = array("q"), 0
+                self.num_new += 1
+                yield variant[0]
+
+    def merge(self, df: pl.DataFrame) -> tuple[pl.DataFrame, int]:
+        """
+        Returns the rows of the next chunk of new ids, annotated in `df`, preceded by
+        the reused rows they follow in the input, and the number of input ids covered.
+        """
+        reused = array("q")
+        num_inputs = 0
+        # rows of `df` are encoded as negative indices, reused rows as positive ones
+        order = []
+        hgvs = df["hgvs"].to_list()
+        positions = []
+        row = 0
+        for _ in range(min(self.chunk_size, len(self.pending))):
+            rows, inputs, variant = self.pending.popleft()
+            order.extend(range(len(reused), len(reused) + len(rows)))
+            reused.extend(rows)
+            num_inputs += inputs
+            # ids can have several hits, in a row
+            while row < len(hgvs) and hgvs[row] == variant[0]:
+                row += 1
+                order.append(-row)
+                positions.append(variant[1:])
+        positions.extend([(None,) * len(POSITION_SCHEMA)] * (len(hgvs) - row))
+        df = df.hstack(
+            pl.DataFrame(positions, schema=POSITION_SCHEMA, orient="row")
+        ).select(self.columns)
+        if not reused:
+            return df, num_inputs
+        order.extend(range(-row - 1, -len(hgvs) - 1, -1))
+        rows = pl.concat([self.previous[reused], df])
+        return rows[[i if i >= 0 else len(reused) - i - 1 for i in order]], num_inputs
+
+    def flush(self) -> tuple[pl.DataFrame | None, int]:
+        """
+        Returns the reused rows following the last new id and the number of input ids
+        they cover.
+        """
+        reused, self.reused = self.reused, array("q")
+        num_inputs, self.reused_inputs = self.reused_inputs, 0
+        if not reused:
+            return None, num_inputs
+        return self.previous[reused], num_inputs
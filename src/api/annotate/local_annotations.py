@@ -0,0 +1,353 @@
+import argparse
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from pathlib import Path
+import shutil
+import threading
+import polars as pl
+from cyvcf2 import VCF
+from vcf_reader import format_hgvs_batch
+
+# MyVariant.info fields provided by each kind of dump, with the VCF INFO key (or ID)
+# or the TSV column they are read from
+SOURCES = {
+    "dbsnp": {"dbsnp.rsid": "ID"},
+    "gnomad_exome": {
+        "gnomad_exome.af.af": "AF",
+        "gnomad_exome.af.af_male": "AF_male",
+        "gnomad_exome.af.af_female": "AF_female",
+        "gnomad_exome.dp": "DP",
+    },
+    "gnomad_genome": {"gnomad_genome.dp": "DP"},
+    "exac": {"exac.af": "AF", "exac.dp": "DP"},
+    "1000g": {"cadd.1000g.af": "AF"},
+    "cadd": {"cadd.gene.gene_id": "GeneID"},
+}
+# fields with a value per gene, returned as a list of objects like MyVariant.info does
+LIST_FIELDS = {"cadd.gene.gene_id"}
+# bump when the layout of the store changes
+STORE_VERSION = 1
+# variants read from a dump before they are converted to a DataFrame
+BATCH_SIZE = 100_000
+MANIFEST_NAME = "manifest.json"
+
+
+def chrom_of(hgvs: pl.Expr) -> pl.Expr:
+    return hgvs.str.extract(r"^chr([^:]+):")
+
+
+def iter_vcf_source(path: Path | str, columns: dict):
+    """
+    Yields the `columns` of every ALT allele of a VCF dump, keyed by HGVS id, in
+    DataFrames of `BATCH_SIZE` variants. Per-allele INFO values are picked for their
+    allele.
+    """
+    vcf = VCF(str(path))
+    types = {}
+    for field, key in columns.items():
+        if key == "ID":
+            types[field] = pl.String
+        else:
+            header_type = vcf.get_header_type(key)["Type"]
+            types[field] = {"Integer": pl.Int64, "Float": pl.Float32}.get(
+                header_type, pl.String
+            )
+
+    variants = []
+    values = {field: [] for field in columns}
+
+    def flush() -> pl.DataFrame:
+        batch = {"hgvs": pl.Series(format_hgvs_batch(variants), dtype=pl.String)}
+        for field, dtype in types.items():
+            series = pl.Series(values[field], dtype=dtype, strict=False)
+            # float32 INFO values, shortest representation like the VCF text
+            if dtype == pl.Float32:
+                series = series.cast(pl.String).cast(pl.Float64)
+            batch[field] = series
+        variants.clear()
+        for field in values:
+            values[field].clear()
+        return pl.DataFrame(batch)
+
+    for record in vcf:
+        for i, alt in enumerate(record.ALT):
+            variants.append((record.CHROM, record.POS, record.REF, alt))
+            for field, key in columns.items():
+                values[field].append(info_value(record, key, i))
+        if len(variants) >= BATCH_SIZE:
+            yield flush()
+    if variants:
+        yield flush()
+
+
+def info_value(record, key: str, allele: int):
+    if key == "ID":
+        return record.ID
+    value = record.INFO.get(key)
+    if isinstance(value, tuple):
+        return value[allele] if allele < len(value) else None
+    return value
+
+
+def iter_tsv_source(path: Path | str, columns: dict):
+    """
+    Yields the `columns` of a CADD-like TSV dump, with `Chrom`, `Pos`, `Ref` and `Alt`
+    columns, keyed by HGVS id, in DataFrames of `BATCH_SIZE` rows.
+    """
+    reader = pl.read_csv_batched(
+        path,
+        separator="\t",
+        comment_prefix="##",
+        null_values=["NA", "."],
+        infer_schema_length=10_000,
+        batch_size=BATCH_SIZE,
+    )
+    while batches := reader.next_batches(1):
+        df = batches[0]
+        df = df.rename({df.columns[0]: df.columns[0].lstrip("#")})
+        variants = df.select("Chrom", "Pos", "Ref", "Alt").iter_rows()
+        hgvs = format_hgvs_batch([(str(chrom), *rest) for chrom, *rest in variants])
+        yield df.select(
+            pl.Series("hgvs", hgvs, dtype=pl.String),
+            *[pl.col(key).alias(field) for field, key in columns.items()],
+        )
+
+
+def stage_source(kind: str, path: Path | str, staging: Path, index: int):
+    """
+    Writes the variants of the `index`-th dump to `staging` as it is read, in a
+    directory per chromosome and kind, so that dumps never have to fit in memory.
+    """
+    columns = SOURCES[kind]
+    if str(path).endswith((".tsv", ".tsv.gz")):
+        batches = iter_tsv_source(path, columns)
+    else:
+        batches = iter_vcf_source(path, columns)
+    for batch_index, df in enumerate(batches):
+        df = df.with_columns(chrom_of(pl.col("hgvs")).alias("chrom"))
+        for (chrom,), partition in df.filter(pl.col("chrom").is_not_null()).group_by(
+            "chrom"
+        ):
+            directory = staging / chrom / kind
+            directory.mkdir(parents=True, exist_ok=True)
+            partition.drop("chrom").write_parquet(
+                directory / f"{index:04d}-{batch_index:06d}.parquet"
+            )
+
+
+def scan_kind(kind: str, paths: list[Path], schema: dict) -> pl.LazyFrame:
+    """
+    Scans the staged variants of a kind in a chromosome, one row per variant. The first
+    dump giving a variant wins, values per gene are gathered into lists.
+    """
+    if not paths:
+        return pl.LazyFrame(schema=schema)
+    lf = pl.scan_parquet(paths)
+    list_fields = [field for field in SOURCES[kind] if field in LIST_FIELDS]
+    if not list_fields:
+        return lf.unique("hgvs", keep="first")
+    # lists can't be aggregated by the streaming engine, they are gathered in memory
+    # a chromosome at a time
+    return (
+        lf.group_by("hgvs")
+        .agg(
+            pl.col(field).drop_nulls().unique(maintain_order=True)
+            if field in LIST_FIELDS
+            else pl.col(field).first()
+            for field in SOURCES[kind]
+        )
+        .collect()
+        .lazy()
+    )
+
+
+def build_store(root: Path | str, sources: list[tuple[str, Path | str]]):
+    """
+    Builds a local annotation store from dumps, as a Parquet file per chromosome sorted
+    by HGVS id. `sources` are `(kind, path)` pairs, see `SOURCES`; a kind may be given
+    several files, e.g. one per chromosome.
+
+    Dumps are first staged by chromosome, then each chromosome is joined across kinds
+    and written with lazy scans, so memory is bounded by a chromosome, not the dumps.
+    """
+    logger = logging.getLogger("annotate")
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    staging = root / ".staging"
+    shutil.rmtree(staging, ignore_errors=True)
+
+    kinds = []
+    for index, (kind, path) in enumerate(sources):
+        if kind not in SOURCES:
+            raise ValueError(f"Unknown source {kind}. Must be one of: {list(SOURCES)}")
+        logger.info(f"Reading {kind} from {path}...")
+        stage_source(kind, path, staging, index)
+        if kind not in kinds:
+            kinds.append(kind)
+
+    paths = {
+        (chrom_dir.name, kind): sorted((chrom_dir / kind).glob("*.parquet"))
+        for chrom_dir in staging.glob("*")
+        for kind in kinds
+    }
+    # kinds missing from a chromosome still get their columns
+    schemas = {kind: {"hgvs": pl.String} for kind in kinds}
+    for (_, kind), kind_paths in paths.items():
+        if kind_paths and len(schemas[kind]) == 1:
+            schemas[kind] = scan_kind(kind, kind_paths[:1], {}).collect_schema()
+
+    for path in root.glob("*.parquet"):
+        path.unlink()
+    for chrom in sorted({chrom for chrom, _ in paths}):
+        frames = [scan_kind(kind, paths[chrom, kind], schemas[kind]) for kind in kinds]
+        # every variant of any kind, joined with each kind
+        lf = pl.concat([frame.select("hgvs") for frame in frames]).unique("hgvs")
+        for frame in frames:
+            lf = lf.join(frame, on="hgvs", how="left")
+        lf.sort("hgvs").sink_parquet(root / f"{chrom}.parquet", statistics=True)
+    shutil.rmtree(staging)
+
+    source_files = [
+        [kind, str(Path(path).resolve()), Path(path).stat().st_size]
+        for kind, path in sources
+    ]
+    # identifies the dumps the store was built from, like MyVariant.info's build
+    build_version = hashlib.sha1(json.dumps(source_files).encode()).hexdigest()[:12]
+    manifest = {
+        "version": STORE_VERSION,
+        "fields": sorted(field for kind in kinds for field in SOURCES[kind]),
+        "sources": source_files,
+        "build_version": build_version,
+    }
+    (root / MANIFEST_NAME).write_text(json.dumps(manifest, indent=2))
+    num_variants = (
+        pl.scan_parquet(sorted(root.glob("*.parquet")))
+        .select(pl.len())
+        .collect()
+        .item()
+        if any(root.glob("*.parquet"))
+        else 0
+    )
+    logger.info(f"Built a store of {num_variants} variants in {root}.")
+
+
+def to_hit(hgvs: str, row: dict | None) -> dict:
+    """
+    Nests the dotted fields of a row like a MyVariant.info hit.
+    """
+    if row is None:
+        return {"query": hgvs, "notfound": True}
+    hit = {"query": hgvs, "_id": hgvs}
+    for field, value in row.items():
+        if value is None or field == "hgvs":
+            continue
+        *parents, name = field.split(".")
+        if field in LIST_FIELDS:
+            if not value:
+                continue
+            value = [{name: item} for item in value]
+            name = parents.pop()
+        node = hit
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[name] = value
+    return hit
+
+
+class LocalAnnotations:
+    """
+    Answers MyVariant.info queries from a store built by `build_store`.
+
+    Chromosome partitions are loaded on first use and the most recently used ones are
+    kept in memory; ids are looked up with a binary search on the sorted HGVS ids.
+    """
+
+    def __init__(self, root: Path | str, max_partitions: int = 2):
+        self.root = Path(root)
+        self.manifest = json.loads((self.root / MANIFEST_NAME).read_text())
+        if self.manifest.get("version") != STORE_VERSION:
+            raise ValueError(
+                f"The store in {self.root} has an old layout, rebuild it with local_annotations.py"
+            )
+        self.url = self.root.resolve().as_uri()
+        self.max_partitions = max_partitions
+        self.partitions: OrderedDict[str, pl.DataFrame] = OrderedDict()
+        # queries are run in worker threads
+        self.lock = threading.Lock()
+
+    def version(self) -> str:
+        return self.manifest["build_version"]
+
+    def fields(self, fields) -> list[str]:
+        """
+        Returns the stored fields matching the requested ones, a requested field also
+        selects its subfields.
+        """
+        if fields == "all":
+            return self.manifest["fields"]
+        if isinstance(fields, str):
+            fields = fields.split(",")
+        return [
+            stored
+            for stored in self.manifest["fields"]
+            if any(
+                stored == field or stored.startswith(f"{field}.") for field in fields
+            )
+        ]
+
+    def partition(self, chrom: str) -> pl.DataFrame | None:
+        with self.lock:
+            if chrom not in self.partitions:
+                path = self.root / f"{chrom}.parquet"
+                if not path.exists():
+                    return None
+                self.partitions[chrom] = pl.read_parquet(path)
+                while len(self.partitions) > self.max_partitions:
+                    self.partitions.popitem(last=False)
+            self.partitions.move_to_end(chrom)
+            return self.partitions[chrom]
+
+    def query(self, ids: list[str], fields="all") -> list[dict]:
+        """
+        Returns a hit per id, in order, shaped like the MyVariant.info response.
+        Unknown ids are reported as not found.
+        """
+        columns = ["hgvs", *self.fields(fields)]
+        queries = pl.DataFrame({"hgvs": ids}, schema={"hgvs": pl.String})
+        rows = {}
+        for (chrom,), group in queries.with_columns(
+            chrom_of(pl.col("hgvs")).alias("chrom")
+        ).group_by("chrom"):
+            partition = self.partition(chrom) if chrom is not None else None
+            if partition is None or len(partition) == 0:
+                continue
+            positions = (
+                partition["hgvs"]
+                .search_sorted(group["hgvs"])
+                .clip(upper_bound=len(partition) - 1)
+            )
+            found = partition.select(columns)[positions]
+            found = found.filter(found["hgvs"] == group["hgvs"])
+            rows.update((row["hgvs"], row) for row in found.iter_rows(named=True))
+        return [to_hit(id, rows.get(id)) for id in ids]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Builds a local annotation store from dbSNP, gnomAD, ExAC, 1000 Genomes and CADD dumps"
+    )
+    parser.add_argument("store")
+    parser.add_argument(
+        "--source",
+        nargs=2,
+        action="append",
+        metavar=("KIND", "PATH"),
+        required=True,
+        help=f"A dump and its kind, one of: {list(SOURCES)}. VCF or, for CADD, TSV",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_store(args.store, [(kind, path) for kind, path in args.source])
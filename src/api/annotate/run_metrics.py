@@ -0,0 +1,80 @@
+import json
+import os
+import time
+from pathlib import Path
+
+# upper bounds, in seconds, of the buckets of the chunk latency histogram
+CHUNK_SECONDS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def metrics_path(output_path: Path) -> Path:
+    """
+    Metrics of the last run that wrote `output_path`. They live in a hidden directory,
+    so that they are not picked up as a sample by the API, which exposes them on
+    `/metrics`.
+    """
+    return output_path.parent / ".metrics" / f"{output_path.name}.json"
+
+
+class RunMetrics:
+    """
+    Counters of an annotation run: chunks queried and their latency, requests sent,
+    retried and failed, cache hits and misses, and variants written.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.chunks = 0
+        self.chunk_seconds = 0.0
+        # cumulative counts are computed when exporting, as Prometheus expects
+        self.chunk_buckets = [0] * len(CHUNK_SECONDS_BUCKETS)
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.variants = 0
+
+    def observe_chunk(self, seconds: float):
+        self.chunks += 1
+        self.chunk_seconds += seconds
+        for i, bound in enumerate(CHUNK_SECONDS_BUCKETS):
+            if seconds <= bound:
+                self.chunk_buckets[i] += 1
+                break
+
+    def to_dict(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        cache_lookups = self.cache_hits + self.cache_misses
+        return {
+            "seconds": elapsed,
+            "variants": self.variants,
+            "variants_per_second": self.variants / elapsed if elapsed else 0.0,
+            "chunks": self.chunks,
+            "chunk_seconds": {
+                "sum": self.chunk_seconds,
+                "buckets": dict(
+                    zip(map(str, CHUNK_SECONDS_BUCKETS), self.chunk_buckets)
+                ),
+            },
+            "requests": self.requests,
+            "retries": self.retries,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_hit_rate": self.cache_hits / cache_lookups
+            if cache_lookups
+            else None,
+        }
+
+    def save(self, output_path: Path, sample: str):
+        """
+        Writes the metrics of the run next to its output, see `metrics_path`.
+        """
+        path = metrics_path(output_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(
+            json.dumps({"sample": sample, "finished": time.time(), **self.to_dict()})
+        )
+        os.replace(tmp_path, path)
@@ -0,0 +1,727 @@
+from async_myvariant import AsyncMyVariantInfo
+from cyvcf2 import VCF, Writer
+import cyvcf2.cyvcf2
+from annotation_cache import AnnotationCache
+from annotation_writer import AnnotationWriter, scan_annotations
+import annotate
+import checkpoint
+import cohort
+import incremental
+from incremental import InputOrder
+import local_annotations
+import run_metrics
+import vcf_reader
+from myvariant import MyVariantInfo
+import asyncio
+import ctypes
+import json
+import logging
+import random
+import sys
+import time
+from itertools import islice
+from pathlib import Path
+from urllib.parse import parse_qs
+import httpx
+import polars as pl
+import pytest
+
+FIELDS = ["dbsnp.rsid", "cadd.gene.gene_id"]
+EXAMPLE_VCF = Path(__file__).parents[3] / "data" / "example.vcf.gz"
+
+
+class FakeMyVariant:
+    """
+    Local stand-in for the MyVariant.info annotation endpoint, records which ids were
+    queried. The first `failures` requests are answered with `failure_status`.
+    """
+
+    def __init__(self, failures=0, failure_status=503, build_version="20250101"):
+        self.build_version = build_version
+        self.queried = []
+        self.requests = 0
+        self.failures = failures
+        self.failure_status = failure_status
+
+    def __call__(self, request: httpx.Request):
+        if request.url.path.endswith("/metadata"):
+            return httpx.Response(200, json={"build_version": self.build_version})
+        self.requests += 1
+        if self.requests <= self.failures:
+            return httpx.Response(self.failure_status)
+        form = parse_qs(request.content.decode())
+        ids = [id.strip('"') for id in form["ids"][0].split(",")]
+        self.queried.extend(ids)
+        return httpx.Response(
+            200,
+            json=[
+                {"query": id, "dbsnp": {"rsid": f"rs{id.split('.')[1][:-3]}"}}
+                for id in ids
+            ],
+        )
+
+    def client(self, **kwargs):
+        return AsyncMyVariantInfo(
+            transport=httpx.MockTransport(self), backoff=0.001, **kwargs
+        )
+
+
+def make_client(tmp_path, **kwargs):
+    cache = AnnotationCache(tmp_path / "cache.sqlite", **kwargs)
+    return FakeMyVariant().client(cache=cache)
+
+
+def test_import_keeps_excepthook():
+    # only annotate.py's command line logs uncaught exceptions, not its importers
+    assert sys.excepthook is not annotate.handle_exception
+
+
+def test_getvariants_keeps_order():
+    server = FakeMyVariant()
+    client = server.client(max_in_flight=2)
+    ids = [f"chr1:g.{i}A>T" for i in range(1, 1000)]
+    response = asyncio.run(client.getvariants(iter(ids), chunk_size=7, fields=FIELDS))
+    assert [hit["query"] for hit in response] == ids
+    assert sorted(server.queried) == sorted(ids)
+    assert response[41]["dbsnp"]["rsid"] == "rs42"
+
+
+def test_getvariants_retries():
+    server = FakeMyVariant(failures=2, failure_status=429)
+    client = server.client()
+    response = asyncio.run(client.getvariants(["chr1:g.1A>T"]))
+    assert server.requests == 3
+    assert response == [{"query": "chr1:g.1A>T", "dbsnp": {"rsid": "rs1"}}]
+    assert (client.metrics.requests, client.metrics.retries) == (3, 2)
+    assert client.metrics.errors == 0
+
+    server = FakeMyVariant(failures=10)
+    client = server.client(max_retries=2)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(client.getvariants(["chr1:g.1A>T"]))
+    assert server.requests == 3
+    assert client.metrics.errors == 1
+
+    server = FakeMyVariant(failures=1, failure_status=400)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(server.client().getvariants(["chr1:g.1A>T"]))
+    assert server.requests == 1
+
+
+def test_cache_only_queries_misses(tmp_path):
+    client = make_client(tmp_path)
+    ids = ["chr1:g.1A>T", "chr1:g.2A>T"]
+    first = asyncio.run(client.getvariants(ids, fields=FIELDS))
+    assert client.transport.handler.queried == ids
+
+    ids = ["chr1:g.2A>T", "chr1:g.3A>T", "chr1:g.1A>T"]
+    second = asyncio.run(client.getvariants(ids, fields=FIELDS))
+    assert client.transport.handler.queried[2:] == ["chr1:g.3A>T"]
+    assert [hit["query"] for hit in second] == ids
+    assert second[0] == first[1]
+    assert client.cache.hits == 2
+    assert client.cache.misses == 3
+
+
+def test_cache_is_keyed_by_fields(tmp_path):
+    client = make_client(tmp_path)
+    asyncio.run(client.getvariants(["chr1:g.1A>T"], fields=FIELDS))
+    asyncio.run(client.getvariants(["chr1:g.1A>T"], fields=list(reversed(FIELDS))))
+    asyncio.run(client.getvariants(["chr1:g.1A>T"], fields=["dbsnp.rsid"]))
+    assert client.transport.handler.queried == ["chr1:g.1A>T", "chr1:g.1A>T"]
+
+
+def test_cache_eviction(tmp_path):
+    cache = AnnotationCache(tmp_path / "cache.sqlite", max_entries=2)
+    for i in range(4):
+        cache.put_many({f"chr1:g.{i}A>T": [{"query": f"chr1:g.{i}A>T"}]})
+        time.sleep(0.01)
+    assert cache.evict() == 2
+    assert sorted(cache.get_many([f"chr1:g.{i}A>T" for i in range(4)])) == [
+        "chr1:g.2A>T",
+        "chr1:g.3A>T",
+    ]
+
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.get_many(["chr1:g.3A>T"]) == {}
+    assert cache.evict() == 2
+    assert len(cache) == 0
+
+
+def test_cache_evicts_once_per_run(tmp_path):
+    client = make_client(tmp_path, max_entries=2)
+    evict = client.cache.evict
+    calls = []
+    client.cache.evict = lambda: calls.append(None) or evict()
+    ids = [f"chr1:g.{i}A>T" for i in range(1, 6)]
+    asyncio.run(client.getvariants(ids, chunk_size=1, fields=FIELDS))
+    assert len(calls) == 1
+    assert len(client.cache) == 2
+
+
+def test_offline_mode(tmp_path):
+    client = make_client(tmp_path)
+    asyncio.run(client.getvariants(["chr1:g.1A>T"], fields=FIELDS))
+
+    server = FakeMyVariant()
+    offline = server.client(cache=client.cache, offline=True)
+    response = asyncio.run(
+        offline.getvariants(["chr1:g.1A>T", "chr1:g.2A>T"], fields=FIELDS)
+    )
+    assert server.requests == 0
+    assert response[0]["dbsnp"]["rsid"] == "rs1"
+    assert response[1] == {"query": "chr1:g.2A>T", "notfound": True}
+
+
+def test_main_streams_output(tmp_path):
+    server = FakeMyVariant()
+    output_path = tmp_path / "example.tsv"
+    asyncio.run(
+        annotate.main(
+            EXAMPLE_VCF,
+            output_path,
+            logging.getLogger("annotate"),
+            client=server.client(),
+            chunk_size=10,
+        )
+    )
+    hgvs = AsyncMyVariantInfo().get_hgvs_from_vcf(EXAMPLE_VCF)
+    df = pl.read_csv(output_path, separator="\t")
+    assert df.columns == list(annotate.OUTPUT_SCHEMA)
+    assert df["hgvs"].to_list() == hgvs
+    assert df["rsid"][0] == f"rs{hgvs[0].split('.')[1][:-3]}"
+    assert server.requests == 8
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".arrow"])
+def test_main_columnar_output(tmp_path, suffix):
+    output_path = tmp_path / f"example{suffix}"
+    asyncio.run(
+        annotate.main(
+            EXAMPLE_VCF,
+            output_path,
+            logging.getLogger("annotate"),
+            client=FakeMyVariant().client(),
+            chunk_size=10,
+        )
+    )
+    if suffix == ".parquet":
+        df = pl.read_parquet(output_path)
+    else:
+        df = pl.read_ipc(output_path)
+    assert df.schema == pl.Schema(annotate.OUTPUT_SCHEMA)
+    assert df["hgvs"].to_list() == AsyncMyVariantInfo().get_hgvs_from_vcf(EXAMPLE_VCF)
+    record = next(iter(VCF(str(EXAMPLE_VCF))))
+    assert df.select("chrom", "pos", "ref", "alt").row(0) == (
+        record.CHROM,
+        record.POS,
+        record.REF,
+        record.ALT[0],
+    )
+    # spilled parts are removed, the metrics of the run are kept
+    assert sorted(tmp_path.iterdir()) == [tmp_path / ".metrics", output_path]
+    metrics = json.loads(run_metrics.metrics_path(output_path).read_text())
+    assert metrics["sample"] == "example"
+    assert metrics["variants"] == len(df)
+    assert metrics["chunks"] == metrics["requests"] == -(-len(df) // 10)
+    assert sum(metrics["chunk_seconds"]["buckets"].values()) == metrics["chunks"]
+    assert metrics["errors"] == metrics["retries"] == 0
+
+
+def test_writer_empty_output(tmp_path):
+    for name in ["empty.tsv", "empty.parquet", "empty.arrow"]:
+        with AnnotationWriter(tmp_path / name, annotate.OUTPUT_SCHEMA):
+            pass
+    assert pl.read_csv(tmp_path / "empty.tsv", separator="\t").columns == list(
+        annotate.OUTPUT_SCHEMA
+    )
+    assert pl.read_parquet(tmp_path / "empty.parquet").schema == pl.Schema(
+        annotate.OUTPUT_SCHEMA
+    )
+    assert len(pl.read_ipc(tmp_path / "empty.arrow")) == 0
+
+
+def random_hit(rng: random.Random, id: str) -> dict:
+    """
+    Random MyVariant.info hit, with missing sources, zeros, integer values and the
+    different shapes of cadd.gene.
+    """
+
+    def value():
+        return rng.choice([None, 0, 0.0, 1, rng.random(), rng.random() / 1000])
+
+    def with_values(**values):
+        return {key: value for key, value in values.items() if value is not None}
+
+    hit = {"query": id, "_id": id, "vcf": {"ref": "A", "alt": "T"}}
+    if rng.random() < 0.1:
+        return {"query": id, "notfound": True}
+    if rng.random() < 0.7:
+        hit["dbsnp"] = with_values(rsid=rng.choice([None, f"rs{rng.randint(1, 9999)}"]))
+    if rng.random() < 0.7:
+        genes = [{"gene_id": f"ENSG{i}"} for i in range(rng.randint(0, 3))]
+        hit["cadd"] = with_values(
+            gene=rng.choice([None, genes, {"gene_id": "ENSG9"}, {"gene": "x"}]),
+            **{"1000g": rng.choice([None, with_values(af=value())])},
+        )
+    if rng.random() < 0.7:
+        hit["gnomad_exome"] = with_values(
+            af=with_values(af=value(), af_male=value(), af_female=value()),
+            dp=rng.choice([None, 0, rng.randint(1, 10**6)]),
+        )
+    if rng.random() < 0.5:
+        hit["gnomad_genome"] = with_values(dp=rng.choice([None, 0, 12]))
+    if rng.random() < 0.5:
+        hit["exac"] = with_values(af=value(), dp=rng.choice([None, 0, 7.0]))
+    return hit
+
+
+def test_annotate_variants_matches_annotate_variant():
+    rng = random.Random(42)
+    response = [random_hit(rng, f"chr1:g.{i}A>T") for i in range(2000)]
+    expected = annotate.annotations_to_frame(
+        annotate.annotate_variant(data) for data in response
+    )
+    assert annotate.annotate_variants(response).equals(expected)
+    assert annotate.annotate_variants([]).equals(annotate.annotations_to_frame([]))
+
+
+MULTI_ALLELIC_VCF = """##fileformat=VCFv4.2
+##contig=<ID=chr1,length=2500>
+##contig=<ID=chr2,length=1000>
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+chr1\t100\t.\tA\tC,G\t.\t.\t.
+chr1\t1200\t.\tAT\tA\t.\t.\t.
+chr1\t2400\t.\tC\t.\t.\t.\t.
+chr2\t5\t.\tG\tGTT,T\t.\t.\t.
+"""
+
+
+def test_iter_hgvs_every_alt(tmp_path):
+    vcf_path = tmp_path / "multi.vcf"
+    vcf_path.write_text(MULTI_ALLELIC_VCF)
+    expected = [
+        "chr1:g.100A>C",
+        "chr1:g.100A>G",
+        "chr1:g.1201del",
+        "chr2:g.5_6insTT",
+        "chr2:g.5G>T",
+    ]
+    assert AsyncMyVariantInfo().get_hgvs_from_vcf(vcf_path) == expected
+    # without an index the VCF is read serially
+    assert vcf_reader.has_index(vcf_path) is False
+    assert list(vcf_reader.iter_hgvs(vcf_path, workers=2)) == expected
+
+
+def test_iter_variant_rows(tmp_path):
+    vcf_path = tmp_path / "multi.vcf"
+    vcf_path.write_text(MULTI_ALLELIC_VCF)
+    # REF and ALT come from the VCF, for indels too
+    expected = [
+        ("chr1:g.100A>C", "1", 100, "A", "C"),
+        ("chr1:g.100A>G", "1", 100, "A", "G"),
+        ("chr1:g.1201del", "1", 1200, "AT", "A"),
+        ("chr2:g.5_6insTT", "2", 5, "G", "GTT"),
+        ("chr2:g.5G>T", "2", 5, "G", "T"),
+    ]
+    assert list(vcf_reader.iter_variant_rows(vcf_path)) == expected
+
+    output_path = tmp_path / "multi.parquet"
+    asyncio.run(
+        annotate.main(
+            vcf_path,
+            output_path,
+            logging.getLogger("annotate"),
+            client=FakeMyVariant().client(),
+        )
+    )
+    df = pl.read_parquet(output_path)
+    assert df.select("hgvs", "chrom", "pos", "ref", "alt").rows() == expected
+
+
+def test_format_hgvs_batch():
+    variants = [
+        ("1", 10, "A", "T"),
+        ("chrX", 20, "G", "C"),
+        ("2", 30, "GA", "G"),
+        ("MT", 40, "C", "CAA"),
+        ("3", 50, "ACG", "AG"),
+    ]
+    myvariant = MyVariantInfo()
+    assert vcf_reader.format_hgvs_batch(variants) == [
+        myvariant.format_hgvs(*variant) for variant in variants
+    ]
+
+
+def test_split_regions(tmp_path):
+    vcf_path = tmp_path / "multi.vcf"
+    vcf_path.write_text(MULTI_ALLELIC_VCF)
+    assert vcf_reader.split_regions(vcf_path) == [
+        ("chr1", None, None),
+        ("chr2", None, None),
+    ]
+    assert vcf_reader.split_regions(vcf_path, region_size=1000) == [
+        ("chr1", 1, 1000),
+        ("chr1", 1001, 2000),
+        ("chr1", 2001, 2500),
+        ("chr2", 1, 1000),
+    ]
+    # records overlapping the start of a region belong to the previous one
+    records = list(vcf_reader.VCF(str(vcf_path)))
+    assert [pos for _, pos, _, _ in vcf_reader.iter_variants(records, 1001, 2000)] == [
+        1200
+    ]
+
+
+def write_indexed_vcf(path: Path, text: str):
+    """
+    Writes a bgzipped VCF and its tabix index, with the htslib bundled in cyvcf2.
+    """
+    plain_path = path.with_name(f"{path.name}.txt")
+    plain_path.write_text(text)
+    vcf = VCF(str(plain_path))
+    writer = Writer(str(path), vcf, mode="wz")
+    for record in vcf:
+        writer.write_record(record)
+    writer.close()
+    htslib = ctypes.CDLL(cyvcf2.cyvcf2.__file__)
+    assert htslib.bcf_index_build3(str(path).encode(), None, 0, 0) == 0
+
+
+# polars warns when a process is forked after it started its thread pool
+@pytest.mark.filterwarnings("error")
+def test_iter_hgvs_parallel_matches_serial(tmp_path):
+    rng = random.Random(3)
+    lines = [
+        "##fileformat=VCFv4.2",
+        "##contig=<ID=chr1,length=5000>",
+        "##contig=<ID=chr2,length=3000>",
+        "##contig=<ID=chrX,length=1000>",
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO",
+    ]
+    for chrom, length in [("chr1", 5000), ("chr2", 3000)]:
+        # every region boundary, with deletions overlapping the next region
+        positions = {1, 999, 1000, 1001, 2000, length} | {
+            rng.randint(1, length) for _ in range(100)
+        }
+        for pos in sorted(positions):
+            ref, alts = rng.choice(
+                [("A", ["C"]), ("C", ["G", "T"]), ("GAT", ["G"]), ("T", ["TAA", "C"])]
+            )
+            lines.append(f"{chrom}\t{pos}\t.\t{ref}\t{','.join(alts)}\t.\t.\t.")
+    vcf_path = tmp_path / "sample.vcf.gz"
+    write_indexed_vcf(vcf_path, "\n".join(lines) + "\n")
+
+    serial = list(vcf_reader.iter_variant_rows(vcf_path))
+    assert len(serial) > 200
+    for region_size in [None, 1000, 333]:
+        parallel = vcf_reader.iter_variant_rows(
+            vcf_path, workers=2, region_size=region_size
+        )
+        assert list(parallel) == serial
+
+
+def write_vcf_subset(path: Path, keep):
+    """
+    Writes the records of the example VCF for which `keep(index)` is true.
+    """
+    vcf = VCF(str(EXAMPLE_VCF))
+    writer = Writer(str(path), vcf)
+    for i, record in enumerate(vcf):
+        if keep(i):
+            writer.write_record(record)
+    writer.close()
+
+
+@pytest.mark.parametrize("suffix", [".tsv", ".parquet"])
+def test_main_incremental(tmp_path, suffix):
+    output_path = tmp_path / f"sample{suffix}"
+    vcf_path = tmp_path / "sample.vcf"
+    hgvs = AsyncMyVariantInfo().get_hgvs_from_vcf(EXAMPLE_VCF)
+
+    def run(server, keep):
+        write_vcf_subset(vcf_path, keep)
+        asyncio.run(
+            annotate.main(
+                vcf_path,
+                output_path,
+                logging.getLogger("annotate"),
+                client=server.client(),
+                chunk_size=10,
+                incremental=True,
+            )
+        )
+        return scan_annotations(output_path, annotate.OUTPUT_SCHEMA).collect()
+
+    server = FakeMyVariant()
+    run(server, lambda i: i < 50 and i % 2 == 0)
+    assert server.queried == hgvs[:50:2]
+
+    # the VCF was extended and variants were removed, new and reused annotations are
+    # merged in VCF order
+    server = FakeMyVariant()
+    df = run(server, lambda i: i >= 10)
+    assert server.queried == [
+        id for i, id in enumerate(hgvs) if i >= 10 and (i % 2 or i >= 50)
+    ]
+    assert df["hgvs"].to_list() == hgvs[10:]
+    assert df["rsid"].to_list() == [f"rs{id.split('.')[1][:-3]}" for id in hgvs[10:]]
+    assert (tmp_path / ".snapshots" / output_path.name).exists()
+
+    # a new MyVariant.info release invalidates the previous annotations
+    server = FakeMyVariant(build_version="20260101")
+    run(server, lambda i: i >= 10)
+    assert server.queried == hgvs[10:]
+
+
+def test_input_order():
+    def variant(id):
+        return (id, "1", ord(id), "A", "C")
+
+    schema = {**vcf_reader.VARIANT_SCHEMA, "rsid": pl.String}
+    previous = pl.DataFrame(
+        [variant(rsid[0]) + (rsid,) for rsid in ["c", "a1", "a2", "e"]],
+        schema=schema,
+        orient="row",
+    )
+    order = InputOrder(previous, 2, schema)
+    read = []
+
+    def variants():
+        for id in "abcdefg":
+            read.append(id)
+            yield variant(id)
+
+    # ids are filtered lazily
+    new_ids = order.new_ids(variants())
+    assert list(islice(new_ids, 2)) == ["b", "d"]
+    assert read == list("abcd")
+
+    # new ids can have several hits, positions come from the input
+    df, num_inputs = order.merge(
+        pl.DataFrame({"hgvs": ["b", "b", "d"], "rsid": ["b1", "b2", "d"]})
+    )
+    assert df.columns == list(schema)
+    assert df["rsid"].to_list() == ["a1", "a2", "b1", "b2", "c", "d"]
+    assert df["pos"].to_list() == [ord(id) for id in "aabbcd"]
+    assert num_inputs == 4
+    assert list(new_ids) == ["f", "g"]
+    df, num_inputs = order.merge(pl.DataFrame({"hgvs": ["f", "g"], "rsid": ["f", "g"]}))
+    assert df["rsid"].to_list() == ["e", "f", "g"]
+    assert num_inputs == 3
+    df, num_inputs = order.flush()
+    assert df is None and num_inputs == 0
+    assert (order.num_reused, order.num_new) == (3, 4)
+
+    order = InputOrder(previous, 2, schema)
+    assert list(order.new_ids(map(variant, "aec"))) == []
+    df, num_inputs = order.flush()
+    assert df["rsid"].to_list() == ["a1", "a2", "e", "c"]
+    assert num_inputs == 3
+
+
+@pytest.mark.parametrize("suffix", [".tsv", ".parquet"])
+def test_main_resumes_from_checkpoint(tmp_path, suffix):
+    output_path = tmp_path / f"example{suffix}"
+    hgvs = AsyncMyVariantInfo().get_hgvs_from_vcf(EXAMPLE_VCF)
+
+    def run(client, chunk_size=10):
+        asyncio.run(
+            annotate.main(
+                EXAMPLE_VCF,
+                output_path,
+                logging.getLogger("annotate"),
+                client=client,
+                chunk_size=chunk_size,
+            )
+        )
+
+    def crash_after(num_ids):
+        server = FakeMyVariant()
+
+        def handler(request):
+            if len(server.queried) >= num_ids:
+                return httpx.Response(400)
+            return server(request)
+
+        return AsyncMyVariantInfo(
+            transport=httpx.MockTransport(handler), max_in_flight=1
+        )
+
+    with pytest.raises(httpx.HTTPStatusError):
+        run(crash_after(30))
+    assert not output_path.exists()
+    manifest_path = checkpoint.checkpoint_dir(output_path) / "manifest.json"
+    assert json.loads(manifest_path.read_text())["chunks"] == 3
+
+    # finished chunks are not queried again
+    server = FakeMyVariant()
+    run(server.client())
+    assert server.queried == hgvs[30:]
+    df = scan_annotations(output_path, annotate.OUTPUT_SCHEMA).collect()
+    assert df["hgvs"].to_list() == hgvs
+    assert df["rsid"].to_list() == [f"rs{id.split('.')[1][:-3]}" for id in hgvs]
+    assert not (tmp_path / ".checkpoints").exists()
+
+    # chunks of another size can't be reused
+    with pytest.raises(httpx.HTTPStatusError):
+        run(crash_after(30))
+    server = FakeMyVariant()
+    run(server.client(), chunk_size=20)
+    assert server.queried == hgvs
+
+
+def test_find_previous(tmp_path):
+    output_path = tmp_path / "sample.tsv"
+    output_path.write_text("hgvs\n")
+    manifest = incremental.make_manifest(annotate.FIELDS, "http://test", "1")
+    assert incremental.find_previous(output_path, manifest) is None
+
+    incremental.save_snapshot(output_path, manifest)
+    snapshot = incremental.snapshot_path(output_path)
+    assert incremental.find_previous(output_path, manifest) == snapshot
+    # the release is unknown when offline
+    offline = incremental.make_manifest(annotate.FIELDS, "http://test", None)
+    assert incremental.find_previous(output_path, offline) == snapshot
+    other_fields = incremental.make_manifest(["dbsnp.rsid"], "http://test", "1")
+    assert incremental.find_previous(output_path, other_fields) is None
+
+
+def test_cohort_annotates_each_variant_once(tmp_path, monkeypatch):
+    # variants are written in several batches
+    monkeypatch.setattr(cohort, "BATCH_SIZE", 7)
+    hgvs = AsyncMyVariantInfo().get_hgvs_from_vcf(EXAMPLE_VCF)
+    samples = {"first": lambda i: i < 50, "second": lambda i: i >= 30}
+    for name, keep in samples.items():
+        write_vcf_subset(tmp_path / f"{name}.vcf", keep)
+        cohort.write_variants(tmp_path / f"{name}.vcf", tmp_path / f"{name}.parquet")
+    cohort.union_variants(
+        [tmp_path / f"{name}.parquet" for name in samples], tmp_path / "cohort.parquet"
+    )
+
+    server = FakeMyVariant()
+    asyncio.run(
+        annotate.main(
+            tmp_path / "cohort.parquet",
+            tmp_path / "annotations.parquet",
+            logging.getLogger("annotate"),
+            client=server.client(),
+            chunk_size=10,
+        )
+    )
+    assert server.queried == hgvs
+
+    for name in samples:
+        cohort.join_sample(
+            tmp_path / f"{name}.parquet",
+            tmp_path / "annotations.parquet",
+            tmp_path / f"{name}.tsv",
+        )
+        asyncio.run(
+            annotate.main(
+                tmp_path / f"{name}.vcf",
+                tmp_path / f"{name}.expected.tsv",
+                logging.getLogger("annotate"),
+                client=FakeMyVariant().client(),
+            )
+        )
+        df = scan_annotations(tmp_path / f"{name}.tsv", annotate.OUTPUT_SCHEMA)
+        expected = scan_annotations(
+            tmp_path / f"{name}.expected.tsv", annotate.OUTPUT_SCHEMA
+        )
+        assert df.collect().equals(expected.collect())
+
+
+def write_dumps(tmp_path, hgvs_records):
+    """
+    Writes small dbSNP, gnomAD exome and CADD dumps covering the first variants of the
+    example VCF.
+    """
+    header = "##fileformat=VCFv4.2\n" + "".join(
+        f'##INFO=<ID={key},Number={number},Type={type},Description="{key}">\n'
+        for key, number, type in [
+            ("AF", "A", "Float"),
+            ("AF_male", "A", "Float"),
+            ("AF_female", "A", "Float"),
+            ("DP", "1", "Integer"),
+        ]
+    )
+    header += "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+    dbsnp = header + "".join(
+        f"{chrom}\t{pos}\trs{pos}\t{ref}\t{alt}\t.\t.\t.\n"
+        for chrom, pos, ref, alt in hgvs_records[:20]
+    )
+    gnomad = header + "".join(
+        f"{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\t.\tAF=0.{i + 1};AF_male=0.0{i + 1};AF_female=0.00{i + 1};DP={i}\n"
+        for i, (chrom, pos, ref, alt) in enumerate(hgvs_records[:8])
+    )
+    cadd = "## CADD\n#Chrom\tPos\tRef\tAlt\tGeneID\n" + "".join(
+        f"{chrom}\t{pos}\t{ref}\t{alt}\t{gene}\n"
+        for chrom, pos, ref, alt in hgvs_records[:4]
+        for gene in [f"ENSG{pos}", "NA", f"ENSG{pos}b"]
+    )
+    (tmp_path / "dbsnp.vcf").write_text(dbsnp)
+    (tmp_path / "gnomad.vcf").write_text(gnomad)
+    (tmp_path / "cadd.tsv").write_text(cadd)
+    return [
+        ("dbsnp", tmp_path / "dbsnp.vcf"),
+        ("gnomad_exome", tmp_path / "gnomad.vcf"),
+        ("cadd", tmp_path / "cadd.tsv"),
+    ]
+
+
+def test_local_annotations(tmp_path, monkeypatch):
+    records = [
+        (record.CHROM, record.POS, record.REF, record.ALT[0])
+        for record in VCF(str(EXAMPLE_VCF))
+    ]
+    hgvs = vcf_reader.format_hgvs_batch(records)
+    # dumps are staged in batches, the genes of a variant span two batches
+    monkeypatch.setattr(local_annotations, "BATCH_SIZE", 5)
+    local_annotations.build_store(tmp_path / "store", write_dumps(tmp_path, records))
+    assert not (tmp_path / "store" / ".staging").exists()
+    backend = local_annotations.LocalAnnotations(tmp_path / "store")
+
+    assert backend.fields(["gnomad_exome.af"]) == [
+        "gnomad_exome.af.af",
+        "gnomad_exome.af.af_female",
+        "gnomad_exome.af.af_male",
+    ]
+    hits = backend.query([hgvs[1], "chrZ:g.1A>T", hgvs[30]], fields=annotate.FIELDS)
+    assert hits[0] == {
+        "query": hgvs[1],
+        "_id": hgvs[1],
+        "dbsnp": {"rsid": f"rs{records[1][1]}"},
+        "gnomad_exome": {
+            "af": {"af": 0.2, "af_male": 0.02, "af_female": 0.002},
+            "dp": 1,
+        },
+        "cadd": {
+            "gene": [
+                {"gene_id": f"ENSG{records[1][1]}"},
+                {"gene_id": f"ENSG{records[1][1]}b"},
+            ]
+        },
+    }
+    assert hits[1] == {"query": "chrZ:g.1A>T", "notfound": True}
+    assert hits[2] == {"query": hgvs[30], "notfound": True}
+
+    client = AsyncMyVariantInfo(backend=backend)
+    output_path = tmp_path / "example.parquet"
+    asyncio.run(
+        annotate.main(
+            EXAMPLE_VCF,
+            output_path,
+            logging.getLogger("annotate"),
+            client=client,
+            chunk_size=10,
+        )
+    )
+    df = pl.read_parquet(output_path)
+    assert df["hgvs"].to_list() == hgvs
+    assert df["rsid"].null_count() == len(hgvs) - 20
+    assert df["freq"].head(3).to_list() == [0.1, 0.2, 0.3]
+    assert df["dp"].head(3).to_list() == [None, 1, 2]
+    assert df["genes"][0].to_list() == [f"ENSG{records[0][1]}", f"ENSG{records[0][1]}b"]
+    assert asyncio.run(client.source_version()) == backend.version()
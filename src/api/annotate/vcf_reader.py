@@ -0,0 +1,144 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import batched
+import multiprocessing
+from pathlib import Path
+import warnings
+import polars as pl
+from cyvcf2 import VCF
+from myvariant import MyVariantInfo
+
+# records formatted at a time when reading a VCF serially
+FORMAT_BATCH_SIZE = 10_000
+INDEX_SUFFIXES = [".tbi", ".csi"]
+# columns of the rows yielded by `iter_variant_rows`
+VARIANT_SCHEMA = {
+    "hgvs": pl.String,
+    "chrom": pl.String,
+    "pos": pl.Int64,
+    "ref": pl.String,
+    "alt": pl.String,
+}
+
+_myvariant = MyVariantInfo()
+
+
+def format_hgvs_batch(variants: list[tuple]) -> list[str]:
+    """
+    Formats `(chrom, pos, ref, alt)` tuples as HGVS ids. SNPs, the vast majority, are
+    formatted inline, other variants go through `MyVariantInfo.format_hgvs`.
+    """
+    hgvs = []
+    for chrom, pos, ref, alt in variants:
+        if len(ref) == len(alt) == 1:
+            if chrom.lower().startswith("chr"):
+                chrom = chrom[3:]
+            hgvs.append(f"chr{chrom}:g.{pos}{ref}>{alt}")
+        else:
+            hgvs.append(_myvariant.format_hgvs(chrom, pos, ref, alt))
+    return hgvs
+
+
+def format_variant_rows(variants: list[tuple]) -> list[tuple]:
+    """
+    Prepends the HGVS id to `(chrom, pos, ref, alt)` tuples. Chromosomes are named
+    without their "chr" prefix, like in HGVS ids.
+    """
+    return [
+        (hgvs, chrom[3:] if chrom.lower().startswith("chr") else chrom, pos, ref, alt)
+        for hgvs, (chrom, pos, ref, alt) in zip(format_hgvs_batch(variants), variants)
+    ]
+
+
+def iter_variants(records, start: int | None = None, end: int | None = None):
+    """
+    Yields a `(chrom, pos, ref, alt)` tuple for every ALT allele of the records. When
+    given, only records with `start <= POS <= end` are kept: a region query also returns
+    the records overlapping its boundaries, which belong to the neighbouring region.
+    """
+    for record in records:
+        if start is not None and not start <= record.POS <= end:
+            continue
+        for alt in record.ALT:
+            yield record.CHROM, record.POS, record.REF, alt
+
+
+def has_index(path: Path | str) -> bool:
+    return any(Path(f"{path}{suffix}").exists() for suffix in INDEX_SUFFIXES)
+
+
+def split_regions(path: Path | str, region_size: int | None = None) -> list[tuple]:
+    """
+    Splits the contigs of the VCF header into `(chrom, start, end)` regions of at most
+    `region_size` bases, in header order. Whole contigs are used, as `(chrom, None,
+    None)`, when no size is given or the header has no contig lengths.
+    """
+    vcf = VCF(str(path))
+    try:
+        lengths = vcf.seqlens if region_size else None
+    except AttributeError:
+        lengths = None
+    if lengths is None:
+        return [(chrom, None, None) for chrom in vcf.seqnames]
+    return [
+        (chrom, start, min(start + region_size - 1, length))
+        for chrom, length in zip(vcf.seqnames, lengths)
+        for start in range(1, length + 1, region_size)
+    ]
+
+
+def read_region(path: Path | str, region: tuple) -> list[tuple]:
+    """
+    Returns the rows of the variants in a region of an indexed VCF, see
+    `iter_variant_rows`.
+    """
+    chrom, start, end = region
+    query = chrom if start is None else f"{chrom}:{start}-{end}"
+    with warnings.catch_warnings():
+        # contigs of the header without any record
+        warnings.filterwarnings("ignore", message="no intervals found")
+        variants = list(iter_variants(VCF(str(path))(query), start, end))
+    return format_variant_rows(variants)
+
+
+def iter_variant_rows(
+    path: Path | str, workers: int = 1, region_size: int | None = None
+):
+    """
+    Lazily yields an `(hgvs, chrom, pos, ref, alt)` row for every ALT allele of the
+    variants in the VCF, in file order. REF and ALT are the VCF's, so that they are
+    known for indels as well as SNVs.
+
+    With several `workers` and a tabix or CSI index, the VCF is split into regions that
+    are parsed in a process pool. Results are yielded in region order, and at most twice
+    as many regions as workers are held in memory. Workers are spawned rather than
+    forked: forking a process that has started polars' thread pool can deadlock.
+    """
+    if workers <= 1 or not has_index(path):
+        for variants in batched(iter_variants(VCF(str(path))), FORMAT_BATCH_SIZE):
+            yield from format_variant_rows(variants)
+        return
+
+    pending = deque()
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        try:
+            for region in split_regions(path, region_size):
+                pending.append(executor.submit(read_region, path, region))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def iter_hgvs(path: Path | str, workers: int = 1, region_size: int | None = None):
+    """
+    Lazily yields the HGVS ids of every ALT allele of the variants in the VCF, in file
+    order, see `iter_variant_rows`.
+    """
+    for row in iter_variant_rows(path, workers=workers, region_size=region_size):
+        yield row[0]
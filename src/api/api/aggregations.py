@@ -0,0 +1,91 @@
+import polars as pl
+from sample_stats import compute_histogram
+
+# what variants can be grouped by, and the column holding it
+GROUP_COLUMNS = {"gene": "genes", "chrom": "chrom"}
+HISTOGRAM_COLUMNS = ["freq", "male_freq", "female_freq", "dp"]
+SPECTRUM_COLUMNS = ["freq", "male_freq", "female_freq"]
+# upper bounds of the allele frequency classes, from ultra-rare to common
+SPECTRUM_EDGES = [0.0001, 0.001, 0.01, 0.05, 0.5]
+
+
+def count_by(lf: pl.LazyFrame, by: str) -> dict:
+    """
+    Counts the variants per gene or chromosome, most frequent first. A variant in
+    several genes counts towards each of them, variants without any are not counted.
+    """
+    column = GROUP_COLUMNS[by]
+    lf = lf.select(pl.col(column).alias("key"))
+    if lf.collect_schema()["key"] == pl.List(pl.String):
+        lf = lf.explode("key")
+    groups = (
+        lf.drop_nulls("key")
+        .group_by("key")
+        .len("count")
+        .sort(["count", "key"], descending=[True, False])
+        .collect()
+    )
+    return {"by": by, "total": len(groups), "groups": groups.to_dicts()}
+
+
+def histogram(
+    lf: pl.LazyFrame,
+    column: str,
+    bins: int,
+    min_value: float | None = None,
+    max_value: float | None = None,
+) -> dict:
+    """
+    Equal-width histogram of a column between `min_value` and `max_value`, which default
+    to the range of the column. Values out of the range are counted apart.
+    """
+    summary = lf.select(
+        pl.col(column).min().alias("min"),
+        pl.col(column).max().alias("max"),
+        pl.col(column).null_count().alias("null_count"),
+        pl.len().alias("total"),
+    ).collect()
+    if min_value is None:
+        min_value = summary["min"].item()
+        if min_value is not None and max_value is not None:
+            min_value = min(min_value, max_value)
+    if max_value is None:
+        max_value = summary["max"].item()
+        if max_value is not None and min_value is not None:
+            max_value = max(max_value, min_value)
+    result = compute_histogram(lf, column, min_value, max_value, bins)
+    null_count = summary["null_count"].item()
+    return {
+        "column": column,
+        **result,
+        "null_count": null_count,
+        "out_of_range": summary["total"].item() - null_count - sum(result["counts"]),
+    }
+
+
+def frequency_spectrum(lf: pl.LazyFrame, column: str) -> dict:
+    """
+    Counts the variants in each allele frequency class, see `SPECTRUM_EDGES`. Classes
+    include their upper bound, the first one starts at 0 and the last one ends at 1.
+    """
+    lower = [0.0, *SPECTRUM_EDGES]
+    upper = [*SPECTRUM_EDGES, 1.0]
+    counts = (
+        lf.select(
+            pl.col(column)
+            .cut(SPECTRUM_EDGES, labels=[str(i) for i in range(len(lower))])
+            .alias("bucket")
+        )
+        .group_by("bucket")
+        .len("count")
+        .collect()
+    )
+    by_bucket = {bucket: count for bucket, count in counts.iter_rows()}
+    return {
+        "column": column,
+        "buckets": [
+            {"min": low, "max": high, "count": by_bucket.get(str(i), 0)}
+            for i, (low, high) in enumerate(zip(lower, upper))
+        ],
+        "null_count": by_bucket.get(None, 0),
+    }
@@ -0,0 +1,83 @@
+import io
+import json
+import time
+from fastapi import HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+import polars as pl
+from metrics import SERIALIZATION_SECONDS
+
+MEDIA_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+# rows serialized at a time when streaming NDJSON
+NDJSON_BATCH_SIZE = 10_000
+
+
+def response_format(
+    request: Request,
+    format: str | None = Query(
+        None,
+        description=f"Response format, one of: {list(MEDIA_TYPES)}. Defaults to the `Accept` header, then to json",
+    ),
+) -> str:
+    """
+    Negotiates the response format from the `format` parameter or the `Accept` header.
+    """
+    if format is not None:
+        if format not in MEDIA_TYPES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid format: {format}. Must be one of: {list(MEDIA_TYPES)}",
+            )
+        return format
+    accept = request.headers.get("accept", "")
+    for name, media_type in MEDIA_TYPES.items():
+        if media_type in accept:
+            return name
+    return "json"
+
+
+def encode_variants(result: dict, format: str) -> Response:
+    """
+    Encodes a result whose "variants" are a DataFrame, without building a dict per row.
+
+    JSON keeps the usual envelope, with the rows serialized by polars. The other formats
+    carry only the rows, the rest of the envelope is sent as headers, e.g. `X-Total`.
+    """
+    start = time.perf_counter()
+    response = _encode_variants(result, format)
+    # NDJSON is serialized while it is streamed, only its setup is timed
+    SERIALIZATION_SECONDS.observe(time.perf_counter() - start, format=format)
+    return response
+
+
+def _encode_variants(result: dict, format: str) -> Response:
+    df: pl.DataFrame = result["variants"]
+    envelope = {key: value for key, value in result.items() if key != "variants"}
+
+    if format == "json":
+        # the envelope is never empty, so the rows can be spliced before its closing brace
+        body = f'{json.dumps(envelope)[:-1]}, "variants": {df.write_json()}}}'
+        return Response(body, media_type=MEDIA_TYPES[format])
+
+    headers = {
+        f"X-{key.title()}": str(value)
+        for key, value in envelope.items()
+        if value is not None
+    }
+    if format == "ndjson":
+        return StreamingResponse(
+            (batch.write_ndjson() for batch in df.iter_slices(NDJSON_BATCH_SIZE)),
+            media_type=MEDIA_TYPES[format],
+            headers=headers,
+        )
+
+    buffer = io.BytesIO()
+    if format == "arrow":
+        df.write_ipc_stream(buffer)
+    else:
+        df.write_parquet(buffer)
+    return Response(buffer.getvalue(), media_type=MEDIA_TYPES[format], headers=headers)
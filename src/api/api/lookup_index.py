@@ -0,0 +1,97 @@
+from pathlib import Path
+import threading
+import polars as pl
+from sample_registry import SampleRegistry, scan_sorted
+
+# what can be looked up, and the column holding it
+LOOKUP_COLUMNS = {"hgvs": "hgvs", "rsid": "rsid", "gene": "genes"}
+
+
+def index_sample(df_path: Path) -> dict[str, pl.DataFrame]:
+    """
+    Returns, for each kind of key, the `(key, row)` pairs of a sample, with rows in the
+    order the sample is served in.
+    """
+    df = (
+        scan_sorted(df_path)
+        .select(list(LOOKUP_COLUMNS.values()))
+        .with_row_index("row")
+        .collect()
+    )
+    parts = {}
+    for kind, column in LOOKUP_COLUMNS.items():
+        part = df.select(pl.col(column).alias("key"), "row")
+        if part.schema["key"] == pl.List(pl.String):
+            part = part.explode("key")
+        parts[kind] = part.drop_nulls("key")
+    return parts
+
+
+class LookupIndex:
+    """
+    Inverted index from rsid, HGVS id and gene id to the samples and rows carrying them.
+
+    For each kind of key, the `(key, sample, row)` entries of all samples are kept in a
+    single table sorted by key, with samples stored as enum codes, so that a lookup is
+    a binary search. `update` only reads the samples that changed since the last call.
+    """
+
+    def __init__(self):
+        self.versions: dict[str, dict] = {}
+        self.parts: dict[str, dict[str, pl.DataFrame]] = {}
+        self.tables: dict[str, pl.DataFrame] = {}
+        self.lock = threading.Lock()
+        self._merge()
+
+    def update(self, registry: SampleRegistry) -> bool:
+        """
+        Indexes the new and updated samples of `registry` and drops deleted ones.
+        Returns whether the index changed.
+        """
+        with self.lock:
+            served = registry.sample_versions()
+            changed = False
+            for sample in [sample for sample in self.versions if sample not in served]:
+                del self.versions[sample]
+                del self.parts[sample]
+                changed = True
+            for sample, (df_path, version) in served.items():
+                if self.versions.get(sample) != version:
+                    self.parts[sample] = index_sample(df_path)
+                    self.versions[sample] = version
+                    changed = True
+            if changed:
+                self._merge()
+            return changed
+
+    def _merge(self):
+        samples = pl.Enum(sorted(self.parts))
+        tables = {}
+        for kind in LOOKUP_COLUMNS:
+            table = pl.DataFrame(
+                schema={"key": pl.String, "sample": samples, "row": pl.UInt32}
+            )
+            parts = [
+                parts[kind].with_columns(pl.lit(sample).cast(samples).alias("sample"))
+                for sample, parts in self.parts.items()
+            ]
+            if parts:
+                table = pl.concat(parts).select(table.columns)
+            tables[kind] = table.sort("key", "sample", "row")
+        self.tables = tables
+
+    def lookup(self, kind: str, key: str) -> pl.DataFrame:
+        """
+        Returns the `sample` and `row` of the variants matching the key, by sample.
+        """
+        table = self.tables[kind]
+        start = table["key"].search_sorted(key, side="left")
+        end = table["key"].search_sorted(key, side="right")
+        return table.slice(start, end - start).select("sample", "row")
+
+    def stats(self) -> dict:
+        return {
+            "samples": len(self.parts),
+            "entries": {kind: len(table) for kind, table in self.tables.items()},
+            "bytes": sum(table.estimated_size() for table in self.tables.values()),
+        }
@@ -0,0 +1,313 @@
+from contextvars import ContextVar
+import cProfile
+import functools
+import io
+import json
+import math
+import pstats
+import threading
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
+from starlette.routing import Match
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+# query parameter asking for the profile of a request rather than its response
+PROFILE_PARAM = "profile"
+# functions listed in a profile
+PROFILE_LINES = 40
+
+# route of the request being served, endpoints run in a thread pool that inherits it
+current_endpoint: ContextVar[str] = ContextVar("current_endpoint", default="")
+current_profiler: ContextVar[cProfile.Profile | None] = ContextVar(
+    "current_profiler", default=None
+)
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = {
+        name: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for name, value in labels.items()
+    }
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_metric(name: str, kind: str, help: str, samples: list[tuple]) -> str:
+    """
+    Formats a metric in the Prometheus text format, from `(suffix, labels, value)`
+    samples.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for suffix, labels, value in samples:
+        lines.append(f"{name}{suffix}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self) -> str:
+        with self.lock:
+            samples = [("", dict(key), value) for key, value in self.values.items()]
+        return format_metric(self.name, "counter", self.help, samples)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: list[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # per labels: the count of each bucket, the sum and the count of observations
+        self.values: dict[tuple, tuple[list[int], float, int]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> str:
+        with self.lock:
+            values = [
+                (dict(key), list(counts), *rest)
+                for key, (counts, *rest) in self.values.items()
+            ]
+        samples = []
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                samples.append(("_bucket", {**labels, "le": bound}, cumulative))
+            samples.append(("_bucket", {**labels, "le": "+Inf"}, count))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return format_metric(self.name, "histogram", self.help, samples)
+
+
+REQUEST_SECONDS = Histogram(
+    "api_request_duration_seconds", "Latency of the requests, by endpoint"
+)
+ROWS_SCANNED = Counter(
+    "api_rows_scanned_total",
+    "Rows matched or scanned by the queries, before pagination, by endpoint",
+)
+ROWS_RETURNED = Counter("api_rows_returned_total", "Rows returned, by endpoint")
+SERIALIZATION_SECONDS = Histogram(
+    "api_serialization_seconds", "Time spent encoding variants, by format"
+)
+
+
+def render_gauges(name: str, help: str, values: dict[str, float], label: str) -> str:
+    samples = [("", {label: key}, value) for key, value in values.items()]
+    return format_metric(name, "gauge", help, samples)
+
+
+# metrics of the last annotation run of each sample, see `run_metrics.RunMetrics`
+ANNOTATION_GAUGES = {
+    "seconds": "Duration of the run",
+    "variants": "Variants written",
+    "variants_per_second": "Variants written per second",
+    "chunks": "Chunks queried",
+    "requests": "Requests sent to MyVariant.info, including retries",
+    "retries": "Requests retried",
+    "errors": "Requests that failed after all retries",
+    "cache_hits": "Variants found in the annotation cache",
+    "cache_misses": "Variants missing from the annotation cache",
+    "finished": "Unix time the run finished at",
+}
+
+
+def is_complete_run(run) -> bool:
+    """
+    Whether the metrics of a run have every value rendered on `/metrics`.
+    """
+    return (
+        isinstance(run, dict)
+        and {"sample", "chunk_seconds", *ANNOTATION_GAUGES} <= run.keys()
+        and isinstance(run["chunk_seconds"], dict)
+        and {"sum", "buckets"} <= run["chunk_seconds"].keys()
+    )
+
+
+def render_annotation_runs(root: Path) -> list[str]:
+    """
+    Renders the metrics written by the last annotation run of each sample under `root`.
+    Runs in hidden directories, such as the cohort's, are not of a served sample.
+    """
+    runs = []
+    for path in sorted(root.glob("**/.metrics/*.json")):
+        if any(part.startswith(".") for part in path.relative_to(root).parts[:-2]):
+            continue
+        try:
+            run = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+        if is_complete_run(run):
+            runs.append(run)
+    if not runs:
+        return []
+    rendered = [
+        render_gauges(
+            f"annotate_last_run_{key}",
+            f"{help}, in the last annotation run",
+            {run["sample"]: run[key] for run in runs},
+            "sample",
+        )
+        for key, help in ANNOTATION_GAUGES.items()
+    ]
+    samples = []
+    for run in runs:
+        labels = {"sample": run["sample"]}
+        cumulative = 0
+        for bound, count in run["chunk_seconds"]["buckets"].items():
+            cumulative += count
+            samples.append(("_bucket", {**labels, "le": bound}, cumulative))
+        samples.append(("_bucket", {**labels, "le": "+Inf"}, run["chunks"]))
+        samples.append(("_sum", labels, run["chunk_seconds"]["sum"]))
+        samples.append(("_count", labels, run["chunks"]))
+    rendered.append(
+        format_metric(
+            "annotate_last_run_chunk_seconds",
+            "histogram",
+            "Latency of the queries of each chunk, in the last annotation run",
+            samples,
+        )
+    )
+    return rendered
+
+
+def record_rows(scanned: int, returned: int):
+    """
+    Counts the rows considered and returned by the current request.
+    """
+    endpoint = current_endpoint.get()
+    ROWS_SCANNED.inc(scanned, endpoint=endpoint)
+    ROWS_RETURNED.inc(returned, endpoint=endpoint)
+
+
+def route_path(app: FastAPI, request: Request) -> str:
+    """
+    Path template of the route matching a request, e.g. `/variants/{sample}`, so that
+    latencies are not broken down by sample or value.
+    """
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+class ProfiledRoute(APIRoute):
+    """
+    Route whose endpoint is run under the profiler of the request, if any, see
+    `MetricsMiddleware`. Endpoints run in worker threads, which a profiler started by
+    the middleware would not see.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        call = self.dependant.call
+
+        @functools.wraps(call)
+        def profiled(*args, **kwargs):
+            profiler = current_profiler.get()
+            if profiler is None:
+                return call(*args, **kwargs)
+            return profiler.runcall(call, *args, **kwargs)
+
+        self.dependant.call = profiled
+
+
+class MetricsMiddleware:
+    """
+    Records the latency of each request by endpoint, method and status.
+
+    With `profiling` enabled, a request with `?profile=true` is answered with the
+    cProfile statistics of its endpoint, as text, instead of its response. Profilers
+    are process-wide since Python 3.12, so one request is profiled at a time and others
+    are answered with 429; work done meanwhile by other requests shows up in its profile.
+    """
+
+    def __init__(self, app: FastAPI, profiling: bool = False):
+        self.app = app
+        self.profiling = profiling
+        self.profile_lock = threading.Lock()
+
+    async def __call__(
+        self, request: Request, call_next: Callable[[Request], Awaitable[Response]]
+    ) -> Response:
+        endpoint = route_path(self.app, request)
+        current_endpoint.set(endpoint)
+        if self.profiling and request.query_params.get(PROFILE_PARAM) in ("1", "true"):
+            if not self.profile_lock.acquire(blocking=False):
+                return PlainTextResponse(
+                    "Another request is being profiled, try again later",
+                    status_code=429,
+                )
+            try:
+                return await self._profile(request, call_next, endpoint)
+            finally:
+                self.profile_lock.release()
+
+        start = time.perf_counter()
+        response = await call_next(request)
+        seconds = time.perf_counter() - start
+        REQUEST_SECONDS.observe(
+            seconds,
+            endpoint=endpoint,
+            method=request.method,
+            status=response.status_code,
+        )
+        return response
+
+    async def _profile(
+        self,
+        request: Request,
+        call_next: Callable[[Request], Awaitable[Response]],
+        endpoint: str,
+    ) -> Response:
+        profiler = cProfile.Profile()
+        current_profiler.set(profiler)
+        start = time.perf_counter()
+        response = await call_next(request)
+        # the response is discarded, its body is consumed so that it is fully computed
+        async for _ in response.body_iterator:
+            pass
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            endpoint=endpoint,
+            method=request.method,
+            status=response.status_code,
+        )
+        out = io.StringIO()
+        out.write(f"{request.method} {request.url} answered {response.status_code} ")
+        out.write(f"in {time.perf_counter() - start:.4f} seconds\n\n")
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+        return PlainTextResponse(out.getvalue())
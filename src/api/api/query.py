@@ -0,0 +1,167 @@
+from typing import Annotated, Literal, Union
+import polars as pl
+from pydantic import BaseModel, Field
+
+NumericColumn = Literal["pos", "freq", "male_freq", "female_freq", "dp"]
+ScalarColumn = Literal[
+    "hgvs",
+    "chrom",
+    "pos",
+    "ref",
+    "alt",
+    "rsid",
+    "freq",
+    "male_freq",
+    "female_freq",
+    "dp",
+]
+Column = Literal[
+    "hgvs",
+    "chrom",
+    "pos",
+    "ref",
+    "alt",
+    "rsid",
+    "genes",
+    "freq",
+    "male_freq",
+    "female_freq",
+    "dp",
+]
+
+
+class RangePredicate(BaseModel):
+    """`min <= column <= max`, either bound may be left out."""
+
+    op: Literal["range"]
+    column: NumericColumn
+    min: float | None = None
+    max: float | None = None
+
+    def to_expr(self) -> pl.Expr:
+        expr = pl.lit(True)
+        if self.min is not None:
+            expr = expr & (pl.col(self.column) >= self.min)
+        if self.max is not None:
+            expr = expr & (pl.col(self.column) <= self.max)
+        return expr & pl.col(self.column).is_not_null()
+
+
+class EqualsPredicate(BaseModel):
+    """`column == value`."""
+
+    op: Literal["eq"]
+    column: ScalarColumn
+    value: float | str
+
+    def to_expr(self) -> pl.Expr:
+        return pl.col(self.column) == self.value
+
+
+class NullPredicate(BaseModel):
+    """The column is (or is not) missing."""
+
+    op: Literal["is_null", "is_not_null"]
+    column: Column
+
+    def to_expr(self) -> pl.Expr:
+        if self.op == "is_null":
+            return pl.col(self.column).is_null()
+        return pl.col(self.column).is_not_null()
+
+
+class InPredicate(BaseModel):
+    """The rsid or HGVS id is one of `values`."""
+
+    op: Literal["in"]
+    column: Literal["hgvs", "rsid"]
+    values: list[str]
+
+    def to_expr(self) -> pl.Expr:
+        return pl.col(self.column).is_in(self.values)
+
+
+class GenesPredicate(BaseModel):
+    """The variant is in any of `genes`."""
+
+    op: Literal["genes"]
+    genes: list[str]
+
+    def to_expr(self) -> pl.Expr:
+        return (
+            pl.col("genes")
+            .list.eval(pl.element().is_in(self.genes))
+            .list.any()
+            .fill_null(False)
+        )
+
+
+class AndPredicate(BaseModel):
+    """All of `predicates` match."""
+
+    op: Literal["and"]
+    predicates: list["Predicate"]
+
+    def to_expr(self) -> pl.Expr:
+        return pl.all_horizontal(
+            pl.lit(True), *[predicate.to_expr() for predicate in self.predicates]
+        )
+
+
+class OrPredicate(BaseModel):
+    """Any of `predicates` matches."""
+
+    op: Literal["or"]
+    predicates: list["Predicate"]
+
+    def to_expr(self) -> pl.Expr:
+        return pl.any_horizontal(
+            pl.lit(False), *[predicate.to_expr() for predicate in self.predicates]
+        )
+
+
+Predicate = Annotated[
+    Union[
+        RangePredicate,
+        EqualsPredicate,
+        NullPredicate,
+        InPredicate,
+        GenesPredicate,
+        AndPredicate,
+        OrPredicate,
+    ],
+    Field(discriminator="op"),
+]
+AndPredicate.model_rebuild()
+OrPredicate.model_rebuild()
+
+
+class VariantQuery(BaseModel):
+    where: Predicate | None = Field(
+        None, description="Predicate tree, all variants match when left out"
+    )
+    columns: list[Column] | None = Field(
+        None, description="Columns to return, all by default"
+    )
+    offset: int = Field(0, ge=0, description="Number of variants to skip")
+    limit: int | None = Field(
+        None, ge=1, description="Maximum number of variants to return"
+    )
+
+
+def run_query(df: pl.DataFrame, query: VariantQuery) -> tuple[int, pl.DataFrame]:
+    """
+    Compiles the query into a single lazy plan over `df`, so polars can push the
+    predicate and projection down and run it multithreaded. Returns the number of
+    matching variants and the requested page.
+    """
+    lf = df.lazy()
+    if query.where is not None:
+        lf = lf.filter(query.where.to_expr())
+    page = lf
+    if query.columns:
+        page = page.select(query.columns)
+    page = page.slice(query.offset, query.limit)
+    # both are collected together, sharing the filtered subplan
+    total, page = pl.collect_all([lf.select(pl.len()), page])
+    return total.item(), page
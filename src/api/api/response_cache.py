@@ -0,0 +1,219 @@
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+import asyncio
+import gzip
+import hashlib
+from typing import Awaitable, Callable
+from fastapi import Request, Response
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+# already compressed, or streamed rather than buffered
+UNCOMPRESSED_TYPES = ["application/vnd.apache.parquet"]
+UNCACHED_TYPES = ["application/x-ndjson"]
+# headers recomputed for each response
+DROPPED_HEADERS = ["content-length", "content-encoding"]
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+
+def accepted_encoding(accept_encoding: str) -> str | None:
+    """
+    Picks the encoding of a response from the `Accept-Encoding` header, preferring
+    zstd when the zstandard package is installed.
+    """
+    accepted = {
+        coding.split(";")[0].strip()
+        for coding in accept_encoding.split(",")
+        if not coding.replace(" ", "").endswith(";q=0")
+    }
+    if zstandard is not None and "zstd" in accepted:
+        return "zstd"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class CachedResponse:
+    def __init__(self, body: bytes, status_code: int, headers: dict, media_type: str):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers
+        self.media_type = media_type
+        self.encoded: dict[str, bytes] = {}
+
+    def size(self) -> int:
+        return len(self.body) + sum(len(body) for body in self.encoded.values())
+
+
+class ResponseCache:
+    """
+    Caches the bodies of successful GET responses, with least recently used eviction
+    once their total size goes over `max_bytes`. Compressed bodies are kept alongside
+    and count towards the budget.
+
+    Responses are keyed by path, query string, `Accept` header and the version of the
+    data they were computed from, see `ResponseCacheMiddleware`, so they never need to
+    be invalidated: entries of outdated versions are evicted in time.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def get(self, key: tuple) -> CachedResponse | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, entry: CachedResponse):
+        if entry.size() > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key).size()
+        self.entries[key] = entry
+        self.size += entry.size()
+        self._evict()
+
+    def add_encoding(
+        self, key: tuple, entry: CachedResponse, encoding: str, body: bytes
+    ):
+        entry.encoded[encoding] = body
+        if self.entries.get(key) is entry:
+            self.size += len(body)
+            self._evict()
+
+    def _evict(self):
+        while self.entries and self.size > self.max_bytes:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size()
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "evictions": self.evictions,
+        }
+
+
+class ResponseCacheMiddleware:
+    """
+    Serves GET requests from a `ResponseCache`, with ETag and Last-Modified validators.
+
+    `version(request)` returns an opaque token identifying the data a response depends
+    on, and when that data was last modified. The ETag is derived from the request and
+    the token only, so conditional requests for a cached response are answered with 304
+    without running the endpoint. Others run it, and only a successful response is
+    answered with 304. Responses are compressed with zstd or gzip depending on `Accept-Encoding`.
+    Paths starting with one of `uncached`, and requests with one of `uncached_params`,
+    are passed through.
+    """
+
+    def __init__(
+        self,
+        cache: ResponseCache,
+        version: Callable[[Request], tuple[str, float]],
+        uncached: list[str],
+        uncached_params: list[str] | None = None,
+    ):
+        self.cache = cache
+        self.version = version
+        self.uncached = uncached
+        self.uncached_params = uncached_params or []
+
+    async def __call__(
+        self, request: Request, call_next: Callable[[Request], Awaitable[Response]]
+    ) -> Response:
+        path = request.url.path
+        if (
+            request.method != "GET"
+            or any(path.startswith(prefix) for prefix in self.uncached)
+            or any(param in request.query_params for param in self.uncached_params)
+        ):
+            return await call_next(request)
+
+        token, modified = self.version(request)
+        key = (path, request.url.query, request.headers.get("accept", ""), token)
+        etag = f'W/"{hashlib.sha1(repr(key).encode()).hexdigest()[:20]}"'
+        validators = {
+            "ETag": etag,
+            "Last-Modified": formatdate(modified, usegmt=True),
+            # clients may keep responses, but must revalidate them
+            "Cache-Control": "no-cache",
+            "Vary": "Accept, Accept-Encoding",
+        }
+        entry = self.cache.get(key)
+        if entry is None:
+            response = await call_next(request)
+            media_type = response.headers.get("content-type", "").split(";")[0]
+            if response.status_code != 200 or media_type in UNCACHED_TYPES:
+                return response
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            headers = {
+                name: value
+                for name, value in response.headers.items()
+                if name not in DROPPED_HEADERS
+            }
+            entry = CachedResponse(body, response.status_code, headers, media_type)
+            self.cache.put(key, entry)
+
+        # only successful responses are validated: errors, e.g. for an unknown sample,
+        # are never turned into 304s
+        if self._not_modified(request, etag, modified):
+            self.cache.not_modified += 1
+            return Response(status_code=304, headers=validators)
+
+        headers = {**entry.headers, **validators}
+        body = entry.body
+        encoding = accepted_encoding(request.headers.get("accept-encoding", ""))
+        if (
+            encoding is not None
+            and len(body) >= MIN_COMPRESS_SIZE
+            and entry.media_type not in UNCOMPRESSED_TYPES
+        ):
+            if encoding not in entry.encoded:
+                # compressing a large page would block the event loop
+                encoded = await asyncio.to_thread(compress, body, encoding)
+                self.cache.add_encoding(key, entry, encoding, encoded)
+            body = entry.encoded[encoding]
+            headers["Content-Encoding"] = encoding
+        return Response(body, status_code=entry.status_code, headers=headers)
+
+    def _not_modified(self, request: Request, etag: str, modified: float) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            # weak comparison, a strong tag matches its weak form
+            return etag in tags or etag[2:] in tags
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            # Last-Modified has a resolution of one second
+            return int(modified) <= since
+        return False
@@ -0,0 +1,488 @@
+import argparse
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+from typing import Callable
+import polars as pl
+from sample_stats import load_stats, source_info
+from sorted_index import PositionIndex, SortedIndex
+
+# when a sample exists in several formats, the later ones take precedence
+SAMPLE_FORMATS = [".tsv", ".parquet", ".feather", ".ipc", ".arrow"]
+# avoids CSV type inference guessing the wrong type from the first rows
+TSV_SCHEMA_OVERRIDES = {
+    "hgvs": pl.String,
+    "chrom": pl.String,
+    "pos": pl.Int64,
+    "ref": pl.String,
+    "alt": pl.String,
+    "rsid": pl.String,
+    "genes": pl.String,
+    "freq": pl.Float64,
+    "male_freq": pl.Float64,
+    "female_freq": pl.Float64,
+    "dp": pl.Int64,
+}
+# hidden directory of the data root holding the samples converted for memory-mapping
+MMAP_DIR = ".mmap"
+# aggregates kept across all samples, their keys include parameters of the requests
+MAX_AGGREGATES = 1024
+
+
+def find_samples(root: Path) -> dict[str, Path]:
+    df_paths = {}
+    for suffix in SAMPLE_FORMATS:
+        for df_path in sorted(root.rglob(f"*{suffix}")):
+            # skips caches and files still being written by the pipeline
+            if any(part.startswith(".") for part in df_path.relative_to(root).parts):
+                continue
+            df_paths[df_path.stem] = df_path
+    return dict(sorted(df_paths.items(), key=lambda item: item[1]))
+
+
+def scan_sample(df_path: Path) -> pl.LazyFrame:
+    """
+    Scans an annotated sample, memory-mapping Arrow IPC files. Genes are returned as a
+    list column regardless of the format.
+    """
+    if df_path.suffix == ".parquet":
+        return pl.scan_parquet(df_path)
+    elif df_path.suffix == ".tsv":
+        return pl.scan_csv(
+            df_path, separator="\t", schema_overrides=TSV_SCHEMA_OVERRIDES
+        ).with_columns(pl.col("genes").str.split(","))
+    return pl.scan_ipc(df_path, memory_map=True)
+
+
+def scan_sorted(df_path: Path) -> pl.LazyFrame:
+    """
+    Scans a sample in the order it is served in. The sort is stable, so that row
+    positions are the same each time the sample is loaded, see `LookupIndex`.
+    """
+    return scan_sample(df_path).sort("freq", nulls_last=True, maintain_order=True)
+
+
+def read_sample(df_path: Path) -> pl.DataFrame:
+    return scan_sorted(df_path).collect()
+
+
+def mapped_path(mmap_dir: Path, sample: str, version: dict) -> Path:
+    """
+    Converted copy of a version of a sample. The version is part of the name, so that
+    workers serving different versions during an update never read each other's files.
+    """
+    digest = hashlib.sha1(json.dumps(version, sort_keys=True).encode()).hexdigest()
+    return mmap_dir / f"{sample}.{digest[:16]}.arrow"
+
+
+def convert_sample(df_path: Path, target: Path) -> Path:
+    """
+    Writes a sample, in the order it is served in, to an uncompressed Arrow IPC file
+    made of a single record batch, which `read_mapped` maps without copying. Files are
+    moved into place once complete, so concurrent conversions are harmless.
+    """
+    if target.exists():
+        return target
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+    try:
+        read_sample(df_path).rechunk().write_ipc(tmp_path, compression="uncompressed")
+        os.replace(tmp_path, target)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return target
+
+
+def read_mapped(path: Path) -> pl.DataFrame:
+    """
+    Memory-maps a file written by `convert_sample`. Its pages live in the OS page cache
+    and are shared by every process mapping it, instead of being copied in each one.
+    """
+    return pl.read_ipc(path, memory_map=True)
+
+
+def prune_mapped(mmap_dir: Path, keep: set[Path]):
+    """
+    Removes the converted files of versions no longer served. Processes mapping them
+    keep their mapping.
+    """
+    for path in mmap_dir.glob("*.arrow"):
+        if path not in keep:
+            path.unlink(missing_ok=True)
+
+
+def convert_samples(root: Path, mmap_dir: Path | None = None) -> list[Path]:
+    """
+    Converts every sample under `root` for memory-mapping, see `convert_sample`, and
+    removes the files of previous versions.
+    """
+    mmap_dir = mmap_dir or root / MMAP_DIR
+    converted = [
+        convert_sample(df_path, mapped_path(mmap_dir, sample, source_info(df_path)))
+        for sample, df_path in find_samples(root).items()
+    ]
+    if mmap_dir.exists():
+        prune_mapped(mmap_dir, set(converted))
+    return converted
+
+
+class SampleRegistry:
+    """
+    Discovers the annotated samples under `root` and loads each one on first access.
+
+    Loaded samples are kept in a least recently used cache: when their total
+    `estimated_size` goes over `max_bytes`, the least recently used samples are evicted.
+    The most recently loaded sample is always kept, even if it alone is over budget.
+
+    `refresh` picks up samples added, updated or removed since: a new version is only
+    swapped in once its stats are ready, until then the previous one is served.
+
+    With `mmap_dir`, samples are converted once to Arrow IPC files under it and
+    memory-mapped, so that several API processes share a single copy of each sample,
+    see `convert_sample`.
+    """
+
+    def __init__(
+        self,
+        root: Path | str,
+        max_bytes: int | None = None,
+        mmap_dir: Path | str | None = None,
+        max_aggregates: int = MAX_AGGREGATES,
+    ):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_aggregates = max_aggregates
+        self.mmap_dir = Path(mmap_dir) if mmap_dir is not None else None
+        self.paths = find_samples(self.root)
+        self.versions = {
+            sample: source_info(df_path) for sample, df_path in self.paths.items()
+        }
+        self.status: dict[str, dict] = {
+            sample: {"status": "ready"} for sample in self.paths
+        }
+        self.loaded: OrderedDict[str, pl.DataFrame] = OrderedDict()
+        self.sizes: dict[str, int] = {}
+        self.summaries: dict[str, dict] = {}
+        self.indexes: dict[tuple[str, str], SortedIndex] = {}
+        self.aggregates: OrderedDict[tuple, dict] = OrderedDict()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        # endpoints are run in a thread pool
+        self.lock = threading.RLock()
+        # one per sample, held while the sample is loaded
+        self.load_locks: dict[str, threading.Lock] = {}
+
+    def __contains__(self, sample: str) -> bool:
+        return sample in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def samples(self) -> list[str]:
+        return list(self.paths)
+
+    def get(self, sample: str) -> pl.DataFrame:
+        """
+        Returns the DataFrame of a sample, loading it if needed. Raises KeyError for
+        unknown samples.
+
+        Samples are loaded outside of the lock, so that other samples are served
+        meanwhile, and one at a time per sample, so that concurrent requests for a
+        sample being loaded wait for it instead of loading it again.
+        """
+        with self.lock:
+            df = self._cached(sample)
+            if df is not None:
+                return df
+            load_lock = self.load_locks.setdefault(sample, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                # loaded by a concurrent request
+                df = self._cached(sample)
+                if df is not None:
+                    return df
+                df_path = self.paths[sample]
+                version = self.versions[sample]
+            df = self._load(sample, df_path, version)
+            with self.lock:
+                self.loads += 1
+                # not kept if the sample changed meanwhile
+                if self.versions.get(sample) == version:
+                    self.loaded[sample] = df
+                    self.sizes[sample] = df.estimated_size()
+                    self._evict()
+            return df
+
+    def _cached(self, sample: str) -> pl.DataFrame | None:
+        if sample not in self.loaded:
+            return None
+        self.hits += 1
+        self.loaded.move_to_end(sample)
+        return self.loaded[sample]
+
+    def _load(self, sample: str, df_path: Path, version: dict) -> pl.DataFrame:
+        if self.mmap_dir is None:
+            return read_sample(df_path)
+        if source_info(df_path) != version:
+            # updated since it was scanned: converting it would store the new version
+            # under the name of the previous one, it is read until the next refresh
+            return read_sample(df_path)
+        return read_mapped(
+            convert_sample(df_path, mapped_path(self.mmap_dir, sample, version))
+        )
+
+    def index(self, sample: str, column: str) -> tuple[pl.DataFrame, SortedIndex]:
+        """
+        Returns the DataFrame of a sample and the sorted index of one of its columns,
+        building it on first use. They are returned together, so that the row positions
+        of the index always refer to the DataFrame it was built on, even if the sample
+        is updated or evicted meanwhile. Indexes count towards the memory budget and are
+        evicted with their sample.
+        """
+        df = self.get(sample)
+        with self.lock:
+            if self.loaded.get(sample) is not df:
+                # updated or evicted since, the index is not kept
+                return df, SortedIndex(df[column])
+            index = self.indexes.get((sample, column))
+            if index is None:
+                index = SortedIndex(df[column])
+                self.indexes[(sample, column)] = index
+                self.sizes[sample] += index.estimated_size()
+                self._evict()
+            return df, index
+
+    def region_index(self, sample: str) -> tuple[pl.DataFrame, PositionIndex]:
+        """
+        Returns the DataFrame of a sample and its position index, see `index`.
+        """
+        df = self.get(sample)
+        with self.lock:
+            if self.loaded.get(sample) is not df:
+                return df, PositionIndex(df["chrom"], df["pos"])
+            index = self.indexes.get((sample, "region"))
+            if index is None:
+                index = PositionIndex(df["chrom"], df["pos"])
+                self.indexes[(sample, "region")] = index
+                self.sizes[sample] += index.estimated_size()
+                self._evict()
+            return df, index
+
+    def scan(self, sample: str) -> pl.LazyFrame:
+        """
+        Returns a LazyFrame over a sample without loading it into the cache.
+        """
+        with self.lock:
+            if sample in self.loaded:
+                return self.loaded[sample].lazy()
+        return scan_sample(self.paths[sample])
+
+    def summary(self, sample: str) -> dict:
+        """
+        Returns the precomputed stats of a sample, see `sample_stats.load_stats`.
+        They are read from the sidecar file once and kept in memory. Without an up to
+        date sidecar they are computed by scanning the sample, outside of the lock.
+        """
+        with self.lock:
+            if sample in self.summaries:
+                return self.summaries[sample]
+            df_path = self.paths[sample]
+            version = self.versions[sample]
+        summary = load_stats(df_path, lambda: self.scan(sample))
+        with self.lock:
+            # not kept if the sample changed meanwhile
+            if self.versions.get(sample) == version:
+                self.summaries[sample] = summary
+        return summary
+
+    def aggregate(
+        self, sample: str, key: tuple, compute: Callable[[pl.LazyFrame], dict]
+    ) -> dict:
+        """
+        Returns `compute` run on `scan(sample)`, cached under `key` until the sample is
+        updated or removed. Aggregates are small, they are kept when the sample is
+        evicted, but keys may carry arbitrary request parameters, so only the
+        `max_aggregates` most recently used are kept. `compute` runs outside of the lock.
+        """
+        with self.lock:
+            if (sample, *key) in self.aggregates:
+                self.aggregates.move_to_end((sample, *key))
+                return self.aggregates[(sample, *key)]
+            version = self.versions[sample]
+            lf = self.scan(sample)
+        result = compute(lf)
+        with self.lock:
+            # not cached if the sample changed meanwhile
+            if self.versions.get(sample) == version:
+                self.aggregates[(sample, *key)] = result
+                while len(self.aggregates) > self.max_aggregates:
+                    self.aggregates.popitem(last=False)
+        return result
+
+    def num_rows(self, sample: str) -> int:
+        """
+        Returns the number of variants in a sample without loading it.
+        """
+        return self.summary(sample)["num_SNPs"]
+
+    def refresh(self) -> dict[str, list[str]]:
+        """
+        Rescans `root`, swapping in new and updated samples and dropping deleted ones.
+        Unchanged samples are not read again. The stats of new versions are computed
+        outside of the lock, so requests keep being served meanwhile.
+        """
+        found = find_samples(self.root)
+        changed = {}
+        for sample, df_path in found.items():
+            try:
+                version = source_info(df_path)
+            except OSError:
+                # removed since the scan
+                continue
+            with self.lock:
+                if (
+                    self.paths.get(sample) != df_path
+                    or self.versions.get(sample) != version
+                ) and self.status.get(sample, {}).get("version") != version:
+                    changed[sample] = (df_path, version)
+                    self.status[sample] = {
+                        "status": "processing",
+                        "path": df_path,
+                        "version": version,
+                    }
+
+        changes = {"added": [], "updated": [], "removed": []}
+        # converted files of the versions dropped by this registry
+        dropped = []
+        for sample, (df_path, version) in changed.items():
+            try:
+                summary = load_stats(df_path, lambda: scan_sample(df_path))
+            except Exception as e:
+                with self.lock:
+                    self.status[sample] = {
+                        "status": "error",
+                        "path": df_path,
+                        "version": version,
+                        "error": str(e),
+                    }
+                continue
+            with self.lock:
+                changes["updated" if sample in self.paths else "added"].append(sample)
+                dropped += self._mapped_paths(sample)
+                self._drop(sample)
+                self.paths[sample] = df_path
+                self.versions[sample] = version
+                self.summaries[sample] = summary
+                self.status[sample] = {"status": "ready"}
+
+        with self.lock:
+            for sample in [sample for sample in self.paths if sample not in found]:
+                dropped += self._mapped_paths(sample)
+                self._drop(sample)
+                del self.paths[sample]
+                del self.versions[sample]
+                self.load_locks.pop(sample, None)
+                changes["removed"].append(sample)
+            for sample in [sample for sample in self.status if sample not in found]:
+                del self.status[sample]
+            self.paths = dict(sorted(self.paths.items(), key=lambda item: item[1]))
+        # only files of versions dropped here are removed, the other workers serving
+        # them keep their mapping, and the files of new versions are left alone
+        for path in dropped:
+            path.unlink(missing_ok=True)
+        return changes
+
+    def _mapped_paths(self, sample: str) -> list[Path]:
+        if self.mmap_dir is None or sample not in self.versions:
+            return []
+        return [mapped_path(self.mmap_dir, sample, self.versions[sample])]
+
+    def sample_versions(self) -> dict[str, tuple[Path, dict]]:
+        """
+        Returns the path and version of each sample currently served.
+        """
+        with self.lock:
+            return {
+                sample: (df_path, self.versions[sample])
+                for sample, df_path in self.paths.items()
+            }
+
+    def sample_status(self) -> dict[str, dict]:
+        """
+        Returns whether each sample is ready, being processed or failed to load.
+        """
+        with self.lock:
+            out = {}
+            for sample, status in self.status.items():
+                out[sample] = {
+                    "status": status["status"],
+                    "path": str(status.get("path") or self.paths[sample]),
+                    "loaded": sample in self.loaded,
+                    # the version currently served, if any
+                    "version": self.versions.get(sample),
+                }
+                if "error" in status:
+                    out[sample]["error"] = status["error"]
+            return out
+
+    def _drop(self, sample: str):
+        # forgets everything derived from the current version of a sample
+        if sample in self.loaded:
+            del self.loaded[sample]
+            del self.sizes[sample]
+        self.summaries.pop(sample, None)
+        for key in [key for key in self.indexes if key[0] == sample]:
+            del self.indexes[key]
+        for key in [key for key in self.aggregates if key[0] == sample]:
+            del self.aggregates[key]
+
+    def loaded_bytes(self) -> int:
+        return sum(self.sizes[sample] for sample in self.loaded)
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        while len(self.loaded) > 1 and self.loaded_bytes() > self.max_bytes:
+            sample, _ = self.loaded.popitem(last=False)
+            del self.sizes[sample]
+            for key in [key for key in self.indexes if key[0] == sample]:
+                del self.indexes[key]
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "samples": len(self.paths),
+                "loaded": list(self.loaded),
+                "loaded_bytes": self.loaded_bytes(),
+                "max_bytes": self.max_bytes,
+                "memory_mapped": self.mmap_dir is not None,
+                "aggregates": len(self.aggregates),
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Converts the samples to Arrow IPC files memory-mapped by the API"
+    )
+    parser.add_argument("root", help="Data directory holding the samples")
+    parser.add_argument(
+        "--mmap-dir",
+        help=f"Output directory, {MMAP_DIR} in the data directory by default",
+    )
+    args = parser.parse_args()
+    for path in convert_samples(
+        Path(args.root), Path(args.mmap_dir) if args.mmap_dir else None
+    ):
+        print(path)
@@ -0,0 +1,138 @@
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Callable
+import polars as pl
+
+STATS_COLUMNS = ["dp", "freq", "male_freq", "female_freq"]
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+HISTOGRAM_BINS = 20
+# bump when the layout of the sidecar changes, so old sidecars are recomputed
+STATS_VERSION = 1
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def stats_path(df_path: Path) -> Path:
+    return df_path.with_name(f"{df_path.name}.stats.json")
+
+
+def source_info(df_path: Path) -> dict:
+    stat = df_path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def compute_stats(lf: pl.LazyFrame) -> dict:
+    """
+    Computes the number of variants and, for each numeric column, its range, null count,
+    quantiles and an equal-width histogram.
+    """
+    summary = lf.select(
+        pl.len().alias("num_SNPs"),
+        *[pl.col(column).min().alias(f"{column}_min") for column in STATS_COLUMNS],
+        *[pl.col(column).max().alias(f"{column}_max") for column in STATS_COLUMNS],
+        *[
+            pl.col(column).null_count().alias(f"{column}_null_count")
+            for column in STATS_COLUMNS
+        ],
+        *[
+            pl.col(column).quantile(q, interpolation="linear").alias(f"{column}_q{q}")
+            for column in STATS_COLUMNS
+            for q in QUANTILES
+        ],
+    ).collect()
+
+    columns = {}
+    for column in STATS_COLUMNS:
+        min_value = summary[f"{column}_min"].item()
+        max_value = summary[f"{column}_max"].item()
+        columns[column] = {
+            "min": min_value,
+            "max": max_value,
+            "null_count": summary[f"{column}_null_count"].item(),
+            "quantiles": {str(q): summary[f"{column}_q{q}"].item() for q in QUANTILES},
+            "histogram": compute_histogram(lf, column, min_value, max_value),
+        }
+    return {"num_SNPs": summary["num_SNPs"].item(), "columns": columns}
+
+
+def compute_histogram(
+    lf: pl.LazyFrame, column: str, min_value, max_value, num_bins: int = HISTOGRAM_BINS
+) -> dict:
+    """
+    Counts the values of `column` within `[min_value, max_value]` in `num_bins`
+    equal-width bins.
+    """
+    if min_value is None or max_value is None:
+        return {"edges": [], "counts": []}
+    # a constant column gets a single bin
+    num_bins = num_bins if max_value > min_value else 1
+    width = (max_value - min_value) / num_bins or 1
+    edges = [min_value + width * i for i in range(num_bins)] + [max_value]
+    # the max value falls into the last bin
+    bins = (
+        lf.select(pl.col(column))
+        .filter(pl.col(column).is_between(min_value, max_value))
+        .select(
+            ((pl.col(column) - min_value) / width)
+            .floor()
+            .clip(0, num_bins - 1)
+            .cast(pl.Int32)
+            .alias("bin")
+        )
+        .drop_nulls()
+        .group_by("bin")
+        .len()
+        .collect()
+    )
+    counts = [0] * num_bins
+    for index, count in bins.iter_rows():
+        counts[index] = count
+    return {"edges": edges, "counts": counts}
+
+
+def load_stats(df_path: Path, scan: Callable[[], pl.LazyFrame]) -> dict:
+    """
+    Returns the stats of a sample from its sidecar file, computing and persisting them
+    when the sidecar is missing or older than the sample. `scan` is only called when
+    the stats need to be computed.
+    """
+    sidecar = stats_path(df_path)
+    source = source_info(df_path)
+    try:
+        stats = json.loads(sidecar.read_text())
+        if stats["version"] == STATS_VERSION and stats["source"] == source:
+            return stats
+    except (OSError, ValueError, KeyError):
+        pass
+
+    stats = {"version": STATS_VERSION, "source": source, **compute_stats(scan())}
+    write_stats(sidecar, stats)
+    return stats
+
+
+def write_stats(sidecar: Path, stats: dict):
+    # written atomically, the API may read it while the pipeline writes it
+    tmp_path = sidecar.with_name(f".{sidecar.name}.tmp")
+    try:
+        tmp_path.write_text(json.dumps(stats))
+        os.replace(tmp_path, sidecar)
+    except OSError as e:
+        logger.warning(f"Could not write stats to {sidecar}: {e}")
+
+
+if __name__ == "__main__":
+    # imported here, sample_registry imports this module
+    from sample_registry import scan_sample
+
+    parser = argparse.ArgumentParser(
+        description="Precomputes the stats sidecar of annotated samples"
+    )
+    parser.add_argument("input_files", nargs="+")
+    args = parser.parse_args()
+
+    for input_file in args.input_files:
+        df_path = Path(input_file)
+        load_stats(df_path, lambda: scan_sample(df_path))
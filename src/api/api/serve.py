@@ -1,12 +1,94 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import json
+import logging
+import re
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 import polars as pl
+
+# polars imports numpy lazily on first use, which is not thread-safe: endpoints run in a
+# thread pool, and fail when several of them make that first use at once
+import numpy  # noqa: F401
 from pathlib import Path
+import os
+from sample_registry import MMAP_DIR, SampleRegistry
+from lookup_index import LOOKUP_COLUMNS, LookupIndex
+from aggregations import (
+    GROUP_COLUMNS,
+    HISTOGRAM_COLUMNS,
+    SPECTRUM_COLUMNS,
+    count_by,
+    frequency_spectrum,
+    histogram,
+)
+from query import VariantQuery, run_query
+from encoding import MEDIA_TYPES, encode_variants, response_format
+from response_cache import ResponseCache, ResponseCacheMiddleware
+from metrics import (
+    PROFILE_PARAM,
+    REQUEST_SECONDS,
+    ROWS_RETURNED,
+    ROWS_SCANNED,
+    SERIALIZATION_SECONDS,
+    MetricsMiddleware,
+    ProfiledRoute,
+    record_rows,
+    render_annotation_runs,
+    render_gauges,
+)
+from fastapi.responses import PlainTextResponse
+
+# byte budget for the samples kept in memory, unlimited by default
+max_bytes = os.getenv("SAMPLE_CACHE_MAX_BYTES")
+# memory-maps samples converted to Arrow IPC, shared by the workers of a multi-process
+# server instead of being copied in each, see sample_registry.convert_sample
+memory_map = os.getenv("SAMPLE_MMAP", "0").lower() in ("1", "true")
+registry = SampleRegistry(
+    Path("data"),
+    max_bytes=int(max_bytes) if max_bytes else None,
+    mmap_dir=Path("data") / MMAP_DIR if memory_map else None,
+)
+# seconds between scans for new, updated or deleted samples, 0 disables them
+watch_interval = float(os.getenv("SAMPLE_WATCH_INTERVAL", "5"))
+# allows profiling requests with ?profile=true, see metrics.MetricsMiddleware
+profiling = os.getenv("API_PROFILING", "0").lower() in ("1", "true")
+
+# cross-sample index from rsid, HGVS id and gene id to samples, see /lookup
+lookup_index = LookupIndex()
+# byte budget for the cached responses, see response_cache
+response_cache = ResponseCache(
+    int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(256 * 1024**2)))
+)
+
+logger = logging.getLogger("uvicorn.error")
+
+
+async def watch_samples():
+    while True:
+        await asyncio.sleep(watch_interval)
+        try:
+            changes = await asyncio.to_thread(registry.refresh)
+        except Exception as e:
+            logger.warning(f"Could not refresh the samples: {e}")
+            continue
+        for change, samples in changes.items():
+            if samples:
+                logger.info(f"Samples {change}: {', '.join(samples)}")
+        if any(changes.values()):
+            await asyncio.to_thread(lookup_index.update, registry)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # built in the background, lookups build it themselves if it is not ready yet
+    indexer = asyncio.create_task(asyncio.to_thread(lookup_index.update, registry))
+    watcher = asyncio.create_task(watch_samples()) if watch_interval > 0 else None
+    yield
+    if watcher is not None:
+        watcher.cancel()
+    indexer.cancel()
 
-df_paths = sorted(Path("data").rglob("*.tsv"))
-variants_dfs: dict[str, pl.DataFrame] = {
-    df_path.stem: pl.read_csv(df_path, separator="\t").sort("freq", nulls_last=True)
-    for df_path in df_paths
-}
 
 tags_metadata = [
     {
@@ -17,10 +99,14 @@ tags_metadata = [
         "name": "items",
         "description": "Operations using the entire dataset",
     },
+    {
+        "name": "aggregate",
+        "description": "Summaries computed over the entire dataset",
+    },
 ]
 
 description = f"""
-# API for the {', '.join(list(variants_dfs.keys()))} samples
+# API for the {', '.join(registry.samples())} samples
 
 This API is designed to be used for accessing and filtering the variants in the sample.
 """
@@ -29,9 +115,46 @@ app = FastAPI(
     openapi_tags=tags_metadata,
     title="vcf api",
     description=description,
-    summary=f"API for the {', '.join(list(variants_dfs.keys()))} samples",
+    summary=f"API for the {', '.join(registry.samples())} samples",
     version="0.0.1",
+    lifespan=lifespan,
+)
+# endpoints run under the profiler of the request, if any
+app.router.route_class = ProfiledRoute
+
+
+def data_version(request: Request) -> tuple[str, float]:
+    """
+    Version of the data a response depends on: the sample in the path for per-sample
+    endpoints such as `/variants/{sample}`, all samples otherwise.
+    """
+    versions = registry.sample_versions()
+    parts = request.url.path.split("/")
+    if len(parts) > 2 and parts[2] in versions:
+        versions = {parts[2]: versions[parts[2]]}
+    versions = {
+        sample: [str(df_path), version]
+        for sample, (df_path, version) in versions.items()
+    }
+    token = hashlib.sha1(json.dumps(versions, sort_keys=True).encode()).hexdigest()
+    modified = max(
+        (version["mtime_ns"] / 1e9 for _, version in versions.values()), default=0
+    )
+    return token, modified
+
+
+# the state of the server changes without the samples changing, and profiled
+# requests must run their endpoint
+app.middleware("http")(
+    ResponseCacheMiddleware(
+        response_cache,
+        data_version,
+        ["/registry", "/status", "/metrics"],
+        [PROFILE_PARAM],
+    )
 )
+# added last, so that it also times the responses served from the cache
+app.middleware("http")(MetricsMiddleware(app, profiling))
 
 
 @app.get(
@@ -45,16 +168,16 @@ app = FastAPI(
 )
 def read_root():
     return {
-        "info": f"Serving API for the {', '.join(list(variants_dfs.keys()))} samples",
-        "samples": list(variants_dfs.keys()),
-        "num_SNPs": {sample: len(variants_dfs[sample]) for sample in variants_dfs},
+        "info": f"Serving API for the {', '.join(registry.samples())} samples",
+        "samples": registry.samples(),
+        "num_SNPs": {sample: registry.num_rows(sample) for sample in registry},
     }
 
 
 @app.get(
     "/meta",
     summary="Retrieves meta from the entire dataset",
-    description="Retrieves meta from the entire dataset",
+    description="Retrieves meta from the entire dataset: the number of SNPs, the (min, max) range of each numeric column, and detailed stats (null count, quantiles and histogram) under `stats`. They are precomputed once per sample.",
     tags=["items"],
     responses={
         200: {"description": "Successful response with dataframe as a list of dicts"},
@@ -62,23 +185,12 @@ def read_root():
 )
 def meta():
     out = {}
-    for sample in variants_dfs:
-        out[sample] = {
-            "num_SNPs": len(variants_dfs[sample]),
-            "dp": [variants_dfs[sample]["dp"].min(), variants_dfs[sample]["dp"].max()],
-            "freq": [
-                variants_dfs[sample]["freq"].min(),
-                variants_dfs[sample]["freq"].max(),
-            ],
-            "male_freq": [
-                variants_dfs[sample]["male_freq"].min(),
-                variants_dfs[sample]["male_freq"].max(),
-            ],
-            "female_freq": [
-                variants_dfs[sample]["female_freq"].min(),
-                variants_dfs[sample]["female_freq"].max(),
-            ],
-        }
+    for sample in registry:
+        summary = registry.summary(sample)
+        out[sample] = {"num_SNPs": summary["num_SNPs"]}
+        for column, stats in summary["columns"].items():
+            out[sample][column] = [stats["min"], stats["max"]]
+        out[sample]["stats"] = summary["columns"]
     return out
 
 
@@ -92,41 +204,140 @@ def meta():
     },
 )
 def samples():
-    return [sample for sample in variants_dfs]
+    return registry.samples()
+
+
+@app.get(
+    "/registry",
+    summary="Retrieves the state of the in-memory sample cache",
+    description="Retrieves which samples are loaded, their memory usage, and how many loads and evictions happened. The statistics of the response cache are under `responses`",
+    tags=["items"],
+    responses={
+        200: {"description": "Successful response with the cache statistics"},
+    },
+)
+def registry_stats():
+    return {**registry.stats(), "responses": response_cache.stats()}
+
+
+@app.get(
+    "/status",
+    summary="Retrieves the processing status of each sample",
+    description="Retrieves, for each sample found in the data directory, whether it is `ready`, still `processing` (new or updated samples are served once their stats are computed, the previous version is served meanwhile) or failed to load with an `error`. `version` identifies the version served, it changes when the sample is updated",
+    tags=["items"],
+    responses={
+        200: {"description": "Successful response with the status of each sample"},
+    },
+)
+def status():
+    return registry.sample_status()
+
+
+def paginate(
+    sample: str,
+    df: pl.DataFrame,
+    offset: int = 0,
+    limit: int | None = None,
+    columns: list[str] | None = None,
+    rows: pl.Series | None = None,
+) -> dict:
+    """
+    Slices and projects the variants before serializing them, so the cost of a response
+    is bounded by the page size rather than by the size of the sample. When `rows` is
+    given, only the rows at those positions are paginated.
+    """
+    if columns:
+        unknown_columns = [column for column in columns if column not in df.columns]
+        if unknown_columns:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid columns: {unknown_columns}. Must be in: {df.columns}",
+            )
+        df = df.select(columns)
+
+    if rows is None:
+        total = len(df)
+        page = df.slice(offset, limit)
+    else:
+        total = len(rows)
+        page = df[rows.slice(offset, limit)]
+    record_rows(total, len(page))
+
+    return {
+        "sample": sample,
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "variants": page,
+    }
+
+
+# numeric columns that can be filtered, see SortedIndex
+INDEXED_COLUMNS = ["freq", "male_freq", "female_freq", "dp"]
+
+VARIANTS_RESPONSE = {
+    "description": "Successful response with dataframe as a list of dicts, or as Arrow IPC, Parquet or NDJSON depending on `format`",
+    "content": {media_type: {} for media_type in MEDIA_TYPES.values()},
+}
+OFFSET_QUERY = Query(0, ge=0, description="Number of variants to skip")
+LIMIT_QUERY = Query(
+    None, ge=1, description="Maximum number of variants to return, all by default"
+)
+COLUMNS_QUERY = Query(
+    None, description="Columns to return, all by default. May be repeated"
+)
 
 
 @app.get(
     "/variants/{sample}",
     summary="Retrieves the entire dataset for a sample",
-    description="Retrieves the entire dataset for a sample",
+    description="Retrieves the dataset for a sample. Use `offset` and `limit` to retrieve a single page, and `columns` to retrieve only some columns. `total` is the number of variants before pagination",
     tags=["items"],
     responses={
-        200: {"description": "Successful response with dataframe as a list of dicts"},
+        200: VARIANTS_RESPONSE,
+        400: {"description": "User mistake on the query"},
+        404: {"description": "Sample not found"},
     },
 )
-def get_variants(sample: str):
-    if sample not in variants_dfs:
+def get_variants(
+    sample: str,
+    offset: int = OFFSET_QUERY,
+    limit: int | None = LIMIT_QUERY,
+    columns: list[str] | None = COLUMNS_QUERY,
+    format: str = Depends(response_format),
+):
+    if sample not in registry:
         raise HTTPException(status_code=404, detail="Sample not found")
 
-    return {"sample": sample, "variants": variants_dfs[sample].to_dicts()}
+    result = paginate(sample, registry.get(sample), offset, limit, columns)
+    return encode_variants(result, format)
 
 
 @app.get(
     "/filter/{sample}/{parameter}/{operator}/{value}",
     summary="Filters the dataset",
-    description="Filters the dataset using the specified parameter, based on the specified operator and value",
+    description="Filters the dataset using the specified parameter, based on the specified operator and value. Supports the same pagination and `columns` parameters as `/variants/{sample}`",
     tags=["filter"],
     responses={
-        200: {"description": "Successful response with dataframe as a list of dicts"},
+        200: VARIANTS_RESPONSE,
         400: {"description": "User mistake on the query"},
         404: {"description": "Sample not found"},
     },
 )
-def filter_variants(sample: str, parameter: str, operator: str, value: float):
+def filter_variants(
+    sample: str,
+    parameter: str,
+    operator: str,
+    value: float,
+    offset: int = OFFSET_QUERY,
+    limit: int | None = LIMIT_QUERY,
+    columns: list[str] | None = COLUMNS_QUERY,
+    format: str = Depends(response_format),
+):
     # hgvs	rsid	genes	freq	male_freq	female_freq	dp
-    accepted_columns = ["freq", "male_freq", "female_freq", "dp"]
+    accepted_columns = INDEXED_COLUMNS
     accepted_params = ["gt", "lt", "eq"]
-    if sample not in variants_dfs:
+    if sample not in registry:
         raise HTTPException(status_code=404, detail="Sample not found")
     if parameter not in accepted_columns:
         raise HTTPException(
@@ -139,11 +350,349 @@ def filter_variants(sample: str, parameter: str, operator: str, value: float):
             detail=f"Invalid operator. Must be one of: {accepted_params}",
         )
 
+    # resolved by binary search on the sorted index of the column
+    df, index = registry.index(sample, parameter)
     if operator == "eq":
-        filtered_variants = variants_dfs[sample].filter(pl.col(parameter) == value)
+        rows = index.range(value, value)
     elif operator == "gt":
-        filtered_variants = variants_dfs[sample].filter(pl.col(parameter) >= value)
+        rows = index.range(low=value)
     elif operator == "lt":
-        filtered_variants = variants_dfs[sample].filter(pl.col(parameter) <= value)
+        rows = index.range(high=value)
+
+    result = paginate(sample, df, offset, limit, columns, rows)
+    return encode_variants(result, format)
+
+
+@app.get(
+    "/range/{sample}/{parameter}",
+    summary="Filters the dataset by a range of values",
+    description="Retrieves the variants with `min <= parameter <= max`. Either bound may be left out. Supports the same pagination and `columns` parameters as `/variants/{sample}`",
+    tags=["filter"],
+    responses={
+        200: VARIANTS_RESPONSE,
+        400: {"description": "User mistake on the query"},
+        404: {"description": "Sample not found"},
+    },
+)
+def range_variants(
+    sample: str,
+    parameter: str,
+    min_value: float | None = Query(None, alias="min"),
+    max_value: float | None = Query(None, alias="max"),
+    offset: int = OFFSET_QUERY,
+    limit: int | None = LIMIT_QUERY,
+    columns: list[str] | None = COLUMNS_QUERY,
+    format: str = Depends(response_format),
+):
+    if sample not in registry:
+        raise HTTPException(status_code=404, detail="Sample not found")
+    if parameter not in INDEXED_COLUMNS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid parameter: {parameter}. Must be one of: {INDEXED_COLUMNS}",
+        )
+
+    df, index = registry.index(sample, parameter)
+    rows = index.range(min_value, max_value)
+    result = paginate(sample, df, offset, limit, columns, rows)
+    return encode_variants(result, format)
+
+
+# e.g. chr7:117,000,000-117,300,000, 7:117000000-, 7:117559590 or X
+REGION_PATTERN = re.compile(r"^(?:chr)?([^:]+?)(?::([\d,]*)(-?)([\d,]*))?$")
+
+
+@app.get(
+    "/region/{sample}/{region}",
+    summary="Retrieves the variants in a genomic region",
+    description="Retrieves the variants of a sample in a region such as `chr7:117,000,000-117,300,000` (1-based and inclusive, either bound may be left out), a single position such as `chr7:117559590`, or a whole chromosome such as `chr7`, in genomic order. Supports the same pagination and `columns` parameters as `/variants/{sample}`",
+    tags=["filter"],
+    responses={
+        200: VARIANTS_RESPONSE,
+        400: {"description": "User mistake on the query"},
+        404: {"description": "Sample not found"},
+    },
+)
+def region_variants(
+    sample: str,
+    region: str,
+    offset: int = OFFSET_QUERY,
+    limit: int | None = LIMIT_QUERY,
+    columns: list[str] | None = COLUMNS_QUERY,
+    format: str = Depends(response_format),
+):
+    if sample not in registry:
+        raise HTTPException(status_code=404, detail="Sample not found")
+    match = REGION_PATTERN.match(region)
+    if match is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid region: {region}. Must be like chr7:117000000-117300000",
+        )
+    chrom, start, dash, end = match.groups()
+    start = int(start.replace(",", "")) if start else None
+    # a single position without a dash
+    end = int(end.replace(",", "")) if end else (None if dash else start)
+
+    # resolved by binary search on the positions of the chromosome
+    df, index = registry.region_index(sample)
+    rows = index.region(chrom, start, end)
+    result = paginate(sample, df, offset, limit, columns, rows)
+    return encode_variants(result, format)
 
-    return {"sample": sample, "variants": filtered_variants.to_dicts()}
+
+@app.post(
+    "/query/{sample}",
+    summary="Filters the dataset with a compound query",
+    description="""Filters the dataset with a tree of predicates combined with `and`/`or`, evaluated as a single lazy polars query. Predicates are:
+- `{"op": "range", "column": "freq", "min": 0, "max": 0.01}` (either bound may be left out);
+- `{"op": "eq", "column": "rsid", "value": "rs123"}`;
+- `{"op": "is_null", "column": "dp"}` or `{"op": "is_not_null", "column": "dp"}`;
+- `{"op": "in", "column": "hgvs", "values": ["chr1:g.871334G>T"]}` (`hgvs` or `rsid`);
+- `{"op": "genes", "genes": ["ENSG00000187634"]}` (variants in any of the genes);
+- `{"op": "and", "predicates": [...]}` and `{"op": "or", "predicates": [...]}`.""",
+    tags=["filter"],
+    responses={
+        200: VARIANTS_RESPONSE,
+        400: {"description": "User mistake on the query"},
+        404: {"description": "Sample not found"},
+    },
+)
+def query_variants(
+    sample: str, query: VariantQuery, format: str = Depends(response_format)
+):
+    if sample not in registry:
+        raise HTTPException(status_code=404, detail="Sample not found")
+
+    df = registry.get(sample)
+    try:
+        total, page = run_query(df, query)
+    except (pl.exceptions.ComputeError, pl.exceptions.InvalidOperationError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid query: {e}")
+    # the query is a scan of the entire sample
+    record_rows(len(df), len(page))
+
+    result = {
+        "sample": sample,
+        "total": total,
+        "offset": query.offset,
+        "limit": query.limit,
+        "variants": page,
+    }
+    return encode_variants(result, format)
+
+
+def lookup_rows(kind: str, key: str) -> pl.DataFrame:
+    if kind not in LOOKUP_COLUMNS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid kind: {kind}. Must be one of: {list(LOOKUP_COLUMNS)}",
+        )
+    # indexes the samples that changed since the last lookup, if any
+    lookup_index.update(registry)
+    return lookup_index.lookup(kind, key)
+
+
+@app.get(
+    "/lookup/{kind}/{key}",
+    summary="Finds the samples carrying a variant or gene",
+    description="Finds the samples carrying an `rsid`, an `hgvs` id or variants in a `gene`, using an index over all samples. Returns the number of matching variants per sample and their row in `/variants/{sample}`",
+    tags=["filter"],
+    responses={
+        200: {"description": "Successful response with the matches per sample"},
+        400: {"description": "User mistake on the query"},
+    },
+)
+def lookup(kind: str, key: str):
+    matches = lookup_rows(kind, key)
+    rows = {}
+    for sample, row in matches.iter_rows():
+        rows.setdefault(sample, []).append(row)
+    return {"kind": kind, "key": key, "total": len(matches), "samples": rows}
+
+
+@app.get(
+    "/lookup/{kind}/{key}/variants",
+    summary="Retrieves the variants matching an rsid, HGVS id or gene across samples",
+    description="Retrieves the variants carrying an `rsid`, an `hgvs` id or in a `gene`, from all samples, with their `sample`. Supports the same pagination, `columns` and `format` parameters as `/variants/{sample}`",
+    tags=["filter"],
+    responses={
+        200: VARIANTS_RESPONSE,
+        400: {"description": "User mistake on the query"},
+    },
+)
+def lookup_variants(
+    kind: str,
+    key: str,
+    offset: int = OFFSET_QUERY,
+    limit: int | None = LIMIT_QUERY,
+    columns: list[str] | None = COLUMNS_QUERY,
+    format: str = Depends(response_format),
+):
+    matches = lookup_rows(kind, key)
+    # only the samples on the requested page are loaded
+    page = matches.slice(offset, limit)
+    frames = []
+    for (sample,), group in page.group_by("sample", maintain_order=True):
+        result = paginate(
+            sample, registry.get(sample), columns=columns, rows=group["row"]
+        )
+        frames.append(
+            result["variants"].select(pl.lit(sample).alias("sample"), pl.all())
+        )
+    variants = pl.concat(frames) if frames else pl.DataFrame()
+    result = {
+        "kind": kind,
+        "key": key,
+        "total": len(matches),
+        "offset": offset,
+        "limit": limit,
+        "variants": variants,
+    }
+    return encode_variants(result, format)
+
+
+@app.get(
+    "/aggregate/{sample}/count/{by}",
+    summary="Counts the variants per gene or chromosome",
+    description="Counts the variants of a sample per `gene` or `chrom`, most frequent first. A variant in several genes counts towards each of them. `total` is the number of groups, use `limit` to only return the largest ones. Cached until the sample changes",
+    tags=["aggregate"],
+    responses={
+        200: {"description": "Successful response with the groups and their count"},
+        400: {"description": "User mistake on the query"},
+        404: {"description": "Sample not found"},
+    },
+)
+def aggregate_count(
+    sample: str,
+    by: str,
+    limit: int | None = Query(
+        None, ge=1, description="Maximum number of groups to return, all by default"
+    ),
+):
+    if sample not in registry:
+        raise HTTPException(status_code=404, detail="Sample not found")
+    if by not in GROUP_COLUMNS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid group: {by}. Must be one of: {list(GROUP_COLUMNS)}",
+        )
+
+    result = registry.aggregate(sample, ("count", by), lambda lf: count_by(lf, by))
+    return {"sample": sample, **result, "groups": result["groups"][:limit]}
+
+
+@app.get(
+    "/aggregate/{sample}/histogram/{column}",
+    summary="Histogram of a numeric column",
+    description="Counts the values of a column in `bins` equal-width bins between `min` and `max`, which default to the range of the column. `edges` has one more item than `counts`, the last bin includes its upper edge. Values out of the range are counted in `out_of_range`. Cached until the sample changes",
+    tags=["aggregate"],
+    responses={
+        200: {"description": "Successful response with the bin edges and counts"},
+        400: {"description": "User mistake on the query"},
+        404: {"description": "Sample not found"},
+    },
+)
+def aggregate_histogram(
+    sample: str,
+    column: str,
+    bins: int = Query(20, ge=1, le=1000, description="Number of bins"),
+    min_value: float | None = Query(None, alias="min"),
+    max_value: float | None = Query(None, alias="max"),
+):
+    if sample not in registry:
+        raise HTTPException(status_code=404, detail="Sample not found")
+    if column not in HISTOGRAM_COLUMNS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid column: {column}. Must be one of: {HISTOGRAM_COLUMNS}",
+        )
+    if min_value is not None and max_value is not None and min_value > max_value:
+        raise HTTPException(status_code=400, detail="min must not be over max")
+
+    result = registry.aggregate(
+        sample,
+        ("histogram", column, bins, min_value, max_value),
+        lambda lf: histogram(lf, column, bins, min_value, max_value),
+    )
+    return {"sample": sample, **result}
+
+
+@app.get(
+    "/aggregate/{sample}/spectrum",
+    summary="Allele frequency spectrum",
+    description="Counts the variants of a sample per allele frequency class: `(0, 0.0001]`, `(0.0001, 0.001]`, `(0.001, 0.01]`, `(0.01, 0.05]`, `(0.05, 0.5]` and `(0.5, 1]`, the first class including 0. Cached until the sample changes",
+    tags=["aggregate"],
+    responses={
+        200: {"description": "Successful response with the count of each class"},
+        400: {"description": "User mistake on the query"},
+        404: {"description": "Sample not found"},
+    },
+)
+def aggregate_spectrum(sample: str, column: str = "freq"):
+    if sample not in registry:
+        raise HTTPException(status_code=404, detail="Sample not found")
+    if column not in SPECTRUM_COLUMNS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid column: {column}. Must be one of: {SPECTRUM_COLUMNS}",
+        )
+
+    result = registry.aggregate(
+        sample, ("spectrum", column), lambda lf: frequency_spectrum(lf, column)
+    )
+    return {"sample": sample, **result}
+
+
+@app.get(
+    "/metrics",
+    summary="Retrieves metrics in the Prometheus text format",
+    description="Retrieves the latency of the requests by endpoint, the rows scanned and returned, the time spent encoding variants, the memory used by each loaded sample, the sample and response caches, and the metrics of the last annotation run of each sample",
+    tags=["items"],
+    response_class=PlainTextResponse,
+    responses={
+        200: {"description": "Successful response with the metrics, as text"},
+    },
+)
+def metrics():
+    stats = registry.stats()
+    with registry.lock:
+        sample_bytes = {sample: registry.sizes[sample] for sample in registry.loaded}
+    rendered = [
+        REQUEST_SECONDS.render(),
+        ROWS_SCANNED.render(),
+        ROWS_RETURNED.render(),
+        SERIALIZATION_SECONDS.render(),
+        render_gauges(
+            "api_sample_bytes",
+            "Memory used by each loaded sample and its indexes",
+            sample_bytes,
+            "sample",
+        ),
+        render_gauges(
+            "api_sample_cache",
+            "State of the sample cache, see /registry",
+            {
+                key: stats[key]
+                for key in ["samples", "loaded_bytes", "hits", "loads", "evictions"]
+            },
+            "stat",
+        ),
+        render_gauges(
+            "api_response_cache",
+            "State of the response cache, see /registry",
+            response_cache.stats(),
+            "stat",
+        ),
+        render_gauges(
+            "api_lookup_index",
+            "Size of the lookup index",
+            {
+                "samples": lookup_index.stats()["samples"],
+                "bytes": lookup_index.stats()["bytes"],
+            },
+            "stat",
+        ),
+        *render_annotation_runs(registry.root),
+    ]
+    return "\n".join(rendered) + "\n"
@@ -0,0 +1,80 @@
+import polars as pl
+
+
+class SortedIndex:
+    """
+    Sorted permutation of a numeric column, used to answer range filters with a binary
+    search instead of a full scan. Null values are left out of the index, they never
+    match a range.
+    """
+
+    def __init__(self, series: pl.Series):
+        order = series.arg_sort(nulls_last=True)
+        num_values = len(series) - series.null_count()
+        self.order = order.head(num_values)
+        # floats, so that integer columns can be searched with float bounds
+        self.values = series.gather(self.order).cast(pl.Float64)
+
+    def __len__(self):
+        return len(self.values)
+
+    def range(self, low: float | None = None, high: float | None = None) -> pl.Series:
+        """
+        Returns the positions of the rows with `low <= value <= high`, in row order.
+        A missing bound leaves that side of the range open.
+        """
+        start = 0 if low is None else self.values.search_sorted(low, side="left")
+        end = (
+            len(self) if high is None else self.values.search_sorted(high, side="right")
+        )
+        return self.order.slice(start, max(end - start, 0)).sort()
+
+    def estimated_size(self) -> int:
+        return self.order.estimated_size() + self.values.estimated_size()
+
+
+class PositionIndex:
+    """
+    Variants sorted by chromosome and position, used to answer region queries with a
+    binary search within the chromosome.
+    """
+
+    def __init__(self, chrom: pl.Series, pos: pl.Series):
+        df = (
+            pl.DataFrame({"chrom": chrom, "pos": pos})
+            .with_row_index("row")
+            .drop_nulls()
+            .sort("chrom", "pos", "row")
+        )
+        self.rows = df["row"]
+        self.positions = df["pos"]
+        # range of each chromosome in the sorted positions
+        bounds = (
+            df.with_row_index("i")
+            .group_by("chrom")
+            .agg(pl.col("i").min().alias("start"), pl.len())
+        )
+        self.chroms = {
+            chrom: (start, length) for chrom, start, length in bounds.iter_rows()
+        }
+
+    def __len__(self):
+        return len(self.rows)
+
+    def region(
+        self, chrom: str, start: int | None = None, end: int | None = None
+    ) -> pl.Series:
+        """
+        Returns the positions of the rows on `chrom` with `start <= pos <= end`, in
+        genomic order. A missing bound leaves that side of the region open.
+        """
+        if chrom not in self.chroms:
+            return self.rows.clear()
+        offset, length = self.chroms[chrom]
+        positions = self.positions.slice(offset, length)
+        low = 0 if start is None else positions.search_sorted(start, side="left")
+        high = length if end is None else positions.search_sorted(end, side="right")
+        return self.rows.slice(offset + low, max(high - low, 0))
+
+    def estimated_size(self) -> int:
+        return self.rows.estimated_size() + self.positions.estimated_size()
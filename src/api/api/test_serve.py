@@ -1,28 +1,255 @@
+import serve
 from serve import app
+from sample_registry import (
+    SampleRegistry,
+    convert_sample,
+    convert_samples,
+    read_sample,
+)
+import sample_registry
+from sample_stats import stats_path
+from lookup_index import LookupIndex
+from sorted_index import PositionIndex
+from response_cache import ResponseCache, ResponseCacheMiddleware
+from metrics import MetricsMiddleware, ProfiledRoute, render_annotation_runs
+from fastapi import FastAPI, HTTPException
 from fastapi.testclient import TestClient
 import pytest
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
 import polars as pl
 
 client = TestClient(app)
 
 
-def test_variants():
-    for sample in client.get("/samples").json():
+def make_variants(rng: random.Random, num_variants: int) -> pl.DataFrame:
+    """
+    Variants annotated like `annotate.py` does, with missing values in every column.
+    """
+
+    def maybe(value):
+        return value if rng.random() > 0.2 else None
+
+    rows = []
+    for _ in range(num_variants):
+        chrom = rng.choice(["1", "2", "X"])
+        pos = rng.randint(1, 50_000_000)
+        ref, alt = rng.sample("ACGT", 2)
+        genes = [f"ENSG{rng.randint(1, 20):011d}"]
+        if rng.random() < 0.3:
+            genes.append(f"ENSG{rng.randint(21, 40):011d}")
+        rows.append(
+            {
+                "hgvs": f"chr{chrom}:g.{pos}{ref}>{alt}",
+                "chrom": chrom,
+                "pos": pos,
+                "ref": ref,
+                "alt": alt,
+                "rsid": maybe(f"rs{rng.randint(1, 10**8)}"),
+                "genes": maybe(genes),
+                "freq": maybe(round(rng.random() ** 4, 5)),
+                "male_freq": maybe(round(rng.random(), 3)),
+                "female_freq": maybe(round(rng.random(), 3)),
+                "dp": maybe(rng.randint(0, 300)),
+            }
+        )
+    return pl.DataFrame(rows)
+
+
+@pytest.fixture(scope="module")
+def samples(tmp_path_factory):
+    """
+    Serves a sample in each format from a temporary data directory. Samples share
+    some variants, like samples of a cohort.
+    """
+    root = tmp_path_factory.mktemp("data")
+    rng = random.Random(7)
+    variants = make_variants(rng, 400)
+    for name in ["a.tsv", "b.parquet", "c.arrow"]:
+        df = variants[sorted(rng.sample(range(len(variants)), 250))]
+        if name.endswith(".tsv"):
+            df = df.with_columns(pl.col("genes").list.join(","))
+            df.write_csv(root / name, separator="\t")
+        elif name.endswith(".parquet"):
+            df.write_parquet(root / name)
+        else:
+            df.write_ipc(root / name)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(serve, "registry", SampleRegistry(root))
+        monkeypatch.setattr(serve, "lookup_index", LookupIndex())
+        yield ["a", "b", "c"]
+
+
+def test_variants(samples):
+    assert client.get("/samples").json() == samples
+    for sample in samples:
         response = client.get(f"/variants/{sample}")
         assert response.status_code == 200
 
 
-def test_meta():
+def test_variants_pagination(samples):
+    for sample in samples:
+        full = client.get(f"/variants/{sample}").json()
+        total = len(full["variants"])
+        assert full["total"] == total
+
+        response = client.get(
+            f"/variants/{sample}",
+            params={"offset": 3, "limit": 5, "columns": ["hgvs", "dp"]},
+        )
+        assert response.status_code == 200
+        page = response.json()
+        assert page["total"] == total
+        assert page["variants"] == [
+            {"hgvs": variant["hgvs"], "dp": variant["dp"]}
+            for variant in full["variants"][3:8]
+        ]
+
+        response = client.get(f"/variants/{sample}", params={"columns": ["nope"]})
+        assert response.status_code == 400
+        response = client.get(f"/variants/{sample}", params={"limit": 0})
+        assert response.status_code == 422
+
+
+def test_filter_pagination(samples):
+    for sample in samples:
+        full = client.get(f"/filter/{sample}/dp/gt/0").json()
+        page = client.get(
+            f"/filter/{sample}/dp/gt/0", params={"offset": 1, "limit": 2}
+        ).json()
+        assert page["total"] == full["total"] == len(full["variants"])
+        assert page["variants"] == full["variants"][1:3]
+
+
+@pytest.mark.parametrize("param", ["dp", "freq", "male_freq", "female_freq"])
+def test_filter_matches_scan(param, samples):
+    for sample in samples:
+        df = pl.from_dicts(client.get(f"/variants/{sample}").json()["variants"])
+        values = df[param].drop_nulls()
+        for value in [values.min(), values.median(), values.max(), values[0]]:
+            for op, expr in [
+                ("gt", pl.col(param) >= value),
+                ("lt", pl.col(param) <= value),
+                ("eq", pl.col(param) == value),
+            ]:
+                response = client.get(f"/filter/{sample}/{param}/{op}/{value}")
+                expected = df.filter(expr)["hgvs"].to_list()
+                assert [v["hgvs"] for v in response.json()["variants"]] == expected
+
+        low, high = values.quantile(0.25), values.quantile(0.75)
+        response = client.get(
+            f"/range/{sample}/{param}", params={"min": low, "max": high}
+        )
+        expected = df.filter(pl.col(param).is_between(low, high))["hgvs"].to_list()
+        assert response.status_code == 200
+        assert [v["hgvs"] for v in response.json()["variants"]] == expected
+
+
+def test_query(samples):
+    for sample in samples:
+        df = pl.from_dicts(client.get(f"/variants/{sample}").json()["variants"])
+        genes = df["genes"].drop_nulls().explode().head(3).to_list()
+        rsids = df["rsid"].drop_nulls().head(3).to_list()
+        dp = df["dp"].median()
+        query = {
+            "where": {
+                "op": "or",
+                "predicates": [
+                    {
+                        "op": "and",
+                        "predicates": [
+                            {"op": "range", "column": "freq", "max": 0.5},
+                            {"op": "range", "column": "dp", "min": dp},
+                            {"op": "is_not_null", "column": "rsid"},
+                        ],
+                    },
+                    {"op": "genes", "genes": genes},
+                    {"op": "in", "column": "rsid", "values": rsids},
+                ],
+            },
+            "columns": ["hgvs", "dp"],
+            "limit": 10,
+        }
+        expected = df.filter(
+            (
+                (pl.col("freq") <= 0.5)
+                & (pl.col("dp") >= dp)
+                & pl.col("rsid").is_not_null()
+            )
+            | pl.col("genes").list.eval(pl.element().is_in(genes)).list.any()
+            | pl.col("rsid").is_in(rsids)
+        )
+        response = client.post(f"/query/{sample}", json=query)
+        assert response.status_code == 200
+        json_resp = response.json()
+        assert json_resp["total"] == len(expected)
+        assert (
+            json_resp["variants"] == expected.select("hgvs", "dp").head(10).to_dicts()
+        )
+
+        response = client.post(f"/query/{sample}", json={})
+        assert response.json()["total"] == len(df)
+
+        bad_query = {"where": {"op": "range", "column": "hgvs", "min": 1}}
+        response = client.post(f"/query/{sample}", json=bad_query)
+        assert response.status_code == 422
+
+
+def test_variants_formats(samples):
+    for sample in samples:
+        params = {"offset": 2, "limit": 50}
+        expected = client.get(f"/variants/{sample}", params=params).json()
+        expected_df = pl.from_dicts(expected["variants"])
+
+        response = client.get(
+            f"/variants/{sample}", params=params | {"format": "arrow"}
+        )
+        assert response.headers["content-type"] == "application/vnd.apache.arrow.stream"
+        assert int(response.headers["x-total"]) == expected["total"]
+        assert pl.read_ipc_stream(response.content).equals(expected_df)
+
+        response = client.get(
+            f"/variants/{sample}",
+            params=params,
+            headers={"Accept": "application/vnd.apache.parquet"},
+        )
+        assert pl.read_parquet(io.BytesIO(response.content)).equals(expected_df)
+
+        response = client.get(
+            f"/filter/{sample}/dp/gt/0", params=params | {"format": "ndjson"}
+        )
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert (
+            rows
+            == client.get(f"/filter/{sample}/dp/gt/0", params=params).json()["variants"]
+        )
+
+        response = client.get(f"/variants/{sample}", params={"format": "xml"})
+        assert response.status_code == 400
+
+
+def test_meta(samples):
     response = client.get("/meta")
     assert response.status_code == 200
     json_resp = response.json()
-    for sample in client.get("/samples").json():
+    for sample in samples:
         assert json_resp[sample]["num_SNPs"] > 0
         assert len(json_resp[sample]["dp"]) == 2
         assert len(json_resp[sample]["freq"]) == 2
         assert len(json_resp[sample]["male_freq"]) == 2
         assert len(json_resp[sample]["female_freq"]) == 2
+        for column, stats in json_resp[sample]["stats"].items():
+            assert stats["min"] == json_resp[sample][column][0]
+            assert stats["max"] == json_resp[sample][column][1]
+            histogram = stats["histogram"]
+            assert (
+                sum(histogram["counts"]) + stats["null_count"]
+                == json_resp[sample]["num_SNPs"]
+            )
 
 
 @pytest.mark.parametrize(
@@ -48,10 +275,10 @@ def test_meta():
         ("female_freq", "eq", "float"),
     ],
 )
-def test_filter_correct(param, op, val):
+def test_filter_correct(param, op, val, samples):
     response = client.get("/meta")
     json_resp = response.json()
-    for sample in client.get("/samples").json():
+    for sample in samples:
         min, max = tuple(json_resp[sample][param])
         if val == "int":
             val = random.randint(min, max)
@@ -63,8 +290,8 @@ def test_filter_correct(param, op, val):
 
 
 @pytest.mark.parametrize("param", ["dp", "freq", "male_freq", "female_freq"])
-def test_filter_min_value(param):
-    for sample in client.get("/samples").json():
+def test_filter_min_value(param, samples):
+    for sample in samples:
         df = pl.from_dicts(client.get(f"/variants/{sample}").json()["variants"])
         num_SNPs = len(df.filter(pl.col(param).is_not_null()))
         json_resp = client.get("/meta").json()
@@ -91,8 +318,8 @@ def test_filter_min_value(param):
 
 
 @pytest.mark.parametrize("param", ["dp", "freq", "male_freq", "female_freq"])
-def test_filter_max_value(param):
-    for sample in client.get("/samples").json():
+def test_filter_max_value(param, samples):
+    for sample in samples:
         df = pl.from_dicts(client.get(f"/variants/{sample}").json()["variants"])
         num_SNPs = len(df.filter(pl.col(param).is_not_null()))
         json_resp = client.get("/meta").json()
@@ -116,3 +343,548 @@ def test_filter_max_value(param):
         # Assert that the length of the returned variants equals num_SNPs
         json_resp = response.json()
         assert len(json_resp["variants"]) == num_SNPs
+
+
+def test_registry_lru(tmp_path):
+    df = pl.DataFrame(
+        {
+            "hgvs": ["chr1:g.1A>T", "chr1:g.2A>T"],
+            "rsid": ["rs1", None],
+            "genes": [["ENSG1", "ENSG2"], None],
+            "freq": [0.5, None],
+            "male_freq": [0.4, 0.1],
+            "female_freq": [None, 0.2],
+            "dp": [10, 20],
+        }
+    )
+    for name in ["a", "b", "c"]:
+        df.write_parquet(tmp_path / f"{name}.parquet")
+    (tmp_path / ".cache").mkdir()
+    df.write_parquet(tmp_path / ".cache" / "hidden.parquet")
+
+    size = read_sample(tmp_path / "a.parquet").estimated_size()
+    registry = SampleRegistry(tmp_path, max_bytes=2 * size)
+    assert registry.samples() == ["a", "b", "c"]
+    assert registry.num_rows("c") == 2
+    assert registry.stats()["loads"] == 0
+
+    assert registry.get("a").equals(df)
+    registry.get("b")
+    registry.get("a")
+    registry.get("c")
+    stats = registry.stats()
+    assert stats["loaded"] == ["a", "c"]
+    assert stats["loads"] == 3
+    assert stats["hits"] == 1
+    assert stats["evictions"] == 1
+    assert stats["loaded_bytes"] <= stats["max_bytes"]
+
+
+def assert_unlocked(registry: SampleRegistry):
+    """
+    Fails, rather than hangs, if the registry lock is held.
+    """
+    executor = ThreadPoolExecutor(1)
+    try:
+        executor.submit(registry.stats).result(timeout=5)
+    finally:
+        executor.shutdown(wait=False)
+
+
+def test_registry_memory_mapped(tmp_path, monkeypatch):
+    df = pl.DataFrame(
+        {
+            "hgvs": [f"chr1:g.{i}A>T" for i in range(10)],
+            "rsid": [f"rs{i}" for i in range(10)],
+            "genes": [["ENSG1"]] * 10,
+            "freq": [(i * 7 % 10) / 10 for i in range(10)],
+            "male_freq": [None] * 10,
+            "female_freq": [0.5] * 10,
+            "dp": list(range(10)),
+        },
+        schema_overrides={"male_freq": pl.Float64},
+    )
+    df.write_parquet(tmp_path / "a.parquet")
+    mmap_dir = tmp_path / ".mmap"
+    registry = SampleRegistry(tmp_path, mmap_dir=mmap_dir)
+    assert registry.samples() == ["a"]
+    assert registry.get("a").equals(read_sample(tmp_path / "a.parquet"))
+    assert registry.stats()["memory_mapped"]
+    (converted,) = mmap_dir.iterdir()
+
+    # another worker maps the same file instead of converting the sample again
+    mtime = converted.stat().st_mtime_ns
+    assert (
+        SampleRegistry(tmp_path, mmap_dir=mmap_dir).get("a").equals(registry.get("a"))
+    )
+    assert converted.stat().st_mtime_ns == mtime
+    assert convert_samples(tmp_path) == [converted]
+
+    # files of the versions a worker drops are removed, not those of other versions
+    lagging = SampleRegistry(tmp_path, mmap_dir=mmap_dir)
+    df.head(5).write_parquet(tmp_path / "a.parquet")
+    assert registry.refresh()["updated"] == ["a"]
+    assert not converted.exists()
+
+    # samples are converted outside of the registry lock
+    def convert(df_path, target):
+        assert_unlocked(registry)
+        return convert_sample(df_path, target)
+
+    monkeypatch.setattr(sample_registry, "convert_sample", convert)
+    assert len(registry.get("a")) == 5
+    (updated,) = mmap_dir.iterdir()
+    assert lagging.refresh()["updated"] == ["a"]
+    assert list(mmap_dir.iterdir()) == [updated]
+
+
+def test_stats_sidecar(tmp_path, monkeypatch):
+    df = pl.DataFrame(
+        {
+            "hgvs": [f"chr1:g.{i}A>T" for i in range(100)],
+            "rsid": [None] * 100,
+            "genes": [None] * 100,
+            "freq": [i / 100 for i in range(100)],
+            "male_freq": [None] * 100,
+            "female_freq": [0.5] * 100,
+            "dp": list(range(100)),
+        },
+        schema_overrides={"genes": pl.List(pl.String), "male_freq": pl.Float64},
+    )
+    df.write_parquet(tmp_path / "a.parquet")
+
+    summary = SampleRegistry(tmp_path).summary("a")
+    assert stats_path(tmp_path / "a.parquet").exists()
+    assert summary["num_SNPs"] == 100
+    assert summary["columns"]["dp"]["histogram"]["counts"] == [5] * 20
+    assert summary["columns"]["freq"]["quantiles"]["0.5"] == pytest.approx(0.495)
+    assert summary["columns"]["male_freq"]["null_count"] == 100
+    assert summary["columns"]["female_freq"]["histogram"]["counts"] == [100]
+
+    # served from the sidecar without reading the sample
+    registry = SampleRegistry(tmp_path)
+    registry.scan = None
+    assert registry.summary("a") == summary
+
+    # stats are computed outside of the registry lock
+    stats_path(tmp_path / "a.parquet").unlink()
+    registry = SampleRegistry(tmp_path)
+    load_stats = sample_registry.load_stats
+
+    def load_stats_unlocked(df_path, scan):
+        assert_unlocked(registry)
+        return load_stats(df_path, scan)
+
+    monkeypatch.setattr(sample_registry, "load_stats", load_stats_unlocked)
+    assert registry.summary("a") == summary
+
+
+def test_registry_refresh(tmp_path):
+    df = pl.DataFrame(
+        {
+            "hgvs": ["chr1:g.1A>T", "chr1:g.2A>T"],
+            "rsid": ["rs1", None],
+            "genes": [["ENSG1"], None],
+            "freq": [0.5, 0.1],
+            "male_freq": [0.4, 0.1],
+            "female_freq": [None, 0.2],
+            "dp": [10, 20],
+        }
+    )
+    df.write_parquet(tmp_path / "a.parquet")
+    df.write_parquet(tmp_path / "b.parquet")
+    registry = SampleRegistry(tmp_path)
+    registry.get("a")
+    registry.get("b")
+    registry.index("a", "freq")
+    assert registry.refresh() == {"added": [], "updated": [], "removed": []}
+    assert registry.stats()["loads"] == 2
+
+    # a new sample, an updated one and a deleted one
+    df.write_parquet(tmp_path / "c.parquet")
+    pl.concat([df, df]).write_parquet(tmp_path / "a.parquet")
+    (tmp_path / "b.parquet").unlink()
+    (tmp_path / "broken.parquet").write_text("not parquet")
+    assert registry.refresh() == {"added": ["c"], "updated": ["a"], "removed": ["b"]}
+    assert registry.samples() == ["a", "c"]
+    assert registry.stats()["loaded"] == []
+    assert registry.num_rows("a") == 4
+    assert len(registry.get("a")) == 4
+    df, index = registry.index("a", "freq")
+    assert len(df) == len(index) == 4
+
+    status = registry.sample_status()
+    assert status["a"]["status"] == "ready"
+    assert status["a"]["version"] == registry.versions["a"]
+    assert status["broken"]["status"] == "error"
+    assert "broken" not in registry
+    # unchanged and failed files are not read again
+    assert registry.refresh() == {"added": [], "updated": [], "removed": []}
+    assert registry.stats()["loads"] == 3
+
+
+def test_region(samples):
+    for sample in samples:
+        df = pl.from_dicts(client.get(f"/variants/{sample}").json()["variants"])
+        chrom, pos = df.select("chrom", "pos").drop_nulls().row(0)
+        for region, expr in [
+            (f"chr{chrom}", pl.col("chrom") == chrom),
+            (
+                f"{chrom}:{pos:,}-{pos + 10_000_000:,}",
+                pl.col("pos").is_between(pos, pos + 10_000_000),
+            ),
+            (f"chr{chrom}:{pos}", pl.col("pos") == pos),
+            (f"chr{chrom}:-{pos}", pl.col("pos") <= pos),
+        ]:
+            response = client.get(f"/region/{sample}/{region}")
+            assert response.status_code == 200
+            expected = (
+                df.with_row_index("row")
+                .filter((pl.col("chrom") == chrom) & expr)
+                .sort("pos", "row")
+                .drop("row")
+            )
+            assert response.json()["variants"] == expected.to_dicts()
+        assert client.get(f"/region/{sample}/chr1:x-y").status_code == 400
+        assert client.get(f"/region/{sample}/chrZ").json()["total"] == 0
+
+
+def test_position_index():
+    index = PositionIndex(
+        pl.Series(["2", "1", "1", None, "1"]), pl.Series([5, 30, 10, 7, 20])
+    )
+    assert len(index) == 4
+    assert index.region("1").to_list() == [2, 4, 1]
+    assert index.region("1", 15, 30).to_list() == [4, 1]
+    assert index.region("1", 20, 20).to_list() == [4]
+    assert index.region("1", end=9).to_list() == []
+    assert index.region("2", 1).to_list() == [0]
+    assert index.region("3").to_list() == []
+
+
+def test_lookup(samples):
+    for sample in samples:
+        df = pl.from_dicts(client.get(f"/variants/{sample}").json()["variants"])
+        for kind, key in [
+            ("hgvs", df["hgvs"][0]),
+            ("rsid", df["rsid"].drop_nulls()[0]),
+            ("gene", df["genes"].drop_nulls().explode()[0]),
+        ]:
+            matches = client.get(f"/lookup/{kind}/{key}").json()
+            rows = matches["samples"][sample]
+            assert len(rows) >= 1
+            variants = client.get(
+                f"/lookup/{kind}/{key}/variants", params={"limit": matches["total"]}
+            ).json()
+            assert variants["total"] == matches["total"]
+            expected = [dict(df.row(row, named=True), sample=sample) for row in rows]
+            assert [
+                v for v in variants["variants"] if v["sample"] == sample
+            ] == expected
+    assert client.get("/lookup/nope/x").status_code == 400
+    assert client.get("/lookup/rsid/rs-nope").json()["total"] == 0
+
+
+def test_lookup_index(tmp_path):
+    df = pl.DataFrame(
+        {
+            "hgvs": ["chr1:g.1A>T", "chr1:g.2A>T", "chr1:g.3A>T"],
+            "rsid": ["rs1", None, "rs3"],
+            "genes": [["ENSG1", "ENSG2"], None, ["ENSG2"]],
+            "freq": [0.5, None, 0.1],
+            "male_freq": [0.4, 0.1, 0.3],
+            "female_freq": [None, 0.2, 0.3],
+            "dp": [10, 20, 30],
+        }
+    )
+    df.write_parquet(tmp_path / "a.parquet")
+    df.tail(2).write_parquet(tmp_path / "b.parquet")
+    registry = SampleRegistry(tmp_path)
+    index = LookupIndex()
+    assert index.update(registry)
+    assert not index.update(registry)
+
+    # rows are positions in the served DataFrame, sorted by freq
+    served = registry.get("a")
+    matches = index.lookup("gene", "ENSG2")
+    assert matches["sample"].to_list() == ["a", "a", "b"]
+    assert [served["hgvs"][row] for row in matches["row"].head(2)] == [
+        "chr1:g.3A>T",
+        "chr1:g.1A>T",
+    ]
+    assert index.lookup("rsid", "rs1").rows() == [("a", 1)]
+    assert len(index.lookup("rsid", "rs2")) == 0
+
+    (tmp_path / "b.parquet").unlink()
+    registry.refresh()
+    assert index.update(registry)
+    assert index.lookup("gene", "ENSG2")["sample"].to_list() == ["a", "a"]
+    assert index.stats()["samples"] == 1
+
+
+def test_aggregate(samples):
+    for sample in samples:
+        df = pl.from_dicts(client.get(f"/variants/{sample}").json()["variants"])
+
+        genes = client.get(f"/aggregate/{sample}/count/gene").json()
+        expected = df["genes"].explode().drop_nulls().value_counts(name="count")
+        assert genes["total"] == len(expected)
+        assert sum(group["count"] for group in genes["groups"]) == len(
+            df["genes"].explode().drop_nulls()
+        )
+        counts = [group["count"] for group in genes["groups"]]
+        assert counts == sorted(counts, reverse=True)
+        limited = client.get(f"/aggregate/{sample}/count/chrom", params={"limit": 1})
+        (largest,) = limited.json()["groups"]
+        assert largest["count"] == df["chrom"].value_counts()["count"].max()
+
+        median = df["dp"].median()
+        histogram = client.get(
+            f"/aggregate/{sample}/histogram/dp", params={"bins": 7, "max": median}
+        ).json()
+        assert len(histogram["counts"]) == 7
+        assert len(histogram["edges"]) == 8
+        assert sum(histogram["counts"]) == df.filter(pl.col("dp") <= median).height
+        assert sum(histogram["counts"]) + histogram["null_count"] + histogram[
+            "out_of_range"
+        ] == len(df)
+
+        spectrum = client.get(f"/aggregate/{sample}/spectrum").json()
+        assert [bucket["count"] for bucket in spectrum["buckets"]] == [
+            df.filter(pl.col("freq").is_between(low, high, closed=closed)).height
+            for low, high, closed in [
+                (0, 0.0001, "both"),
+                (0.0001, 0.001, "right"),
+                (0.001, 0.01, "right"),
+                (0.01, 0.05, "right"),
+                (0.05, 0.5, "right"),
+                (0.5, 1, "right"),
+            ]
+        ]
+        assert spectrum["null_count"] == df["freq"].null_count()
+
+        assert client.get(f"/aggregate/{sample}/count/rsid").status_code == 400
+        assert client.get(f"/aggregate/{sample}/histogram/hgvs").status_code == 400
+        assert client.get(f"/aggregate/{sample}/spectrum?column=dp").status_code == 400
+    assert client.get("/aggregate/nope/spectrum").status_code == 404
+
+
+def test_registry_aggregate(tmp_path):
+    df = pl.DataFrame(
+        {
+            "hgvs": ["chr1:g.1A>T", "chr1:g.2A>T"],
+            "rsid": ["rs1", None],
+            "genes": [["ENSG1"], None],
+            "freq": [0.5, 0.1],
+            "male_freq": [0.4, 0.1],
+            "female_freq": [None, 0.2],
+            "dp": [10, 20],
+        }
+    )
+    df.write_parquet(tmp_path / "a.parquet")
+    registry = SampleRegistry(tmp_path)
+    calls = []
+
+    def compute(lf):
+        calls.append(1)
+        return {"num_SNPs": lf.select(pl.len()).collect().item()}
+
+    assert registry.aggregate("a", ("n",), compute) == {"num_SNPs": 2}
+    assert registry.aggregate("a", ("n",), compute) == {"num_SNPs": 2}
+    assert len(calls) == 1
+
+    # recomputed for the new version of the sample
+    pl.concat([df, df]).write_parquet(tmp_path / "a.parquet")
+    assert registry.refresh()["updated"] == ["a"]
+    assert registry.aggregate("a", ("n",), compute) == {"num_SNPs": 4}
+    assert len(calls) == 2
+
+    # only the most recently used aggregates are kept
+    registry = SampleRegistry(tmp_path, max_aggregates=2)
+    for key in ["x", "y", "x", "z", "x", "y"]:
+        registry.aggregate("a", (key,), compute)
+    assert len(calls) == 6
+    assert registry.stats()["aggregates"] == 2
+
+
+def test_response_cache_headers(samples):
+    for sample in samples:
+        url = f"/variants/{sample}"
+        response = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        etag = response.headers["etag"]
+        cached = client.get(url, headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in cached.headers
+        assert cached.headers["etag"] == etag
+        assert cached.json() == response.json()
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        last_modified = response.headers["last-modified"]
+        response = client.get(url, headers={"If-Modified-Since": last_modified})
+        assert response.status_code == 304
+        # other parameters and formats are other representations
+        for params in [{"limit": 1}, {"format": "arrow"}]:
+            response = client.get(url, params=params, headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["etag"] != etag
+    assert "etag" in client.get("/samples").headers
+    assert "etag" not in client.get("/registry").headers
+    response = client.get(
+        "/variants/nope", headers={"If-Modified-Since": "Thu, 01 Jan 2099 00:00:00 GMT"}
+    )
+    assert response.status_code == 404
+
+
+def test_response_cache():
+    calls = []
+    version = {"token": "1"}
+    cache_app = FastAPI()
+
+    @cache_app.get("/items/{item}")
+    def item(item: str):
+        calls.append(item)
+        if item == "missing":
+            raise HTTPException(status_code=404)
+        return {"item": item, "padding": "x" * 100}
+
+    cache = ResponseCache(max_bytes=300)
+    cache_app.middleware("http")(
+        ResponseCacheMiddleware(cache, lambda request: (version["token"], 0), [])
+    )
+    cache_client = TestClient(cache_app)
+
+    first = cache_client.get("/items/a")
+    assert cache_client.get("/items/a").json() == first.json()
+    assert calls == ["a"]
+    assert cache_client.get("/items/missing").status_code == 404
+    assert cache_client.get("/items/missing").status_code == 404
+    assert calls == ["a", "missing", "missing"]
+
+    # errors are not turned into 304s, even though the data didn't change since
+    for headers in [
+        {"If-Modified-Since": "Thu, 01 Jan 2099 00:00:00 GMT"},
+        {"If-None-Match": "*, " + first.headers["etag"]},
+    ]:
+        response = cache_client.get("/items/missing", headers=headers)
+        assert response.status_code == 404
+        assert "etag" not in response.headers
+    assert len(calls) == 5
+    response = cache_client.get(
+        "/items/a", headers={"If-Modified-Since": "Thu, 01 Jan 2099 00:00:00 GMT"}
+    )
+    assert response.status_code == 304
+    assert len(calls) == 5
+
+    # a new version of the data is recomputed, with another ETag
+    version["token"] = "2"
+    second = cache_client.get("/items/a")
+    assert calls[-1] == "a" and len(calls) == 6
+    assert second.headers["etag"] != first.headers["etag"]
+
+    # the least recently used responses are evicted
+    cache_client.get("/items/b")
+    cache_client.get("/items/c")
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["bytes"] <= 300
+    cache_client.get("/items/a")
+    assert calls[-1] == "a" and len(calls) == 9
+
+
+def test_metrics(samples):
+    for sample in samples:
+        client.get(f"/variants/{sample}", params={"limit": 3})
+        client.get(f"/range/{sample}/dp")
+    text = client.get("/metrics").text
+    assert "# TYPE api_request_duration_seconds histogram" in text
+    assert (
+        'api_request_duration_seconds_count{endpoint="/samples",method="GET",status="200"}'
+        in text
+    )
+    for sample in samples:
+        assert f'api_sample_bytes{{sample="{sample}"}}' in text
+        assert 'api_rows_returned_total{endpoint="/variants/{sample}"}' in text
+    assert 'api_response_cache{stat="hits"}' in text
+
+
+def test_profiling():
+    profiled_app = FastAPI()
+    profiled_app.router.route_class = ProfiledRoute
+
+    def slow_sum(n: int) -> int:
+        return sum(range(n))
+
+    @profiled_app.get("/sum/{n}")
+    def get_sum(n: int):
+        return {"sum": slow_sum(n)}
+
+    profiled_app.middleware("http")(MetricsMiddleware(profiled_app, profiling=True))
+    profiled_client = TestClient(profiled_app)
+    assert profiled_client.get("/sum/10").json() == {"sum": 45}
+    response = profiled_client.get("/sum/10", params={"profile": "true"})
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "slow_sum" in response.text
+
+    # profilers are process-wide, a request profiled meanwhile is rejected
+    started, release = threading.Event(), threading.Event()
+
+    @profiled_app.get("/wait")
+    def wait():
+        started.set()
+        release.wait(5)
+        return {}
+
+    with ThreadPoolExecutor(1) as executor:
+        first = executor.submit(profiled_client.get, "/wait", params={"profile": "1"})
+        assert started.wait(5)
+        second = profiled_client.get("/sum/10", params={"profile": "true"})
+        release.set()
+        assert first.result().status_code == 200
+    assert second.status_code == 429
+    assert "function calls" in first.result().text
+    assert "function calls" in (
+        profiled_client.get("/sum/10", params={"profile": "true"}).text
+    )
+
+    # disabled by default
+    assert client.get("/samples", params={"profile": "true"}).json() == (
+        client.get("/samples").json()
+    )
+
+
+def test_render_annotation_runs(tmp_path):
+    assert render_annotation_runs(tmp_path) == []
+    (tmp_path / "a" / ".metrics").mkdir(parents=True)
+    run = {
+        "sample": "x",
+        "finished": 1.5,
+        "seconds": 2.0,
+        "variants": 10,
+        "variants_per_second": 5.0,
+        "chunks": 3,
+        "chunk_seconds": {"sum": 0.6, "buckets": {"0.1": 1, "1": 2}},
+        "requests": 4,
+        "retries": 1,
+        "errors": 0,
+        "cache_hits": 2,
+        "cache_misses": 8,
+        "cache_hit_rate": 0.2,
+    }
+    (tmp_path / "a" / ".metrics" / "x.tsv.json").write_text(json.dumps(run))
+    text = "\n".join(render_annotation_runs(tmp_path))
+    assert 'annotate_last_run_retries{sample="x"} 1' in text
+    assert 'annotate_last_run_chunk_seconds_bucket{sample="x",le="1"} 3' in text
+    assert 'annotate_last_run_chunk_seconds_count{sample="x"} 3' in text
+
+    # incomplete runs and runs outside of the served samples are skipped
+    (tmp_path / "a" / ".metrics" / "y.tsv.json").write_text(json.dumps({"sample": "y"}))
+    (tmp_path / "a" / ".metrics" / "z.tsv.json").write_text("[]")
+    (tmp_path / ".cohort" / ".metrics").mkdir(parents=True)
+    (tmp_path / ".cohort" / ".metrics" / "annotations.parquet.json").write_text(
+        json.dumps({**run, "sample": "annotations"})
+    )
+    text = "\n".join(render_annotation_runs(tmp_path))
+    assert 'annotate_last_run_retries{sample="x"} 1' in text
+    assert 'sample="y"' not in text
+    assert 'sample="annotations"' not in text
@@ -0,0 +1,391 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import httpx
+import polars as pl
+
+ROOT = Path(__file__).resolve().parents[1]
+# the annotation modules are imported, the API is run in a subprocess
+sys.path.insert(0, str(ROOT / "annotate"))
+
+import annotate  # noqa: E402
+from annotation_writer import AnnotationWriter  # noqa: E402
+from async_myvariant import AsyncMyVariantInfo  # noqa: E402
+from fake_myvariant import FakeMyVariant  # noqa: E402
+from synthetic import write_annotated, write_vcf  # noqa: E402
+
+SUITES = ["annotate", "serve"]
+SIZES = [1_000, 100_000]
+# bump when results are no longer comparable with those of previous versions
+RESULTS_VERSION = 1
+# metrics compared with a baseline, all of them are better when lower
+COMPARED_METRICS = ["seconds", "p95"]
+SAMPLE = "synthetic"
+PAGE_SIZE = 100
+# seconds to wait for the API to start
+STARTUP_TIMEOUT = 60
+
+
+def timed(function, repeat: int) -> tuple[float, object]:
+    """
+    Returns the best time of `repeat` calls of `function`, and its last result.
+    """
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        best = min(best, time.perf_counter() - start)
+    return best, value
+
+
+def make_result(suite: str, name: str, size: int, seconds: float, items: int) -> dict:
+    return {
+        "suite": suite,
+        "name": name,
+        "size": size,
+        "seconds": seconds,
+        "items": items,
+        "items_per_second": items / seconds if seconds else None,
+    }
+
+
+def bench_annotate(size: int, workdir: Path, repeat: int, latency: float) -> list:
+    """
+    Times each step of `annotate.py` on a synthetic VCF of `size` records: parsing, the
+    queries to a local fake MyVariant.info, the annotation of the hits, and writing
+    them out.
+    """
+    vcf_path = workdir / f"{size}.vcf.gz"
+    write_vcf(vcf_path, size)
+    results = []
+
+    with FakeMyVariant(latency=latency) as server:
+        client = AsyncMyVariantInfo(url=server.url)
+        seconds, hgvs = timed(lambda: client.get_hgvs_from_vcf(vcf_path), repeat)
+        results.append(
+            make_result("annotate", "get_hgvs_from_vcf", size, seconds, len(hgvs))
+        )
+
+        seconds, response = timed(
+            lambda: asyncio.run(
+                client.getvariants(hgvs, chunk_size=1000, fields=annotate.FIELDS)
+            ),
+            repeat,
+        )
+        results.append(make_result("annotate", "getvariants", size, seconds, len(hgvs)))
+
+    seconds, df = timed(
+        lambda: annotate.annotations_to_frame(
+            annotate.annotate_variant(data) for data in response
+        ),
+        repeat,
+    )
+    results.append(
+        make_result("annotate", "annotate_variant", size, seconds, len(response))
+    )
+    seconds, df = timed(lambda: annotate.annotate_variants(response), repeat)
+    results.append(
+        make_result("annotate", "annotate_variants", size, seconds, len(response))
+    )
+
+    for format in ["tsv", "parquet", "arrow"]:
+
+        def write():
+            with AnnotationWriter(
+                workdir / f"{size}.{format}", annotate.OUTPUT_SCHEMA
+            ) as output:
+                for chunk in df.iter_slices(1000):
+                    output.write(chunk)
+
+        seconds, _ = timed(write, repeat)
+        results.append(
+            make_result("annotate", f"write_{format}", size, seconds, len(df))
+        )
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_api(data_root: Path) -> tuple[subprocess.Popen, str]:
+    """
+    Runs `serve.py` with uvicorn on the samples in `data_root / "data"`, and waits for
+    it to answer.
+    """
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "serve:app",
+            "--app-dir",
+            str(ROOT / "api"),
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        cwd=data_root,
+        env={**os.environ, "SAMPLE_WATCH_INTERVAL": "0"},
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The API exited with code {process.returncode}")
+        try:
+            httpx.get(f"{url}/samples").raise_for_status()
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"The API did not start in {STARTUP_TIMEOUT} seconds")
+
+
+def scenarios(size: int) -> dict:
+    """
+    Requests sent by the API benchmark, as functions of a random generator returning a
+    path and its parameters. Random pages and thresholds defeat the response cache,
+    `variants_cached` measures it.
+    """
+    page = {"limit": PAGE_SIZE}
+    return {
+        "meta": lambda rng: ("/meta", {}),
+        "variants": lambda rng: (
+            f"/variants/{SAMPLE}",
+            {**page, "offset": rng.randrange(max(size - PAGE_SIZE, 1))},
+        ),
+        "variants_cached": lambda rng: (f"/variants/{SAMPLE}", page),
+        "filter": lambda rng: (f"/filter/{SAMPLE}/freq/lt/{rng.random():.6f}", page),
+    }
+
+
+async def load(url: str, request, num_requests: int, concurrency: int) -> dict:
+    """
+    Sends `num_requests` requests, `concurrency` at a time, and returns the latency
+    percentiles and the throughput.
+    """
+    rng = random.Random(0)
+    requests = [request(rng) for _ in range(num_requests)]
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async def send(http: httpx.AsyncClient, path: str, params: dict):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await http.get(path, params=params)
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code != 200
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*[send(http, *request) for request in requests])
+        seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "seconds": seconds,
+        "requests_per_second": num_requests / seconds,
+        "concurrency": concurrency,
+        "errors": errors,
+        "mean": sum(latencies) / len(latencies),
+        **{
+            f"p{q}": latencies[min(len(latencies) - 1, len(latencies) * q // 100)]
+            for q in [50, 95, 99]
+        },
+    }
+
+
+def bench_serve(size: int, workdir: Path, num_requests: int, concurrency: int) -> list:
+    """
+    Measures the latency and throughput of the API on a synthetic sample of `size`
+    variants, under `concurrency` concurrent clients.
+    """
+    data_root = workdir / f"serve-{size}"
+    (data_root / "data").mkdir(parents=True, exist_ok=True)
+    write_annotated(data_root / "data" / f"{SAMPLE}.parquet", size)
+    process, url = start_api(data_root)
+    results = []
+    try:
+        # loading the sample and computing its stats are measured apart
+        start = time.perf_counter()
+        for path in ["/meta", f"/variants/{SAMPLE}?limit=1", f"/range/{SAMPLE}/freq"]:
+            httpx.get(f"{url}{path}", timeout=None).raise_for_status()
+        seconds = time.perf_counter() - start
+        results.append(make_result("serve", "first_requests", size, seconds, 3))
+
+        for name, request in scenarios(size).items():
+            stats = asyncio.run(load(url, request, num_requests, concurrency))
+            results.append(
+                {
+                    "suite": "serve",
+                    "name": name,
+                    "size": size,
+                    "items": num_requests,
+                    **stats,
+                }
+            )
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "version": RESULTS_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results: list, baseline: list, tolerance: float) -> list[str]:
+    """
+    Returns the benchmarks slower than in `baseline` by more than `tolerance`, e.g. 0.2
+    for 20%. Benchmarks missing from the baseline are not compared.
+    """
+    previous = {(r["suite"], r["name"], r["size"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result["suite"], result["name"], result["size"]))
+        if before is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if metric not in result or not before.get(metric):
+                continue
+            ratio = result[metric] / before[metric]
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f"{result['suite']}/{result['name']} ({result['size']}): {metric} "
+                    f"{before[metric]:.4g} -> {result[metric]:.4g} (x{ratio:.2f})"
+                )
+    return regressions
+
+
+def run(
+    suites: list[str],
+    sizes: list[int],
+    workdir: Path,
+    repeat: int = 1,
+    latency: float = 0.0,
+    num_requests: int = 200,
+    concurrency: int = 8,
+) -> dict:
+    results = []
+    for size in sizes:
+        if "annotate" in suites:
+            results += bench_annotate(size, workdir, repeat, latency)
+        if "serve" in suites:
+            results += bench_serve(size, workdir, num_requests, concurrency)
+    return {"environment": environment(), "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the annotation pipeline and the API on synthetic data, offline"
+    )
+    parser.add_argument(
+        "--suite",
+        choices=SUITES,
+        action="append",
+        help="May be repeated, all by default",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        action="append",
+        help=f"Number of variants, may be repeated. Defaults to {SIZES}",
+    )
+    parser.add_argument(
+        "--output",
+        default="bench_results.json",
+        help="JSON file the results are written to",
+    )
+    parser.add_argument(
+        "--baseline", help="Results of a previous run, regressions are reported"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Slowdown over the baseline reported as a regression, 0.2 for 20%%",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Runs of each annotation step, the best is kept",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds the fake MyVariant.info waits per query",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="Requests per API scenario"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Concurrent API clients"
+    )
+    parser.add_argument(
+        "--workdir", help="Directory for the synthetic data, temporary by default"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp_dir:
+        report = run(
+            args.suite or SUITES,
+            args.size or SIZES,
+            Path(args.workdir or tmp_dir),
+            repeat=args.repeat,
+            latency=args.latency,
+            num_requests=args.requests,
+            concurrency=args.concurrency,
+        )
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    for result in report["results"]:
+        print(
+            f"{result['suite']:>8} {result['name']:<20} {result['size']:>10} "
+            f"{result['seconds']:>10.4f}s"
+            + (f" p95 {result['p95'] * 1000:.2f}ms" if "p95" in result else "")
+        )
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline["environment"].get("version") != RESULTS_VERSION:
+            sys.exit(
+                f"{args.baseline} was produced by another version of the benchmarks"
+            )
+        regressions = compare(report["results"], baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,89 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from synthetic import fake_hit
+
+
+class FakeMyVariantHandler(BaseHTTPRequestHandler):
+    """
+    Answers `POST /v1/variant` and `GET /v1/metadata` like MyVariant.info, with the
+    annotations of `synthetic.fake_hit`.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/metadata"):
+            self._send_json({"build_version": "synthetic"})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/variant"):
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        form = parse_qs(body.decode())
+        ids = [id.strip('"') for id in form["ids"][0].split(",")]
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.requests += 1
+        self._send_json([fake_hit(id) for id in ids])
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeMyVariant:
+    """
+    Local stand-in for MyVariant.info, served over HTTP from a background thread so that
+    benchmarks include the cost of the network stack without depending on the real API.
+    Each query waits `latency` seconds, to emulate a remote server.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.server = ThreadingHTTPServer((host, port), FakeMyVariantHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.requests = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def requests(self) -> int:
+        return self.server.requests
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves a fake MyVariant.info API")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds each query waits"
+    )
+    args = parser.parse_args()
+    with FakeMyVariant(port=args.port, latency=args.latency) as server:
+        print(f"Serving on {server.url}, use it with annotate.py --url {server.url}")
+        server.thread.join()
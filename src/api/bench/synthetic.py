@@ -0,0 +1,196 @@
+import argparse
+import gzip
+import random
+import zlib
+from itertools import batched
+from pathlib import Path
+import numpy as np
+import polars as pl
+
+CHROMS = [str(i) for i in range(1, 23)] + ["X"]
+BASES = "ACGT"
+# largest distance between consecutive variants
+MAX_GAP = 2000
+# variants written at a time
+WRITE_BATCH_SIZE = 100_000
+# share of the variants that are indels, and that have a second ALT allele
+INDEL_RATE = 0.05
+MULTI_ALLELIC_RATE = 0.03
+# columns of an annotated sample, see `annotate.OUTPUT_SCHEMA`
+ANNOTATED_SCHEMA = {
+    "hgvs": pl.String,
+    "chrom": pl.String,
+    "pos": pl.Int64,
+    "ref": pl.String,
+    "alt": pl.String,
+    "rsid": pl.String,
+    "genes": pl.List(pl.String),
+    "freq": pl.Float64,
+    "male_freq": pl.Float64,
+    "female_freq": pl.Float64,
+    "dp": pl.Int64,
+}
+
+
+def iter_records(num_variants: int, seed: int = 0):
+    """
+    Yields `(chrom, pos, ref, alts)` records spread over `CHROMS`, sorted by position.
+    """
+    rng = random.Random(seed)
+    per_chrom = -(-num_variants // len(CHROMS))
+    for i, chrom in enumerate(CHROMS):
+        pos = 0
+        for _ in range(min(per_chrom, num_variants - i * per_chrom)):
+            pos += rng.randint(1, MAX_GAP)
+            ref = rng.choice(BASES)
+            alts = [rng.choice(BASES.replace(ref, ""))]
+            if rng.random() < INDEL_RATE:
+                alts = [ref + "".join(rng.choices(BASES, k=rng.randint(1, 5)))]
+            elif rng.random() < MULTI_ALLELIC_RATE:
+                alts.append(rng.choice(BASES.replace(ref, "").replace(alts[0], "")))
+            yield f"chr{chrom}", pos, ref, alts
+
+
+def write_vcf(path: Path | str, num_variants: int, seed: int = 0):
+    """
+    Writes a VCF of `num_variants` records without samples. The VCF is gzipped when
+    the path ends with `.gz`, it is not bgzipped so it can't be indexed.
+    """
+    path = Path(path)
+    # positions are at most `MAX_GAP` apart
+    length = -(-num_variants // len(CHROMS)) * MAX_GAP
+    header = ["##fileformat=VCFv4.2"]
+    header += [f"##contig=<ID=chr{chrom},length={length}>" for chrom in CHROMS]
+    header.append("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO")
+
+    if path.suffix == ".gz":
+        file = gzip.open(path, "wt", compresslevel=1)
+    else:
+        file = open(path, "w")
+    with file:
+        file.write("\n".join(header) + "\n")
+        for batch in batched(iter_records(num_variants, seed), WRITE_BATCH_SIZE):
+            file.write(
+                "".join(
+                    f"{chrom}\t{pos}\t.\t{ref}\t{','.join(alts)}\t.\t.\t.\n"
+                    for chrom, pos, ref, alts in batch
+                )
+            )
+
+
+def iter_hgvs(num_variants: int, seed: int = 0):
+    """
+    Yields the HGVS ids of the SNVs of the records, as found in a synthetic VCF.
+    """
+    for chrom, pos, ref, alts in iter_records(num_variants, seed):
+        for alt in alts:
+            if len(alt) == 1:
+                yield f"{chrom}:g.{pos}{ref}>{alt}"
+
+
+def fake_hit(id: str) -> dict:
+    """
+    MyVariant.info hit for an HGVS id, derived from its hash so that the same id always
+    gets the same annotations. About one in ten ids is not found.
+    """
+    rng = random.Random(zlib.crc32(id.encode()))
+    if rng.random() < 0.1:
+        return {"query": id, "notfound": True}
+    hit = {"query": id, "_id": id}
+    if rng.random() < 0.8:
+        hit["dbsnp"] = {"rsid": f"rs{rng.randint(1, 10**9)}"}
+    if rng.random() < 0.8:
+        genes = [{"gene_id": f"ENSG{rng.randint(1, 60_000):011d}"}]
+        hit["cadd"] = {
+            "gene": genes if rng.random() < 0.5 else genes[0],
+            "1000g": {"af": rng.random()},
+        }
+    if rng.random() < 0.7:
+        af = rng.random() ** 4
+        hit["gnomad_exome"] = {
+            "af": {"af": af, "af_male": af * 0.9, "af_female": min(af * 1.1, 1.0)},
+            "dp": rng.randint(1, 10**6),
+        }
+    if rng.random() < 0.3:
+        hit["exac"] = {"af": rng.random() ** 4, "dp": rng.randint(1, 10**5)}
+    return hit
+
+
+def make_annotated(num_variants: int, seed: int = 0) -> pl.DataFrame:
+    """
+    Annotated sample of `num_variants` SNVs, with the columns written by `annotate.py`
+    and about the same share of missing values as real samples. Values are drawn a
+    column at a time by numpy, and formatted by polars.
+    """
+    rng = np.random.default_rng(seed)
+    per_chrom = -(-num_variants // len(CHROMS))
+    bases = pl.Series(list(BASES))
+    ref = rng.integers(0, len(BASES), num_variants)
+    # any base but the REF
+    alt = (ref + rng.integers(1, len(BASES), num_variants)) % len(BASES)
+    df = pl.DataFrame(
+        {
+            "chrom": pl.Series(CHROMS).gather(np.arange(num_variants) // per_chrom),
+            "gap": rng.integers(1, MAX_GAP + 1, num_variants),
+            "ref": bases.gather(ref),
+            "alt": bases.gather(alt),
+            "rsid": rng.integers(1, 10**9 + 1, num_variants),
+            "gene": rng.integers(1, 60_001, num_variants),
+            "freq": rng.random(num_variants) ** 4,
+            "dp": rng.integers(1, 10**6 + 1, num_variants),
+            # whether each value is present
+            "has_rsid": rng.random(num_variants) < 0.8,
+            "has_gene": rng.random(num_variants) < 0.8,
+            "has_freq": rng.random(num_variants) < 0.8,
+            "has_dp": rng.random(num_variants) < 0.9,
+        }
+    )
+    pos = pl.col("gap").cum_sum().over("chrom")
+    freq = pl.when(pl.col("has_freq")).then(pl.col("freq"))
+    gene_id = pl.format("ENSG{}", pl.col("gene").cast(pl.String).str.zfill(11))
+    return df.select(
+        pl.format("chr{}:g.{}{}>{}", "chrom", pos, "ref", "alt").alias("hgvs"),
+        "chrom",
+        pos.alias("pos"),
+        "ref",
+        "alt",
+        pl.when(pl.col("has_rsid")).then(pl.format("rs{}", "rsid")).alias("rsid"),
+        # like annotate.py, variants without genes have none rather than an empty list
+        pl.when(pl.col("has_gene")).then(pl.concat_list(gene_id)).alias("genes"),
+        freq.alias("freq"),
+        (freq * 0.9).alias("male_freq"),
+        (freq * 1.1).clip(upper_bound=1.0).alias("female_freq"),
+        pl.when(pl.col("has_dp")).then(pl.col("dp")).alias("dp"),
+    ).cast(ANNOTATED_SCHEMA)
+
+
+def write_annotated(path: Path | str, num_variants: int, seed: int = 0):
+    """
+    Writes an annotated sample as TSV, Parquet or Arrow IPC depending on the extension.
+    """
+    path = Path(path)
+    df = make_annotated(num_variants, seed)
+    if path.suffix == ".tsv":
+        df.with_columns(pl.col("genes").list.join(",")).write_csv(path, separator="\t")
+    elif path.suffix == ".parquet":
+        df.write_parquet(path)
+    else:
+        df.write_ipc(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generates synthetic VCFs and annotated samples for benchmarks"
+    )
+    parser.add_argument("kind", choices=["vcf", "annotated"])
+    parser.add_argument(
+        "output_file",
+        help="VCF (.vcf or .vcf.gz), or annotated sample (.tsv, .parquet or .arrow)",
+    )
+    parser.add_argument("--variants", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.kind == "vcf":
+        write_vcf(args.output_file, args.variants, args.seed)
+    else:
+        write_annotated(args.output_file, args.variants, args.seed)
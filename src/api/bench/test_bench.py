@@ -0,0 +1,54 @@
+import asyncio
+import bench
+from async_myvariant import AsyncMyVariantInfo
+from fake_myvariant import FakeMyVariant
+import synthetic
+import polars as pl
+import sys
+
+
+def test_synthetic_vcf(tmp_path):
+    vcf_path = tmp_path / "synthetic.vcf.gz"
+    synthetic.write_vcf(vcf_path, 500, seed=1)
+    hgvs = AsyncMyVariantInfo().get_hgvs_from_vcf(vcf_path)
+    snvs = [id for id in hgvs if ">" in id]
+    assert snvs == list(synthetic.iter_hgvs(500, seed=1))
+    assert len(hgvs) >= 500
+
+    df = synthetic.make_annotated(500, seed=1)
+    assert len(df) == 500
+    assert df.schema == pl.Schema(synthetic.ANNOTATED_SCHEMA)
+    assert df["hgvs"].is_unique().all()
+    assert df["genes"].null_count() > 0
+    assert (df["genes"].list.len() > 0).all()
+
+
+def test_import_keeps_excepthook():
+    # failures of the benchmarks are reported as is
+    assert sys.excepthook is not bench.annotate.handle_exception
+
+
+def test_fake_myvariant():
+    ids = ["chr1:g.1A>T", "chr2:g.2C>G"]
+    with FakeMyVariant() as server:
+        client = AsyncMyVariantInfo(url=server.url)
+        response = asyncio.run(client.getvariants(ids, chunk_size=1))
+        assert asyncio.run(client.source_version()) == "synthetic"
+    assert response == [synthetic.fake_hit(id) for id in ids]
+    assert server.requests == 2
+
+
+def test_bench(tmp_path):
+    report = bench.run(
+        ["annotate", "serve"], [200], tmp_path, num_requests=5, concurrency=2
+    )
+    names = {(result["suite"], result["name"]) for result in report["results"]}
+    assert ("annotate", "getvariants") in names
+    assert ("serve", "filter") in names
+    assert all(result["seconds"] > 0 for result in report["results"])
+    assert all(result.get("errors", 0) == 0 for result in report["results"])
+
+    results = report["results"]
+    assert bench.compare(results, results, tolerance=0.1) == []
+    slower = [{**result, "seconds": result["seconds"] * 2} for result in results]
+    assert len(bench.compare(slower, results, tolerance=0.5)) == len(results)
@@ -2,4 +2,11 @@
 
 uv run snakemake
 
-uv run fastapi run serve.py --port 4000
\ No newline at end of file
+# several workers share the samples through memory-mapped Arrow IPC files, converted once
+API_WORKERS=${API_WORKERS:-1}
+if [ "$API_WORKERS" -gt 1 ]; then
+    export SAMPLE_MMAP=1
+    uv run python sample_registry.py data
+fi
+
+uv run fastapi run serve.py --port 4000 --workers "$API_WORKERS"
\ No newline at end of file
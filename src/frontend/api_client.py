@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import os
+import polars as pl
+import requests
+from requests.adapters import HTTPAdapter
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+API_BASE_URL = os.getenv("API_BASE_URL")
+# seconds responses are cached for, they are also refetched when the samples change
+CACHE_TTL = int(os.getenv("FRONTEND_CACHE_TTL", "600"))
+# pages kept in the cache, shared by all users
+MAX_CACHED_PAGES = 256
+# connections kept open to the API
+POOL_SIZE = 8
+
+
+@st.cache_resource
+def get_session() -> requests.Session:
+    """
+    HTTP session shared by all reruns and users, so that connections to the API are
+    reused rather than opened for each request.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get(endpoint: str, params: dict | None = None) -> requests.Response:
+    response = get_session().get(f"{API_BASE_URL}{endpoint}", params=params)
+    response.raise_for_status()
+    return response
+
+
+def fetch_status() -> dict:
+    """
+    Returns the status of each sample. Never cached: the versions it carries are what
+    the other responses are cached by.
+    """
+    return get("/status").json()
+
+
+def version_key(status: dict, sample: str | None = None) -> str:
+    """
+    Key for the responses depending on a sample, or on all samples by default. It
+    changes when the API serves a new version of them.
+    """
+    if sample is not None:
+        return json.dumps(status.get(sample, {}).get("version"), sort_keys=True)
+    versions = {sample: info.get("version") for sample, info in status.items()}
+    return json.dumps(versions, sort_keys=True)
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def fetch_json(endpoint: str, version: str, params: dict | None = None):
+    """
+    Returns the JSON response of an endpoint. `version` is only part of the cache key,
+    see `version_key`.
+    """
+    return get(endpoint, params).json()
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=MAX_CACHED_PAGES)
+def fetch_page(
+    endpoint: str, version: str, offset: int, limit: int, columns: list[str]
+) -> tuple[int, pl.DataFrame]:
+    """
+    Returns the total number of variants of a `/variants` or `/filter` endpoint and a
+    page of them, transferred as Arrow rather than JSON. `version` is only part of the
+    cache key, see `version_key`.
+    """
+    response = get(
+        endpoint,
+        {"offset": offset, "limit": limit, "columns": columns, "format": "arrow"},
+    )
+    return int(response.headers["X-Total"]), pl.read_ipc_stream(
+        io.BytesIO(response.content)
+    )
+
+
+def fetch_concurrently(*calls: tuple) -> list:
+    """
+    Runs `(function, *args)` calls in threads and returns their results in order. The
+    threads share the context of the script run, which cached functions need.
+    """
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=len(calls), initializer=lambda: add_script_run_ctx(ctx=ctx)
+    ) as executor:
+        futures = [executor.submit(function, *args) for function, *args in calls]
+        return [future.result() for future in futures]
@@ -1,27 +1,29 @@
 import streamlit as st
 import requests
-import os
 import time
 import polars as pl
-
-API_BASE_URL = os.getenv("API_BASE_URL")
+from api_client import (
+    fetch_concurrently,
+    fetch_json,
+    fetch_page,
+    fetch_status,
+    get,
+    version_key,
+)
 
 
 def check_api_status():
     while True:
         try:
-            response = requests.get(f"{API_BASE_URL}/")
-            response.raise_for_status()
+            get("/")
             return True
         except requests.exceptions.RequestException:
             time.sleep(2)  # Wait for 2 seconds before retrying
 
 
-def fetch_data(endpoint, params=None):
+def fetch_data(function, *args):
     try:
-        response = requests.get(f"{API_BASE_URL}{endpoint}", params=params)
-        response.raise_for_status()
-        return response.json()
+        return function(*args)
     except requests.exceptions.RequestException as e:
         st.error(f"An error occurred: {e}")
         return None
@@ -37,6 +39,9 @@ COLUMN_MAPPING = {
 
 OP_MAPPING = {"gt": "Greater than", "eq": "Equal to", "lt": "Less than"}
 
+# Columns requested from the API for the variants table
+DISPLAY_COLUMNS = ["hgvs", "rsid", "freq", "male_freq", "female_freq", "dp"]
+
 
 def main():
     st.set_page_config(
@@ -50,20 +55,38 @@ def main():
     # Sidebar
     st.sidebar.title("Filter Options")
 
-    # Fetch available samples from the API
-    samples = fetch_data("/samples")
+    # Responses are cached until the API serves new versions of the samples
+    status = fetch_data(fetch_status) or {}
+    versions = version_key(status)
+
+    # Fetch available samples and their metadata from the API
+    fetched = fetch_data(
+        fetch_concurrently,
+        (fetch_json, "/samples", versions),
+        (fetch_json, "/meta", versions),
+    )
+    if not fetched:
+        return
+    samples, meta = fetched
     if not samples:
         return
 
     # Sidebar dropdown for selecting a sample
     selected_sample = st.sidebar.selectbox("Select sample", samples)
 
-    # If sample changes, reset the filtered data
+    # Samples written by the pipeline are picked up by the API while it runs
+    processing = [
+        sample for sample, info in status.items() if info["status"] == "processing"
+    ]
+    if processing:
+        st.sidebar.caption(f"Processing: {', '.join(processing)}")
+
+    # If sample changes, reset the filter
     if (
         "selected_sample" in st.session_state
         and st.session_state["selected_sample"] != selected_sample
     ):
-        st.session_state["filtered"] = None  # Clear filtered data when sample changes
+        st.session_state["filtered"] = None  # Clear filter when sample changes
 
     st.session_state["selected_sample"] = selected_sample  # Store the selected sample
 
@@ -83,11 +106,6 @@ def main():
         format_func=lambda x: OP_MAPPING.get(x, x),
     )
 
-    # Fetch metadata for the selected sample
-    meta = fetch_data("/meta")
-    if not meta:
-        return
-
     min_value = float(meta[selected_sample][parameter][0])
 
     manual_value = st.sidebar.text_input(
@@ -100,37 +118,38 @@ def main():
     page = st.sidebar.number_input("Page number:", min_value=1, value=1, step=1)
     page_size = st.sidebar.number_input("Page size:", min_value=1, value=10, step=1)
 
-    # Fetch data from filter endpoint
+    # Only the endpoint is stored, pages are fetched from it as needed
     if st.sidebar.button("Apply Filter"):
-        st.session_state["filtered"] = fetch_data(
-            f"/filter/{selected_sample}/{parameter}/{operator}/{value}",
+        st.session_state["filtered"] = (
+            f"/filter/{selected_sample}/{parameter}/{operator}/{value}"
         )
 
     st.sidebar.markdown("---")
     st.sidebar.header("Metadata (min, max)")
     st.sidebar.json(meta[selected_sample], expanded=False)
 
-    # Fetch filtered data if not already in session state
+    # Defaults to the entire dataset when no filter was applied
     if "filtered" not in st.session_state or st.session_state["filtered"] is None:
-        all_data = fetch_data(f"/variants/{selected_sample}")
-        if all_data:
-            st.session_state["filtered"] = all_data
-        else:
-            st.write("No variants data available for this sample.")
-
-    filtered_data = st.session_state.get("filtered", [])
+        st.session_state["filtered"] = f"/variants/{selected_sample}"
+
+    start_idx = (page - 1) * page_size
+    # the next page is fetched alongside, so that paging forward is served from cache
+    endpoint = st.session_state["filtered"]
+    version = version_key(status, selected_sample)
+    pages = fetch_data(
+        fetch_concurrently,
+        *[
+            (fetch_page, endpoint, version, offset, page_size, DISPLAY_COLUMNS)
+            for offset in [start_idx, start_idx + page_size]
+        ],
+    )
 
     st.header("Variants")
-    if filtered_data:
-        filtered_data = filtered_data["variants"]
-
-        total_records = len(filtered_data)
-        start_idx = (page - 1) * page_size
-        end_idx = start_idx + page_size
-        paginated_data = filtered_data[start_idx:end_idx]
+    if pages:
+        total_records, paginated_data = pages[0]
+        end_idx = start_idx + len(paginated_data)
 
-        if paginated_data:
-            paginated_data = pl.from_dicts(paginated_data)
+        if len(paginated_data):
             paginated_data = paginated_data.with_columns(
                 (
                     pl.lit("https://www.ncbi.nlm.nih.gov/snp/")